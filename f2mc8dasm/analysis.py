@@ -0,0 +1,145 @@
+'''
+Disassemble rom images in-process.  analyze() traces an image, generates
+symbols, and returns an Analysis that can render the listing:
+
+    from f2mc8dasm.analysis import Options, analyze
+
+    analysis = analyze(rom, Options(entry_points=[0xedba]))
+    text = analysis.listing()
+
+'''
+
+import contextlib
+import io
+
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.listing import Printer
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import MB89620R_SYMBOLS, SymbolTable
+from f2mc8dasm.trace import Tracer
+
+VECTORS = (
+    # callv
+    0xffc0, 0xffc2, 0xffc4, 0xffc6, 0xffc8, 0xffca, 0xffcc, 0xffce,
+    # irq
+    0xffd0, 0xffd2, 0xffd4, 0xffd6, 0xffd8, 0xffda, 0xffdc, 0xffde,
+    0xffe0, 0xffe2, 0xffe4, 0xffe6, 0xffe8, 0xffea, 0xffec, 0xffee,
+    0xfff0, 0xfff2, 0xfff4, 0xfff6, 0xfff8, 0xfffa,
+    # reset
+    0xfffe,
+    )
+
+
+class Options(object):
+    '''Options for analyze().  Keyword arguments override the defaults.'''
+
+    def __init__(self, **kwargs):
+        self.entry_points = ()      # addresses to trace besides the vectors
+        self.vectors = VECTORS      # addresses of vectors to trace
+        self.symbols = MB89620R_SYMBOLS # initial symbols: {address: (name, comment)}
+        self.reserved_bytes = (0xfffc,) # addresses of reserved bytes
+        self.mode_bytes = (0xfffd,) # addresses of mode bytes
+        self.merge_states = False   # trace with a MergingTraceQueue
+        self.observer = None        # TraceObserver or None for no events
+
+        for k, v in kwargs.items():
+            if hasattr(self, k):
+                setattr(self, k, v)
+            else:
+                raise KeyError(k)
+
+
+class Analysis(object):
+    '''The result of analyze(): the traced memory, the symbol table, and
+    the tracer.  Use resume() to trace more entry points or vectors; it
+    rebuilds the symbol table from initial_symbols.  Resuming the tracer
+    directly leaves the symbol table stale.'''
+
+    def __init__(self, memory, symbol_table, tracer, start_address,
+                 initial_symbols=MB89620R_SYMBOLS):
+        self.memory = memory
+        self.symbol_table = symbol_table
+        self.tracer = tracer
+        self.start_address = start_address
+        self.initial_symbols = initial_symbols
+
+    def resume(self, entry_points=(), vectors=()):
+        '''Trace from more entry points and vectors.  Only the states that
+        become reachable are traced and only the branches they reach are
+        annotated again.  The symbols are generated again for all of the
+        code found.'''
+        for address in entry_points:
+            self.tracer.add_entry_point(address)
+        for address in vectors:
+            self.tracer.add_vector(address)
+        self.tracer.trace(disassemble_inst)
+        self.symbol_table = SymbolTable(self.initial_symbols)
+        self.symbol_table.generate(self.memory, self.start_address)
+
+    def printer(self):
+        return Printer(self.memory, self.start_address, self.symbol_table)
+
+    def iter_lines(self):
+        '''Generate the lines of the listing without line endings'''
+        return self.printer().iter_lines()
+
+    def print_listing(self, stream=None, processes=1):
+        '''Write the listing to a text stream, sys.stdout by default.  If
+        processes is more than 1, it is rendered by that many processes.'''
+        self.printer().print_listing(stream, processes)
+
+    def listing(self, processes=1):
+        '''Return the listing as a string'''
+        stream = io.StringIO()
+        self.print_listing(stream, processes)
+        return stream.getvalue()
+
+
+def analyze(rom, options=None, stats=None):
+    '''Disassemble a rom image (bytes-like, up to 64K) that is aligned to
+    the top of memory and return an Analysis.  If a Stats is given, the
+    load, trace, and symbols phases and the tracer counters are recorded.'''
+    with _phase(stats, 'load'):
+        memory = Memory(rom)
+    return _analyze(memory, options, stats)
+
+def analyze_file(filename, options=None, stats=None):
+    '''Disassemble a rom image file and return an Analysis'''
+    with _phase(stats, 'load'):
+        memory = Memory.from_file(filename)
+    return _analyze(memory, options, stats)
+
+def _analyze(memory, options, stats):
+    start_address = memory.start_address
+    if options is None:
+        options = Options()
+    for address in options.reserved_bytes:
+        memory.set_reserved_byte(address)
+    for address in options.mode_bytes:
+        memory.set_mode_byte(address)
+
+    traceable_range = range(start_address, 0x10000)
+    tracer = Tracer(memory, options.entry_points, options.vectors,
+                    traceable_range, merge_states=options.merge_states)
+    if options.observer is not None:
+        tracer.add_observer(options.observer)
+    if stats is not None:
+        stats.watch_tracer(tracer)
+    with _phase(stats, 'trace'):
+        tracer.trace(disassemble_inst)
+    if stats is not None:
+        stats.count_tracer(tracer)
+
+    with _phase(stats, 'symbols'):
+        symbol_table = SymbolTable(options.symbols)
+        symbol_table.generate(memory, start_address)
+    return Analysis(memory, symbol_table, tracer, start_address,
+                    options.symbols)
+
+@contextlib.contextmanager
+def _phase(stats, name):
+    if stats is None:
+        yield
+    else:
+        with stats.phase(name):
+            yield
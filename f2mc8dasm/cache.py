@@ -0,0 +1,182 @@
+'''
+A directory of analysis results that are reused when the same rom image
+is analyzed again with the same options.  Results are stored under a hash
+of the rom, the options, and the package version and source code, so a
+change to the disassembler never returns stale results:
+
+    <directory>/<2 hex digits>/<sha256>.snap   snapshot of the Analysis
+    <directory>/<2 hex digits>/<sha256>.asm    listing, if one was asked for
+
+When the files in the directory are larger than max_size, the ones that
+were least recently used are deleted until they are no larger than
+EVICT_FRACTION of max_size.
+'''
+
+import hashlib
+import io
+import os
+import tempfile
+import threading
+
+from f2mc8dasm import __version__, snapshot
+from f2mc8dasm.analysis import Analysis, Options, analyze
+
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+EVICT_FRACTION = 0.9
+
+
+class Cache(object):
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._size = None # size of the files in the directory, estimated
+        self._lock = threading.Lock() # for _size, shared by server threads
+
+    def analyze(self, rom, options=None):
+        '''Return the Analysis of a rom image like analyze(), from the cache
+        if it is there.  Options with an observer are never cached because
+        a cached result would not send it any events.'''
+        if options is None:
+            options = Options()
+        if options.observer is not None:
+            return analyze(rom, options)
+
+        filename = self._filename(rom, options, '.snap')
+        data = self._read(filename, 'rb')
+        if data is not None:
+            try:
+                loaded = snapshot.load(io.BytesIO(data))
+            except ValueError:
+                os.remove(filename)
+            else:
+                return Analysis(loaded.memory, loaded.symbol_table,
+                                loaded.tracer, loaded.memory.start_address,
+                                options.symbols)
+
+        analysis = analyze(rom, options)
+        f = io.BytesIO()
+        snapshot.save(f, analysis.memory, analysis.symbol_table,
+                      analysis.tracer)
+        self._write(filename, 'wb', f.getvalue())
+        return analysis
+
+    def listing(self, rom, options=None):
+        '''Return the listing of a rom image as a string, from the cache if
+        it is there'''
+        if options is None:
+            options = Options()
+        if options.observer is not None:
+            return analyze(rom, options).listing()
+
+        filename = self._filename(rom, options, '.asm')
+        text = self._read(filename, 'r')
+        if text is None:
+            text = self.analyze(rom, options).listing()
+            self._write(filename, 'w', text)
+        return text
+
+    def key(self, rom, options):
+        '''Return the hex digest that results for the rom and options are
+        stored under'''
+        h = hashlib.sha256()
+        h.update(('f2mc8dasm %s %s\n' % (__version__, source_digest())
+                  ).encode('utf-8'))
+        fields = (list(options.entry_points), list(options.vectors),
+                  list(options.reserved_bytes), list(options.mode_bytes),
+                  bool(options.merge_states),
+                  sorted(options.symbols.items()))
+        h.update(('%r\n' % (fields,)).encode('utf-8'))
+        h.update(rom)
+        return h.hexdigest()
+
+    def evict(self, size=None):
+        '''Delete the least recently used files until the files in the
+        directory are no larger than size, max_size by default.  Return
+        the size of the files left.'''
+        if size is None:
+            size = self.max_size
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.endswith('.tmp'): # being written
+                    continue
+                filename = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(filename)
+                except OSError: # removed by another process
+                    continue
+                entries.append((st.st_mtime, st.st_size, filename))
+                total += st.st_size
+
+        entries.sort()
+        for mtime, file_size, filename in entries:
+            if total <= size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= file_size
+        return total
+
+    def _filename(self, rom, options, ext):
+        key = self.key(rom, options)
+        return os.path.join(self.directory, key[:2], key + ext)
+
+    def _read(self, filename, mode):
+        try:
+            with open(filename, mode) as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            os.utime(filename, None) # most recently used
+        except OSError: # evicted by another process
+            pass
+        return data
+
+    def _write(self, filename, mode, data):
+        # written to a temporary file and renamed so that other processes
+        # never read a partial file
+        dirname = os.path.dirname(filename)
+        os.makedirs(dirname, exist_ok=True)
+        fd, temp_filename = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+        try:
+            with open(fd, mode) as f:
+                f.write(data)
+            os.replace(temp_filename, filename)
+        except:
+            os.remove(temp_filename)
+            raise
+        self._grow(os.path.getsize(filename))
+
+    def _grow(self, size):
+        # the directory is walked once, and after that only when the files
+        # written since would make it larger than max_size.  files written
+        # by other processes are found by the next walk.
+        with self._lock:
+            if self._size is None:
+                self._size = self.evict()
+            else:
+                self._size += size
+                if self._size > self.max_size:
+                    self._size = self.evict(
+                        int(self.max_size * EVICT_FRACTION))
+
+
+_source_digest = None
+
+def source_digest():
+    '''Return a hex digest of the source files of the package'''
+    global _source_digest
+    if _source_digest is None:
+        h = hashlib.sha256()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(package_dir)):
+            if name.endswith('.py'):
+                h.update(name.encode('utf-8') + b'\0')
+                with open(os.path.join(package_dir, name), 'rb') as f:
+                    h.update(f.read())
+        _source_digest = h.hexdigest()
+    return _source_digest
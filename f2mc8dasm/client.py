@@ -0,0 +1,76 @@
+'''
+Usage: f2mc8dasm-client <socket> <filename.bin>
+
+Writes the listing of a rom image to stdout, disassembled by a server
+that was started with "f2mc8dasm --serve <socket>".  This module does not
+import the disassembler so that it starts quickly.
+
+'''
+
+import base64
+import json
+import socket
+import sys
+
+
+class Client(object):
+    '''Sends requests to a server listening on a Unix domain socket'''
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+    def request(self, request):
+        '''Send a request and return the response'''
+        self.sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError("Server closed the connection")
+        return json.loads(line.decode('utf-8'))
+
+    def listing(self, rom, **options):
+        '''Return the listing of a rom image.  Raises RuntimeError with
+        the message of the server if the request failed.'''
+        response = self.request({
+            'rom': base64.b64encode(bytes(rom)).decode('ascii'),
+            'options': options,
+            })
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response['listing']
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if len(argv) != 2:
+        sys.stderr.write(__doc__)
+        sys.exit(1)
+    sys.exit(request_listing(argv[0], argv[1]))
+
+def request_listing(path, filename, stream=None):
+    '''Write the listing of a rom image file from the server to a stream,
+    sys.stdout by default, with the options of the f2mc8dasm command.
+    Return the exit status.'''
+    if stream is None:
+        stream = sys.stdout
+    with open(filename, 'rb') as f:
+        rom = f.read()
+    client = Client(path)
+    try:
+        stream.write(client.listing(rom, entry_points=[0xedba]))
+    except RuntimeError as exc:
+        sys.stderr.write("%s: %s\n" % (filename, exc))
+        return 1
+    finally:
+        client.close()
+    return 0
+
+
+if __name__ == '__main__':
+    main()
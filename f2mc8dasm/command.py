@@ -1,53 +1,257 @@
 '''
-Usage: f2mc8dasm <filename.bin>
+Usage: f2mc8dasm [-c <directory>] [--stats] [--stats-json <file>]
+                 [--profile <directory>] [--timeline <file>] <filename.bin>
+       f2mc8dasm [-c <directory>] [-j <jobs>] [-o <directory>]
+                 <filename.bin|directory> ...
+       f2mc8dasm [-c <directory>] --serve <socket>|-
+       f2mc8dasm --connect <socket> <filename.bin>
+
+With one file, the listing is written to stdout.  With several files or
+a directory (all of its *.bin files), each listing is written next to its
+file, or to the -o directory, with the extension .asm.  Files whose
+listings would be written to the same file fail.  Files are disassembled
+by a pool of -j worker processes (default: one per CPU).
+
+With -c, results are cached in the directory and a file that was
+disassembled before with the same options is not disassembled again.
+
+With --stats, the wall time, CPU time, and peak memory of each phase and
+the tracer counters are written to stderr.  With --stats-json, they are
+written as JSON to the file.  With --profile, each phase is profiled and
+dumped to <directory>/<phase>.prof.  With --timeline, the phases and
+samples of the trace queue and memory are written to the file as Chrome
+trace events, which can be opened in Perfetto or chrome://tracing.
+
+With --serve, requests are answered from the Unix domain socket, or from
+stdin if it is "-", until interrupted.  See server.py for the protocol.
+With --connect, the listing is disassembled by such a server.
 
 '''
 
+import argparse
+import glob
+import multiprocessing
+import os
 import sys
+import time
+
+from f2mc8dasm.analysis import Options, analyze_file
+from f2mc8dasm.cache import Cache
+from f2mc8dasm.client import request_listing
+from f2mc8dasm.observers import LoggingObserver
+from f2mc8dasm.server import serve_stream, serve_unix
+from f2mc8dasm.stats import Stats
+from f2mc8dasm.timeline import Timeline
+
+def main(argv=None):
+    usage = __doc__.strip().split('\n\n')[0].replace('Usage: ', '', 1)
+    parser = argparse.ArgumentParser(prog='f2mc8dasm', usage=usage)
+    parser.add_argument('-j', '--jobs', type=int, default=None)
+    parser.add_argument('-o', '--output-dir', default=None)
+    parser.add_argument('-c', '--cache-dir', default=None)
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--stats-json', default=None)
+    parser.add_argument('--profile', default=None)
+    parser.add_argument('--timeline', default=None)
+    parser.add_argument('--serve', default=None)
+    parser.add_argument('--connect', default=None)
+    parser.add_argument('filenames', nargs='*')
+    args = parser.parse_args(argv)
 
-from f2mc8dasm.disasm import disassemble_inst
-from f2mc8dasm.trace import Tracer
-from f2mc8dasm.memory import Memory
-from f2mc8dasm.listing import Printer
-from f2mc8dasm.symbols import MB89620R_SYMBOLS, SymbolTable
+    if args.serve is not None:
+        serve(args.serve, args.cache_dir)
+        return
+    if args.connect is not None:
+        if len(args.filenames) != 1:
+            parser.error("--connect takes one filename")
+        sys.exit(request_listing(args.connect, args.filenames[0]))
 
-def main():
-    if len(sys.argv) != 2:
+    if not args.filenames:
         sys.stderr.write(__doc__)
         sys.exit(1)
 
-    with open(sys.argv[1], 'rb') as f:
-        rom = bytearray(f.read())
-    start_address = 0x10000 - len(rom)
-
-    memory = Memory(rom)
-    memory.set_reserved_byte(0xfffc)
-    memory.set_mode_byte(0xfffd)
-
-    entry_points = [0xedba]
-    vectors = [
-        # callv
-        0xffc0, 0xffc2, 0xffc4, 0xffc6, 0xffc8, 0xffca, 0xffcc, 0xffce,
-        # irq
-        0xffd0, 0xffd2, 0xffd4, 0xffd6, 0xffd8, 0xffda, 0xffdc, 0xffde,
-        0xffe0, 0xffe2, 0xffe4, 0xffe6, 0xffe8, 0xffea, 0xffec, 0xffee,
-        0xfff0, 0xfff2, 0xfff4, 0xfff6, 0xfff8, 0xfffa,
-        # reset
-        0xfffe,
-    ]
-
-    traceable_range = range(start_address, start_address + len(rom) + 1)
-    tracer = Tracer(memory, entry_points, vectors, traceable_range)
-    tracer.trace(disassemble_inst)
-
-    symbol_table = SymbolTable(MB89620R_SYMBOLS)
-    symbol_table.generate(memory, start_address) # xxx should pass traceable_range
-
-    printer = Printer(memory,
-                      start_address,
-                      symbol_table,
-                      )
-    printer.print_listing()
+    batch = ((len(args.filenames) > 1) or
+             (args.output_dir is not None) or
+             os.path.isdir(args.filenames[0]) or
+             _is_pattern(args.filenames[0]))
+    want_stats = (args.stats or (args.stats_json is not None) or
+                  (args.profile is not None) or (args.timeline is not None))
+    if not batch:
+        stats = None
+        if args.timeline is not None:
+            stats = Timeline(trace_memory=(args.stats or
+                                           (args.stats_json is not None)),
+                             profile_dir=args.profile)
+        elif want_stats:
+            stats = Stats(profile_dir=args.profile)
+        print_listing(args.filenames[0], args.cache_dir, stats)
+        if args.stats:
+            stats.write_report(sys.stderr)
+        if args.stats_json is not None:
+            with open(args.stats_json, 'w') as f:
+                stats.write_json(f)
+        if args.timeline is not None:
+            with open(args.timeline, 'w') as f:
+                stats.write_trace(f)
+        return
+    if want_stats:
+        parser.error("--stats, --stats-json, --profile, and --timeline "
+                     "take one filename")
+
+    inputs = _expand_filenames(args.filenames)
+    if args.output_dir is not None:
+        os.makedirs(args.output_dir, exist_ok=True)
+    jobs = [ (filename, _output_filename(filename, args.output_dir),
+              args.cache_dir) for filename in inputs ]
+    failures = run_batch(jobs, args.jobs)
+    if failures:
+        sys.exit(1)
+
+def print_listing(filename, cache_dir=None, stats=None):
+    '''Write the listing of a rom image file to stdout.  If a Stats is
+    given, the phases are recorded in it.'''
+    if cache_dir is not None:
+        if stats is None:
+            sys.stdout.write(_cached_listing(filename, cache_dir))
+        else:
+            with stats.phase('cache'):
+                sys.stdout.write(_cached_listing(filename, cache_dir))
+        return
+
+    analysis = analyze_file(filename, _options(), stats)
+    if stats is None:
+        analysis.print_listing()
+    else:
+        with stats.phase('listing'):
+            analysis.print_listing()
+
+def serve(path, cache_dir=None):
+    '''Answer requests from a Unix domain socket, or stdin and stdout if
+    the path is "-"'''
+    cache = None
+    if cache_dir is not None:
+        cache = Cache(cache_dir)
+    if path == '-':
+        serve_stream(sys.stdin, sys.stdout, cache)
+    else:
+        try:
+            serve_unix(path, cache)
+        except FileExistsError as exc:
+            sys.stderr.write("%s\n" % exc)
+            sys.exit(1)
+        except KeyboardInterrupt:
+            pass
+
+def run_batch(jobs, processes=None, stream=None):
+    '''Disassemble each (input filename, output filename, cache directory
+    or None) of jobs with a pool of worker processes.  A line is reported
+    for each file as it is finished; a file that fails does not stop the
+    others.  Files that would write the same output file are not
+    disassembled and fail.  Return the number of files that failed.'''
+    if stream is None:
+        stream = sys.stderr
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    start = time.perf_counter()
+    failures = 0
+    writers = {} # normalized output filename: number of jobs writing it
+    for _, output_filename, _ in jobs:
+        output = _normalize(output_filename)
+        writers[output] = writers.get(output, 0) + 1
+    runnable = []
+    for job in jobs:
+        if writers[_normalize(job[1])] > 1:
+            failures += 1
+            stream.write("FAIL  %7.3fs  %s: %s is also the output of "
+                         "another file\n" % (0.0, job[0], job[1]))
+        else:
+            runnable.append(job)
+
+    pool = None
+    if processes > 1 and len(runnable) > 1:
+        pool = multiprocessing.Pool(min(processes, len(runnable)))
+        results = pool.imap_unordered(_disassemble_file, runnable)
+    else:
+        results = map(_disassemble_file, runnable)
+
+    try:
+        for filename, output_filename, elapsed, error in results:
+            if error is None:
+                stream.write("ok    %7.3fs  %s -> %s\n" % (
+                    elapsed, filename, output_filename))
+            else:
+                failures += 1
+                stream.write("FAIL  %7.3fs  %s: %s\n" % (
+                    elapsed, filename, error))
+            stream.flush()
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    stream.write("%d files, %d failed in %.3fs\n" % (
+        len(jobs), failures, time.perf_counter() - start))
+    return failures
+
+def _disassemble_file(job):
+    filename, output_filename, cache_dir = job
+    start = time.perf_counter()
+    try:
+        if cache_dir is None:
+            analysis = analyze_file(filename, _options())
+            with open(output_filename, 'w') as f:
+                analysis.print_listing(f)
+        else:
+            listing = _cached_listing(filename, cache_dir)
+            with open(output_filename, 'w') as f:
+                f.write(listing)
+        error = None
+    except Exception as exc:
+        error = "%s: %s" % (exc.__class__.__name__, exc)
+    return filename, output_filename, time.perf_counter() - start, error
+
+def _cached_listing(filename, cache_dir):
+    with open(filename, 'rb') as f:
+        rom = f.read()
+    cache = _caches.get(cache_dir)
+    if cache is None:
+        # one per process, so its directory is not walked for every file
+        cache = _caches[cache_dir] = Cache(cache_dir)
+    return cache.listing(rom, _options())
+
+_caches = {} # directory: Cache
+
+def _options():
+    options = Options(entry_points=[0xedba])
+    if "LOG" in os.environ:
+        options.observer = LoggingObserver()
+    return options
+
+def _expand_filenames(filenames):
+    expanded = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            pattern = os.path.join(filename, '*.bin')
+            expanded.extend(sorted(glob.glob(pattern)))
+        elif _is_pattern(filename): # not expanded by the shell
+            expanded.extend(sorted(glob.glob(filename)))
+        else:
+            expanded.append(filename)
+    return expanded
+
+def _is_pattern(filename):
+    return any(c in filename for c in '*?[')
+
+def _normalize(filename):
+    return os.path.normcase(os.path.abspath(filename))
+
+def _output_filename(filename, output_dir):
+    root, ext = os.path.splitext(filename)
+    if output_dir is not None:
+        root = os.path.join(output_dir, os.path.basename(root))
+    return root + '.asm'
 
 
 if __name__ == '__main__':
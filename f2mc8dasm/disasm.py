@@ -1,7 +1,8 @@
+import operator
+import re
 from f2mc8dasm.tables import (
     AddressModes,
     Opcodes,
-    InstructionLengths,
     )
 
 
@@ -36,26 +37,42 @@ class Instruction(object):
         return 1 + len(self.operands)
 
     def __str__(self):
-        disasm = self.disasm_template
-        for attr, tpl, fmt in self._disasm_formats:
-            v = getattr(self, attr)
-            if v is not None:
-                disasm = disasm.replace(tpl, fmt % v)
-        return disasm
-
-    _disasm_formats = (
-        ('opcode',          'OPC', '0x%02x'),
-        ('bittest_address', 'DIR', '0x%02x'),
-        ('address',         'DIR', '0x%02x'),
-        ('address',         'EXT', '0x%04x'),
-        ('address',         'REL', '0x%04x'),
-        ('immediate',       'IMB', '0x%02x'),
-        ('immediate',       'IMW', '0x%04x'),
-        ('ixd_offset',      'IXD', '0x%02x'),
-        ('bit',             'BIT', '%d'),
-        ('callv',           'VEC', '%d'),
-        ('register',        'REG', '%d'),
-        )
+        compiled = _str_formats.get(self.disasm_template)
+        if compiled is None:
+            compiled = _compile_str_format(self.disasm_template)
+        fmt, operands, placeholders = compiled
+        try:
+            return fmt % operands(self)
+        except TypeError:
+            # an operand is None; its placeholder is left in the text
+            values = []
+            for placeholder in placeholders:
+                attr, conversion = self._disasm_formats[placeholder]
+                value = getattr(self, attr)
+                values.append(placeholder if value is None
+                              else conversion % value)
+            return compile_template(self.disasm_template, {})[0] % tuple(values)
+
+    _disasm_formats = { # placeholder: (attribute, conversion)
+        'OPC': ('opcode',         '0x%02x'),
+        'DIR': ('direct_address', '0x%02x'),
+        'EXT': ('address',        '0x%04x'),
+        'REL': ('address',        '0x%04x'),
+        'IMB': ('immediate',      '0x%02x'),
+        'IMW': ('immediate',      '0x%04x'),
+        'IXD': ('ixd_offset',     '0x%02x'),
+        'BIT': ('bit',            '%d'),
+        'VEC': ('callv',          '%d'),
+        'REG': ('register',       '%d'),
+        }
+
+    @property
+    def direct_address(self):
+        '''The address that replaces DIR: the bit test address for bbc and
+        bbs, otherwise the direct address'''
+        if self.bittest_address is not None:
+            return self.bittest_address
+        return self.address
 
     @property
     def all_bytes(self):
@@ -85,73 +102,166 @@ class Instruction(object):
                 (self.opcode not in (0x21, 0x31)))
 
 
+PLACEHOLDER_PATTERN = re.compile('OPC|DIR|EXT|REL|IMB|IMW|IXD|BIT|VEC|REG')
+
+def compile_template(template, conversions):
+    '''Compile a disassembly template like "cmp @ix+IXD, #IMB" into a
+    format string for the % operator and a tuple of the placeholders in
+    it, in order.  conversions maps a placeholder to the conversion that
+    formats its value, like "0x%02x"; other placeholders become "%s".'''
+    placeholders = []
+    def substitute(match):
+        placeholders.append(match.group(0))
+        return conversions.get(match.group(0), '%s')
+    fmt = PLACEHOLDER_PATTERN.sub(substitute, template.replace('%', '%%'))
+    return fmt, tuple(placeholders)
+
+def operands_getter(attrs):
+    '''Return a function that gets the named attributes of an instruction
+    as a value for the % operator: a tuple, or the value itself if there
+    is only one'''
+    if not attrs:
+        return lambda inst: ()
+    return operator.attrgetter(*attrs)
+
+def _compile_str_format(template):
+    fmt, placeholders = compile_template(template, dict(
+        (placeholder, conversion) for placeholder, (attr, conversion)
+        in Instruction._disasm_formats.items()))
+    attrs = [ Instruction._disasm_formats[p][0] for p in placeholders ]
+    compiled = (fmt, operands_getter(attrs), placeholders)
+    _str_formats[template] = compiled
+    return compiled
+
+_str_formats = {} # template: (format, operands getter, placeholders)
+
+
 def disassemble_inst(memory, pc):
-    opcode = Opcodes[memory[pc]]
-    pc = (pc + 1) & 0xFFFF
-
-    instlen = InstructionLengths[opcode.addr_mode]
-    operands = bytearray()
-    for i in range(instlen - 1):
-        operands.append(memory[pc])
-        pc = (pc + 1) & 0xFFFF
-
-    inst = Instruction(
-        disasm_template=opcode.disasm_template,
-        addr_mode=opcode.addr_mode,
-        flow_type=opcode.flow_type,
-        affected_flags=opcode.affected_flags,
-        opcode=opcode.number,
-        operands=operands,
-        )
-
-    if inst.addr_mode == AddressModes.Illegal:
-        pass
-    elif inst.addr_mode == AddressModes.Inherent:
-        pass
-    elif inst.addr_mode == AddressModes.ImmediateByte:
-        inst.immediate = operands[0]
-    elif inst.addr_mode == AddressModes.ImmediateWord:
-        inst.immediate = (operands[0] << 8) + operands[1]
-    elif inst.addr_mode == AddressModes.Extended:
-        high_byte, low_byte = operands
-        word = (high_byte << 8) + low_byte
-        inst.address = word
-    elif inst.addr_mode == AddressModes.Direct:
-        inst.address = operands[0]
-    elif inst.addr_mode == AddressModes.DirectWithImmediateByte:
-        inst.address = operands[0]
-        inst.immediate = operands[1]
-    elif inst.addr_mode == AddressModes.Register:
-        inst.register = opcode.number & 0b111
-    elif inst.addr_mode == AddressModes.RegisterWithImmediateByte:
-        inst.register = opcode.number & 0b111
-        inst.immediate = operands[0]
-    elif inst.addr_mode == AddressModes.Pointer:
-        pass
-    elif inst.addr_mode == AddressModes.PointerWithImmediateByte:
-        inst.immediate = operands[0]
-    elif inst.addr_mode == AddressModes.Index:
-        inst.ixd_offset = operands[0]
-    elif inst.addr_mode == AddressModes.IndexWithImmediateByte:
-        inst.ixd_offset = operands[0]
-        inst.immediate = operands[1]
-    elif inst.addr_mode == AddressModes.Vector:
-        inst.callv = opcode.number & 0b111
-        inst.address = _resolve_callv(inst.callv, memory)
-    elif inst.addr_mode == AddressModes.BitDirect:
-        inst.bit = opcode.number & 0b111
-        inst.address = operands[0]
-    elif inst.addr_mode == AddressModes.Relative:
-        inst.address = _resolve_rel(pc, operands[0])
-    elif inst.addr_mode == AddressModes.BitDirectWithRelative:
-        inst.bit = opcode.number & 0b111
-        inst.bittest_address = operands[0]
-        inst.address = _resolve_rel(pc, operands[1])
+    return _Decoders[memory[pc]](memory, pc)
+
+
+def _make_decoder(opcode):
+    '''Build a function that decodes an instruction with the given opcode.
+    The addressing mode is resolved once here instead of on every decode.'''
+    fields = (opcode.disasm_template, opcode.addr_mode, opcode.flow_type,
+              opcode.affected_flags, opcode.number)
+    low_bits = opcode.number & 0b111
+    mode = opcode.addr_mode
+
+    if mode in (AddressModes.Illegal,
+                AddressModes.Inherent,
+                AddressModes.Pointer):
+        def decode(memory, pc):
+            return _new_instruction(fields, bytearray(),
+                None, None, None, None, None, None, None)
+
+    elif mode in (AddressModes.ImmediateByte,
+                  AddressModes.PointerWithImmediateByte):
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1,)),
+                None, None, b1, None, None, None, None)
+
+    elif mode == AddressModes.ImmediateWord:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            b2 = memory[(pc + 2) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1, b2)),
+                None, None, (b1 << 8) + b2, None, None, None, None)
+
+    elif mode == AddressModes.Extended:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            b2 = memory[(pc + 2) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1, b2)),
+                (b1 << 8) + b2, None, None, None, None, None, None)
+
+    elif mode == AddressModes.Direct:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1,)),
+                b1, None, None, None, None, None, None)
+
+    elif mode == AddressModes.DirectWithImmediateByte:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            b2 = memory[(pc + 2) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1, b2)),
+                b1, None, b2, None, None, None, None)
+
+    elif mode == AddressModes.Register:
+        def decode(memory, pc):
+            return _new_instruction(fields, bytearray(),
+                None, None, None, None, None, None, low_bits)
+
+    elif mode == AddressModes.RegisterWithImmediateByte:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1,)),
+                None, None, b1, None, None, None, low_bits)
+
+    elif mode == AddressModes.Index:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1,)),
+                None, None, None, b1, None, None, None)
+
+    elif mode == AddressModes.IndexWithImmediateByte:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            b2 = memory[(pc + 2) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1, b2)),
+                None, None, b2, b1, None, None, None)
+
+    elif mode == AddressModes.Vector:
+        def decode(memory, pc):
+            address = _resolve_callv(low_bits, memory)
+            return _new_instruction(fields, bytearray(),
+                address, None, None, None, None, low_bits, None)
+
+    elif mode == AddressModes.BitDirect:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            return _new_instruction(fields, bytearray((b1,)),
+                b1, None, None, None, low_bits, None, None)
+
+    elif mode == AddressModes.Relative:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            address = _resolve_rel(pc + 2, b1)
+            return _new_instruction(fields, bytearray((b1,)),
+                address, None, None, None, None, None, None)
+
+    elif mode == AddressModes.BitDirectWithRelative:
+        def decode(memory, pc):
+            b1 = memory[(pc + 1) & 0xFFFF]
+            b2 = memory[(pc + 2) & 0xFFFF]
+            address = _resolve_rel(pc + 3, b2)
+            return _new_instruction(fields, bytearray((b1, b2)),
+                address, b1, None, None, low_bits, None, None)
+
     else:
-        msg = "Unhandled addressing mode %r at 0x%04x" % (
-            inst.addr_mode, pc)
+        msg = "Unhandled addressing mode %r for opcode 0x%02x" % (
+            mode, opcode.number)
         raise NotImplementedError(msg) # always a bug
 
+    return decode
+
+
+def _new_instruction(fields, operands, address, bittest_address, immediate,
+                     ixd_offset, bit, callv, register):
+    # bypasses Instruction.__init__ and its keyword argument checking
+    inst = object.__new__(Instruction)
+    (inst.disasm_template, inst.addr_mode, inst.flow_type,
+        inst.affected_flags, inst.opcode) = fields
+    inst.operands = operands
+    inst.address = address
+    inst.bittest_address = bittest_address
+    inst.immediate = immediate
+    inst.ixd_offset = ixd_offset
+    inst.bit = bit
+    inst.callv = callv
+    inst.register = register
     return inst
 
 
@@ -169,3 +279,10 @@ def _resolve_callv(callv, memory):
         return high + low
     except IndexError:
         return None
+
+
+_Decoders = tuple([ _make_decoder(opcode) for opcode in Opcodes ])
+
+for _opcode in Opcodes:
+    _compile_str_format(_opcode.disasm_template)
+del _opcode
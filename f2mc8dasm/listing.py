@@ -1,4 +1,15 @@
+import io
+import itertools
+import operator
 import struct
+import sys
+from f2mc8dasm.disasm import (
+    Instruction,
+    PLACEHOLDER_PATTERN,
+    compile_template,
+    operands_getter,
+    )
+from f2mc8dasm.memory import LocationTypes
 from f2mc8dasm.tables import AddressModes
 
 class Printer(object):
@@ -7,44 +18,149 @@ class Printer(object):
         self.start_address = start_address
         self.symbol_table = symbol_table
         self.last_line_type = None
+        self._instruction_formats = {} # template: (format, operands getter)
 
-    def print_listing(self):
-        self.print_header()
-        self.print_symbols()
+    def print_listing(self, stream=None, processes=1):
+        '''Write the listing to a text stream, sys.stdout by default.  Lines
+        are joined and written in large chunks instead of one at a time.
+        If processes is more than 1, the lines are rendered by a pool of
+        that many worker processes.'''
+        if stream is None:
+            stream = sys.stdout
+        if processes > 1:
+            lines = self.iter_lines_parallel(processes)
+        else:
+            lines = self.iter_lines()
+        while True:
+            chunk = list(itertools.islice(lines, 4096))
+            if not chunk:
+                break
+            chunk.append('')
+            stream.write('\n'.join(chunk))
+
+    def iter_lines(self):
+        '''Generate the lines of the listing without line endings'''
+        self.last_line_type = None
+        for line in self.header_lines():
+            yield line
+        for line in self.symbol_lines():
+            yield line
+        for line in self.iter_body_lines(self.start_address, len(self.memory)):
+            yield line
+
+    def iter_lines_parallel(self, processes, chunks_per_process=4):
+        '''Generate the same lines as iter_lines() but render the body in
+        chunks with a pool of worker processes.  Forked workers inherit
+        this printer; otherwise the memory and symbol table are sent to
+        each worker once as a snapshot.'''
+        import multiprocessing # only needed when rendering in parallel
+        self.last_line_type = None
+        for line in self.header_lines():
+            yield line
+        for line in self.symbol_lines():
+            yield line
+
+        chunks = self.split_body(processes * chunks_per_process)
+        if multiprocessing.get_start_method() == 'fork':
+            # arguments of forked workers are inherited, not pickled
+            initargs = (self, None)
+        else:
+            from f2mc8dasm import snapshot
+            f = io.BytesIO()
+            snapshot.save(f, self.memory, self.symbol_table)
+            initargs = (None, (f.getvalue(), self.start_address))
+        pool = multiprocessing.Pool(processes, _init_worker, initargs)
+        try:
+            for lines in pool.imap(_render_chunk, chunks):
+                for line in lines:
+                    yield line
+            pool.close()
+        finally:
+            pool.terminate()
+
+    def split_body(self, count):
+        '''Split the addresses from the start address to the end into about
+        count chunks that can be rendered separately by iter_body_lines().
+        A chunk starts only where an instruction, a vector, or a region of
+        one location type starts, so none of them is split.  Return a list
+        of (start, end, line type) where the line type is the
+        last_line_type to render the chunk with.'''
+        end = len(self.memory)
+        step = max(1, (end - self.start_address) // max(1, count))
+        chunks = []
+        chunk_start = self.start_address
+        chunk_type = None
+        while chunk_start < end:
+            chunk_end = self._line_boundary(min(chunk_start + step, end))
+            chunks.append((chunk_start, chunk_end, chunk_type))
+            if chunk_end < end:
+                loc_type = self.memory.types[chunk_end - 1]
+                chunk_type = _START_TYPES.get(loc_type, loc_type)
+            chunk_start = chunk_end
+        return chunks
+
+    def _line_boundary(self, address):
+        # the first address from the given one that starts an instruction,
+        # a vector, or a region.  the address is after the start address.
+        memory = self.memory
+        types = memory.types
+        end = len(memory)
+        while (address < end) and (types[address] in _START_TYPES):
+            address += 1
+        if ((address < end) and (types[address] == LocationTypes.Data) and
+                (types[address - 1] == LocationTypes.Data)):
+            address = next(memory.iter_regions(address, end))[1]
+        return address
 
-        address = self.start_address
-        while address < len(self.memory):
-            self.print_blank(address)
-            self.print_label(address)
+    def iter_body_lines(self, address, end):
+        '''Generate the lines for the locations from the address up to the
+        end address.  last_line_type must be what it would be after the
+        lines before the address.'''
+        while address < end:
+            if self.memory.is_data(address):
+                # data only needs a blank line before the start of its run
+                start, run_end, loc_type = next(
+                    self.memory.iter_regions(address, end))
+                for line in self.blank_lines(address):
+                    yield line
+                for address in range(start, run_end):
+                    for line in self.label_lines(address):
+                        yield line
+                    yield self.format_data_line(address)
+                address = run_end
+                continue
+
+            for line in self.blank_lines(address):
+                yield line
+            for line in self.label_lines(address):
+                yield line
 
             if self.memory.is_instruction_start(address):
                 inst = self.memory.get_instruction(address)
-                self.print_instruction_line(address, inst)
+                yield self.format_instruction_line(address, inst)
                 address += len(inst)
             else:
                 if self.memory.is_vector_start(address):
-                    self.print_vector_line(address)
+                    yield self.format_vector_line(address)
                     address += 2
                 elif self.memory.is_mode_byte(address):
-                    self.print_mode_byte_line(address)
+                    yield self.format_mode_byte_line(address)
                     address += 1
                 elif self.memory.is_reserved_byte(address):
-                    self.print_reserved_byte_line(address)
-                    address += 1
-                elif self.memory.is_data(address):
-                    self.print_data_line(address)
+                    yield self.format_reserved_byte_line(address)
                     address += 1
                 else:
                     msg = "Unhandled location type %r at 0x%04x" % (
                         self.memory.types[address], address)
                     raise NotImplementedError(msg) # always a bug
 
-    def print_header(self):
-        print('    .F2MC8L')
-        print('    .area CODE1 (ABS)')
-        print('    .org 0x%04x\n' % self.start_address)
+    def header_lines(self):
+        return ['    .F2MC8L',
+                '    .area CODE1 (ABS)',
+                '    .org 0x%04x' % self.start_address,
+                '']
 
-    def print_symbols(self):
+    def symbol_lines(self):
         used_symbols = set()
         for address, inst in self.memory.iter_instructions():
             if inst.address in self.symbol_table.symbols:
@@ -59,31 +175,36 @@ class Printer(object):
             if target in self.symbol_table.symbols:
                 used_symbols.add(target)
 
+        lines = []
         for address in sorted(used_symbols):
             if address < self.start_address:
                 name, comment = self.symbol_table.symbols[address]
                 line = ("    %s = 0x%02x" % (name, address)).ljust(28)
                 if comment:
                     line += ";%s" % comment
-                print(line)
-        print('')
+                lines.append(line)
+        lines.append('')
+        return lines
 
-    def print_blank(self, address):
+    def blank_lines(self, address):
         typ = self.memory.types[address]
+        lines = []
         if self.last_line_type is not None:
             if typ != self.last_line_type:
                 if address not in self.symbol_table.symbols:
-                    print('')
+                    lines.append('')
         self.last_line_type = typ
+        return lines
 
-    def print_label(self, address):
+    def label_lines(self, address):
         if address in self.symbol_table.symbols:
-            print("\n%s:" % self.format_ext_address(address))
+            return ['', "%s:" % self.format_ext_address(address)]
+        return []
 
-    def print_data_line(self, address):
+    def format_data_line(self, address):
         line = ('    .byte 0x%02x' % self.memory[address]).ljust(28)
         line += ';%04x  %02x          DATA %s ' % (address, self.memory[address], self._data_byte_repr(self.memory[address]))
-        print(line)
+        return line
 
     def _data_byte_repr(self, b):
         if (b >= 0x20) and (b <= 0x7e):  # printable 7-bit ascii
@@ -91,7 +212,7 @@ class Printer(object):
         else:
             return "0x%02x" % b
 
-    def print_vector_line(self, address):
+    def format_vector_line(self, address):
         target = struct.unpack('>H', self.memory[address:address+2])[0]
         target = self.format_ext_address(target)
         line = ('    .word %s' % target).ljust(28)
@@ -99,28 +220,19 @@ class Printer(object):
         name, comment = self.symbol_table.symbols.get(address, ('',''))
         if comment:
             line += ' ' + comment
-        print(line)
+        return line
 
-    def print_mode_byte_line(self, address):
+    def format_mode_byte_line(self, address):
         line = ('    .byte 0x%02X' % self.memory[address]).ljust(28)
         line += ';%04x  %02x          MODE' % (address, self.memory[address])
-        print(line)
+        return line
 
-    def print_reserved_byte_line(self, address):
+    def format_reserved_byte_line(self, address):
         line = ('    .byte 0x%02X' % self.memory[address]).ljust(28)
         line += ';%04x  %02x          RESERVED' % (address, self.memory[address])
-        print(line)
-
-    def print_instruction_line(self, address, inst):
-        if inst.stores_immediate_word_in_pointer:
-            if inst.immediate in self.symbol_table.symbols:
-                name, comment = self.symbol_table.symbols[inst.immediate]
-                inst.disasm_template = inst.disasm_template.replace("IMW", name)
-        if inst.stores_immediate_word_in_a:
-            if inst.immediate in self.symbol_table.symbols and (inst.immediate >= self.start_address):
-                name, comment = self.symbol_table.symbols[inst.immediate]
-                inst.disasm_template = inst.disasm_template.replace("IMW", name)
+        return line
 
+    def format_instruction_line(self, address, inst):
         disasm = self.format_instruction(inst)
         hexdump = (' '.join([ '%02x' % h for h in inst.all_bytes ])).ljust(8)
 
@@ -157,9 +269,124 @@ class Printer(object):
         if inst.addr_mode == AddressModes.Vector:
             dest = self.format_ext_address(inst.address)
             line = line.ljust(47) + "CALLV #%d = %s" % (inst.callv, dest)
-        print(line)
+        return line
+
+    # print_* write the lines of the methods above to sys.stdout
+
+    def print_header(self):
+        _print_lines(self.header_lines())
+
+    def print_symbols(self):
+        _print_lines(self.symbol_lines())
+
+    def print_blank(self, address):
+        _print_lines(self.blank_lines(address))
+
+    def print_label(self, address):
+        _print_lines(self.label_lines(address))
+
+    def print_data_line(self, address):
+        print(self.format_data_line(address))
+
+    def print_vector_line(self, address):
+        print(self.format_vector_line(address))
+
+    def print_mode_byte_line(self, address):
+        print(self.format_mode_byte_line(address))
+
+    def print_reserved_byte_line(self, address):
+        print(self.format_reserved_byte_line(address))
+
+    def print_instruction_line(self, address, inst):
+        print(self.format_instruction_line(address, inst))
 
     def format_instruction(self, inst):
+        '''Format the disassembly of an instruction with symbols substituted
+        for its operands.  The instruction is not changed, so the same
+        instructions can be formatted again with another symbol table.'''
+        compiled = self._instruction_formats.get(inst.disasm_template)
+        if compiled is None:
+            compiled = self._compile_instruction_format(inst.disasm_template)
+        fmt, operands = compiled
+        try:
+            return fmt % operands(inst)
+        except TypeError:
+            # an operand is None; its placeholder is left in the text
+            return self._format_instruction_by_replacing(inst)
+
+    def _compile_instruction_format(self, template):
+        '''Compile a template into a format string and a function that
+        gets the operands of an instruction for it.  Only the operands
+        that the template contains are formatted or looked up.'''
+        conversions = dict(
+            (placeholder, conversion) for placeholder, (attr, conversion)
+            in Instruction._disasm_formats.items()
+            if placeholder not in self._symbol_operands)
+        fmt, placeholders = compile_template(template, conversions)
+        if not any(p in self._symbol_operands for p in placeholders):
+            operands = operands_getter(
+                [ Instruction._disasm_formats[p][0] for p in placeholders ])
+        else:
+            getters = []
+            for placeholder in placeholders:
+                if placeholder in self._symbol_operands:
+                    method = self._symbol_operands[placeholder]
+                    getters.append(getattr(self, method))
+                else:
+                    attr = Instruction._disasm_formats[placeholder][0]
+                    getters.append(operator.attrgetter(attr))
+            if len(getters) == 1:
+                operands = getters[0]
+            else:
+                operands = lambda inst: tuple([ get(inst) for get in getters ])
+        compiled = (fmt, operands)
+        self._instruction_formats[template] = compiled
+        return compiled
+
+    def _ext_operand(self, inst):
+        symbol = self.symbol_table.symbols.get(inst.address)
+        if symbol is None:
+            return '0x%04x' % inst.address
+        return symbol[0]
+
+    def _dir_operand(self, inst):
+        if inst.bittest_address is not None:
+            symbol = self.symbol_table.symbols.get(inst.bittest_address)
+            if symbol is None:
+                return '0x%04x' % inst.bittest_address
+        else:
+            symbol = self.symbol_table.symbols.get(inst.address)
+            if symbol is None:
+                return '0x%02x' % inst.address
+        return symbol[0]
+
+    def _imw_operand(self, inst):
+        name = self._immediate_word_symbol(inst)
+        if name is None:
+            return '0x%04x' % inst.immediate
+        return name
+
+    def _immediate_word_symbol(self, inst):
+        '''Return the symbol name for the immediate word of an instruction
+        that loads an address, or None to show the value in hex'''
+        if inst.immediate not in self.symbol_table.symbols:
+            return None
+        name, comment = self.symbol_table.symbols[inst.immediate]
+        if inst.stores_immediate_word_in_pointer:
+            return name
+        if inst.stores_immediate_word_in_a:
+            if inst.immediate >= self.start_address:
+                return name
+        return None
+
+    _symbol_operands = { # placeholder: method
+        'EXT': '_ext_operand',
+        'REL': '_ext_operand',
+        'DIR': '_dir_operand',
+        'IMW': '_imw_operand',
+        }
+
+    def _format_instruction_by_replacing(self, inst):
         d = {'OPC': '0x%02x' % inst.opcode}
 
         if inst.immediate is not None:
@@ -180,10 +407,14 @@ class Printer(object):
         if inst.register is not None:
             d['REG'] = '%d' % inst.register
 
-        disasm = inst.disasm_template
-        for k, v in d.items():
-            disasm = disasm.replace(k, v)
-        return disasm
+        name = self._immediate_word_symbol(inst)
+        if name is not None:
+            d['IMW'] = name
+
+        # one pass, so text that was substituted is never substituted again
+        return PLACEHOLDER_PATTERN.sub(
+            lambda match: d.get(match.group(0), match.group(0)),
+            inst.disasm_template)
 
     def format_ext_address(self, address):
         if address in self.symbol_table.symbols:
@@ -196,3 +427,30 @@ class Printer(object):
             name, comment = self.symbol_table.symbols[address]
             return name
         return '0x%02x' % address
+
+
+# continuation location type: type of the location that starts it
+_START_TYPES = {
+    LocationTypes.InstructionContinuation: LocationTypes.InstructionStart,
+    LocationTypes.VectorContinuation: LocationTypes.VectorStart,
+    }
+
+_worker_printer = None # Printer of a worker process
+
+def _init_worker(printer, saved):
+    global _worker_printer
+    if printer is None:
+        from f2mc8dasm import snapshot
+        data, start_address = saved
+        loaded = snapshot.load(io.BytesIO(data))
+        printer = Printer(loaded.memory, start_address, loaded.symbol_table)
+    _worker_printer = printer
+
+def _render_chunk(chunk):
+    start, end, last_line_type = chunk
+    _worker_printer.last_line_type = last_line_type
+    return list(_worker_printer.iter_body_lines(start, end))
+
+def _print_lines(lines):
+    for line in lines:
+        print(line)
@@ -1,23 +1,39 @@
+import bisect
+import os
+import re
 
 class Memory(object):
     def __init__(self, rom):
-        self.contents = bytearray(0x10000 - len(rom)) + bytearray(rom)
-        self.instructions = {}
-        self.types = {}
-        self.annotations = {}
-
-        for address in range(len(self.contents)):
-            self.instructions[address] = None
-            self.types[address] = LocationTypes.Unknown
-            self.annotations[address] = set()
+        if len(rom) > 0x10000:
+            raise ValueError("ROM image is larger than 64K")
+        contents = bytearray(0x10000) # rom at the top, padded with zeros
+        contents[0x10000 - len(rom):] = rom
+        self._initialize(contents, 0x10000 - len(rom))
+
+    @classmethod
+    def from_file(cls, filename):
+        '''Create a Memory for a ROM image file.  The image is read once,
+        directly into place at the top of memory.'''
+        memory = cls.__new__(cls)
+        memory._initialize(*_load_rom_file(filename))
+        return memory
+
+    def _initialize(self, contents, start_address):
+        self.contents = contents                # 64K buffer of rom
+        self.start_address = start_address      # where the rom image starts
+        size = len(self.contents)
+        self.instructions = {}                  # address: Instruction
+        self.instruction_starts = []            # sorted instruction addresses
+        self.new_instruction_starts = []        # not yet in the sorted list
+        self.vector_starts = []                 # sorted vector addresses
+        self.types = bytearray(size)            # LocationTypes by address
+        self.annotations = bytearray(size)      # LocationAnnotations bits
+        self.decode_cache = DecodeCache()
 
     def __len__(self):
         return len(self.contents)
 
     def __getitem__(self, address):
-        if isinstance(address, slice):
-            rng = _slice_to_range(address)
-            return bytearray([ self.contents[a] for a in rng ])
         return self.contents[address]
 
     def read_byte(self, address):
@@ -28,6 +44,10 @@ class Memory(object):
         low = self.contents[(address + 1) & 0xFFFF]
         return (high << 8) + low
 
+    def write_byte(self, address, value):
+        self.contents[address] = value
+        self.decode_cache.invalidate(address)
+
     # Instruction Storage
 
     def set_instruction(self, address, inst):
@@ -41,6 +61,8 @@ class Memory(object):
                 raise Exception(msg % addr)
 
         # store instruction and mark its locations
+        if address not in self.instructions:
+            self.new_instruction_starts.append(address)
         self.instructions[address] = inst
         for i in range(inst_len):
             addr = (address + i) & 0xFFFF
@@ -51,33 +73,93 @@ class Memory(object):
             self.types[addr] = loc_type
 
     def get_instruction(self, address):
-        return self.instructions[address]
-
-    def iter_instructions(self, address=0):
-        for a in range(address, len(self.contents)):
-            if self.types[a] == LocationTypes.InstructionStart:
-                yield a, self.instructions[a]
+        return self.instructions.get(address)
+
+    def iter_instructions(self, address=0, end=None):
+        '''Yield (address, Instruction) for each instruction that starts
+        at or after the address and before the end address, in order'''
+        starts = self._sorted_instruction_starts()
+        lo, hi = _bisect_range(starts, address, end)
+        types, instructions = self.types, self.instructions
+        for a in starts[lo:hi]:
+            if types[a] == LocationTypes.InstructionStart:
+                yield a, instructions[a]
+
+    def next_instruction_start(self, address):
+        '''Return the address of the first instruction that starts after
+        the address, or None if there is none'''
+        starts = self._sorted_instruction_starts()
+        for i in range(bisect.bisect_right(starts, address), len(starts)):
+            if self.types[starts[i]] == LocationTypes.InstructionStart:
+                return starts[i]
+        return None
+
+    def previous_instruction_start(self, address):
+        '''Return the address of the last instruction that starts before
+        the address, or None if there is none'''
+        starts = self._sorted_instruction_starts()
+        for i in range(bisect.bisect_left(starts, address) - 1, -1, -1):
+            if self.types[starts[i]] == LocationTypes.InstructionStart:
+                return starts[i]
+        return None
+
+    def _sorted_instruction_starts(self):
+        # merging is a single sort: the new starts are usually few and the
+        # rest of the list is already sorted
+        if self.new_instruction_starts:
+            self.instruction_starts.extend(self.new_instruction_starts)
+            self.instruction_starts.sort()
+            self.new_instruction_starts = []
+        return self.instruction_starts
 
     # Vector Storage
 
     def set_vector(self, address):
         self.types[address] = LocationTypes.VectorStart
         self.types[(address + 1) & 0xFFFF] = LocationTypes.VectorContinuation
+        i = bisect.bisect_left(self.vector_starts, address)
+        if self.vector_starts[i:i+1] != [address]:
+            self.vector_starts.insert(i, address)
 
     def get_vector(self, address):
         high = self.contents[address]
         low = self.contents[(address + 1) & 0xFFFF]
         return (high << 8) + low
 
-    def iter_vectors(self, address=0):
-        for a in range(address, len(self.contents)):
+    def iter_vectors(self, address=0, end=None):
+        '''Yield (address, target) for each vector that starts at or after
+        the address and before the end address, in order'''
+        lo, hi = _bisect_range(self.vector_starts, address, end)
+        for a in self.vector_starts[lo:hi]:
             if self.types[a] == LocationTypes.VectorStart:
                 yield a, self.get_vector(a)
 
+    def reindex(self):
+        '''Rebuild the indexes of instruction and vector starts after types
+        or instructions were assigned directly instead of with set_*()'''
+        self.instruction_starts = sorted(self.instructions)
+        self.new_instruction_starts = []
+        self.vector_starts = []
+        address = self.types.find(LocationTypes.VectorStart)
+        while address != -1:
+            self.vector_starts.append(address)
+            address = self.types.find(LocationTypes.VectorStart, address + 1)
+
     # Data Storage
 
-    def set_data(self, address):
-        self.types[address] = LocationTypes.Data
+    def set_data(self, address, length=1):
+        self._set_types(address, length, LocationTypes.Data)
+
+    def set_unknown(self, address, length=1):
+        self._set_types(address, length, LocationTypes.Unknown)
+
+    def _set_types(self, address, length, loc_type):
+        end = address + length
+        if end <= len(self.types):
+            self.types[address:end] = bytes((loc_type,)) * length
+        else:
+            for i in range(length):
+                self.types[(address + i) & 0xFFFF] = loc_type
 
     # Special Locations
 
@@ -90,6 +172,10 @@ class Memory(object):
     # Location Types
 
     def is_unknown(self, address, length=1):
+        end = address + length
+        if end <= len(self.types):
+            unknowns = self.types.count(LocationTypes.Unknown, address, end)
+            return unknowns == length
         for i in range(length):
             if self.types[(address + i) & 0xFFFF] != LocationTypes.Unknown:
                 return False
@@ -116,6 +202,39 @@ class Memory(object):
     def is_reserved_byte(self, address):
         return self.types[address] == LocationTypes.ReservedByte
 
+    # Location Type Regions
+
+    def iter_regions(self, address=0, end=None, loc_type=None):
+        '''Yield (start, end, type) for each run of consecutive locations
+        with the same type from the address to the end address.  The first
+        run starts at the address even if the locations before it have the
+        same type.  If loc_type is given, only runs of that type are yielded.'''
+        if end is None:
+            end = len(self.types)
+        if loc_type is not None:
+            pattern = _RUN_PATTERNS[loc_type]
+            for match in pattern.finditer(self.types, address, end):
+                yield match.start(), match.end(), loc_type
+            return
+
+        while address < end:
+            loc_type = self.types[address]
+            match = _OTHER_PATTERNS[loc_type].search(self.types, address, end)
+            run_end = end if match is None else match.start()
+            yield address, run_end, loc_type
+            address = run_end
+
+    def region_at(self, address):
+        '''Return (start, end, type) of the run of consecutive locations
+        with the same type that contains the address'''
+        loc_type = self.types[address]
+        before = self.types[address::-1] # reversed, from the address down
+        match = _OTHER_PATTERNS[loc_type].search(before)
+        start = 0 if match is None else address - match.start() + 1
+        match = _OTHER_PATTERNS[loc_type].search(self.types, address)
+        end = len(self.types) if match is None else match.start()
+        return start, end, loc_type
+
     # Location Types (single- or multi-byte inquiry)
 
     def is_single_byte_or_start_of_multibyte(self, address):
@@ -130,40 +249,97 @@ class Memory(object):
     # Location Annotations
 
     def annotate_jump_target(self, address):
-        self.annotations[address].add(LocationAnnotations.JumpTarget)
+        self.annotations[address] |= LocationAnnotations.JumpTarget
 
     def annotate_call_target(self, address):
-        self.annotations[address].add(LocationAnnotations.CallTarget)
+        self.annotations[address] |= LocationAnnotations.CallTarget
 
     def annotate_branch_taken(self, address):
-        self.annotations[address].add(LocationAnnotations.BranchTaken)
+        self.annotations[address] |= LocationAnnotations.BranchTaken
 
     def annotate_branch_not_taken(self, address):
-        self.annotations[address].add(LocationAnnotations.BranchNotTaken)
+        self.annotations[address] |= LocationAnnotations.BranchNotTaken
 
     def annotate_branch_always_taken(self, address):
-        self.annotations[address].add(LocationAnnotations.BranchAlwaysTaken)
+        self.annotations[address] |= LocationAnnotations.BranchAlwaysTaken
 
     def annotate_branch_never_taken(self, address):
-        self.annotations[address].add(LocationAnnotations.BranchNeverTaken)
+        self.annotations[address] |= LocationAnnotations.BranchNeverTaken
+
+    def unannotate_branch_always_taken(self, address):
+        self.annotations[address] &= ~LocationAnnotations.BranchAlwaysTaken
+
+    def unannotate_branch_never_taken(self, address):
+        self.annotations[address] &= ~LocationAnnotations.BranchNeverTaken
 
     def is_jump_target(self, address):
-        return LocationAnnotations.JumpTarget in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.JumpTarget) != 0
 
     def is_call_target(self, address):
-        return LocationAnnotations.CallTarget in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.CallTarget) != 0
 
     def is_branch_taken(self, address):
-        return LocationAnnotations.BranchTaken in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.BranchTaken) != 0
 
     def is_branch_not_taken(self, address):
-        return LocationAnnotations.BranchNotTaken in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.BranchNotTaken) != 0
 
     def is_branch_always_taken(self, address):
-        return LocationAnnotations.BranchAlwaysTaken in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.BranchAlwaysTaken) != 0
 
     def is_branch_never_taken(self, address):
-        return LocationAnnotations.BranchNeverTaken in self.annotations[address]
+        return (self.annotations[address] & LocationAnnotations.BranchNeverTaken) != 0
+
+class DecodeCache(object):
+    '''Decoded instructions by address.  An address is decoded once and
+    later requests for it are answered from the cache until a byte the
+    instruction was decoded from is written with Memory.write_byte().'''
+
+    def __init__(self):
+        self.instructions = {}
+        self.vector_dependents = set() # addresses of cached callv insts
+        self.disassemble_func = None
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def decode(self, memory, address, disassemble_func):
+        if disassemble_func is not self.disassemble_func:
+            self.clear()
+            self.disassemble_func = disassemble_func
+
+        inst = self.instructions.get(address)
+        if inst is not None:
+            self.hits += 1
+            return inst
+
+        self.misses += 1
+        inst = disassemble_func(memory, address)
+        self.instructions[address] = inst
+        if inst.callv is not None:
+            self.vector_dependents.add(address)
+        return inst
+
+    def invalidate(self, address):
+        # an instruction is at most 3 bytes long, so only the instructions
+        # starting at the written byte or the two before it can contain it
+        for i in range(3):
+            addr = (address - i) & 0xFFFF
+            self.instructions.pop(addr, None)
+            self.vector_dependents.discard(addr)
+
+        # callv instructions are decoded using the callv vector table
+        if 0xffc0 <= address <= 0xffcf:
+            for addr in self.vector_dependents:
+                self.instructions.pop(addr, None)
+            self.vector_dependents.clear()
+
+    def clear(self):
+        self.instructions.clear()
+        self.vector_dependents.clear()
+
 
 class LocationTypes(object):
     '''A memory location has exactly one type'''
@@ -178,19 +354,42 @@ class LocationTypes(object):
 
 
 class LocationAnnotations(object):
-    '''A memory location can have zero or more annotations'''
-    JumpTarget = 0
-    CallTarget = 1
-    BranchTaken = 2
-    BranchNotTaken = 3
-    BranchAlwaysTaken = 4
-    BranchNeverTaken = 5
-
-
-def _slice_to_range(slc):
-    start, stop, step = slc.start, slc.stop, slc.step
-    if start is None:
-        start = 0
-    if step is None:
-        step = 1
-    return range(start, stop, step)
+    '''A memory location can have zero or more annotations.  Each is a
+    single bit so a location's annotations can be stored as one byte.'''
+    JumpTarget = 1 << 0
+    CallTarget = 1 << 1
+    BranchTaken = 1 << 2
+    BranchNotTaken = 1 << 3
+    BranchAlwaysTaken = 1 << 4
+    BranchNeverTaken = 1 << 5
+
+
+# runs of one location type, and any location not of that type
+_RUN_PATTERNS = {}
+_OTHER_PATTERNS = {}
+for _loc_type in range(LocationTypes.ReservedByte + 1):
+    _escaped = re.escape(bytes((_loc_type,)))
+    _RUN_PATTERNS[_loc_type] = re.compile(_escaped + b'+')
+    _OTHER_PATTERNS[_loc_type] = re.compile(b'[^' + _escaped + b']')
+del _loc_type, _escaped
+
+def _bisect_range(starts, address, end):
+    lo = bisect.bisect_left(starts, address)
+    if end is None:
+        return lo, len(starts)
+    return lo, bisect.bisect_left(starts, end)
+
+def _load_rom_file(filename):
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > 0x10000:
+            raise ValueError("ROM image is larger than 64K")
+        contents = bytearray(0x10000)
+        start_address = 0x10000 - size
+        view = memoryview(contents)[start_address:]
+        while len(view):
+            count = f.readinto(view)
+            if not count:
+                raise ValueError("ROM image changed while it was read")
+            view = view[count:]
+        return contents, start_address
@@ -0,0 +1,144 @@
+import json
+import sys
+
+class TraceObserver(object):
+    '''Receives events from a Tracer.  Subclasses override the methods for
+    the events they are interested in.  A Tracer without observers does not
+    generate any events.'''
+
+    def state_popped(self, ps):
+        '''A processor state was taken to be traced, either popped from the
+        queue or taken right away by TraceQueue.push_or_take().  The states
+        inside previously traced straight-line code that is re-traced as a
+        block are skipped and do not generate this event.'''
+
+    def instruction_traced(self, inst, ps):
+        '''An instruction was decoded and traced with a processor state.
+        Previously traced straight-line code that is re-traced as a block
+        does not generate this event.'''
+
+    def instruction_marked(self, address, inst):
+        '''A new instruction was marked in memory'''
+
+    def branch_annotated(self, address, taken):
+        '''A conditional branch was found to be taken or not taken'''
+
+    def state_deduplicated(self, ps):
+        '''A processor state was not queued because it was already traced,
+        was already waiting to be traced, or was merged away'''
+
+
+class ObserverGroup(TraceObserver):
+    '''Sends each event to several observers'''
+
+    def __init__(self, observers=()):
+        self.observers = list(observers)
+
+    def add(self, observer):
+        self.observers.append(observer)
+
+    def state_popped(self, ps):
+        for observer in self.observers:
+            observer.state_popped(ps)
+
+    def instruction_traced(self, inst, ps):
+        for observer in self.observers:
+            observer.instruction_traced(inst, ps)
+
+    def instruction_marked(self, address, inst):
+        for observer in self.observers:
+            observer.instruction_marked(address, inst)
+
+    def branch_annotated(self, address, taken):
+        for observer in self.observers:
+            observer.branch_annotated(address, taken)
+
+    def state_deduplicated(self, ps):
+        for observer in self.observers:
+            observer.state_deduplicated(ps)
+
+
+class CountingObserver(TraceObserver):
+    '''Counts the events of each type'''
+
+    def __init__(self):
+        self.states_popped = 0
+        self.instructions_traced = 0
+        self.instructions_marked = 0
+        self.branches_annotated = 0
+        self.states_deduplicated = 0
+
+    def state_popped(self, ps):
+        self.states_popped += 1
+
+    def instruction_traced(self, inst, ps):
+        self.instructions_traced += 1
+
+    def instruction_marked(self, address, inst):
+        self.instructions_marked += 1
+
+    def branch_annotated(self, address, taken):
+        self.branches_annotated += 1
+
+    def state_deduplicated(self, ps):
+        self.states_deduplicated += 1
+
+    def as_dict(self):
+        return {
+            'states_popped': self.states_popped,
+            'instructions_traced': self.instructions_traced,
+            'instructions_marked': self.instructions_marked,
+            'branches_annotated': self.branches_annotated,
+            'states_deduplicated': self.states_deduplicated,
+            }
+
+
+class JsonLinesObserver(TraceObserver):
+    '''Writes each event to a text stream as a line of JSON'''
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def _write(self, event):
+        self.stream.write(json.dumps(event, sort_keys=True) + '\n')
+
+    def state_popped(self, ps):
+        self._write(_state_event('state_popped', ps))
+
+    def instruction_traced(self, inst, ps):
+        event = _state_event('instruction_traced', ps)
+        event['disasm'] = str(inst)
+        self._write(event)
+
+    def instruction_marked(self, address, inst):
+        self._write({'event': 'instruction_marked',
+                     'address': address,
+                     'length': len(inst),
+                     'disasm': str(inst)})
+
+    def branch_annotated(self, address, taken):
+        self._write({'event': 'branch_annotated',
+                     'address': address,
+                     'taken': taken})
+
+    def state_deduplicated(self, ps):
+        self._write(_state_event('state_deduplicated', ps))
+
+
+class LoggingObserver(TraceObserver):
+    '''Prints each instruction traced along with its processor state'''
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def instruction_traced(self, inst, ps):
+        stream = sys.stdout if self.stream is None else self.stream
+        stream.write("TRACE " + str(ps).ljust(24) + str(inst) + "\n")
+
+
+def _state_event(name, ps):
+    event = {'event': name, 'pc': ps.pc}
+    for flag in ('c', 'n', 'z'):
+        value = getattr(ps, flag)
+        event[flag] = value if value in (0, 1) else None
+    return event
@@ -0,0 +1,38 @@
+'''
+Measure the throughput of disassemble_inst().  Decodes every address of a
+64K image filled with random bytes (fixed seed) and reports decodes/second.
+
+Usage: python bench_decode.py [<passes>]
+'''
+
+import random
+import sys
+import time
+
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.memory import Memory
+
+def main(passes):
+    rng = random.Random(0x8f2)
+    rom = bytearray(rng.randrange(0x100) for _ in range(0x10000))
+    memory = Memory(rom)
+
+    best = None
+    for _ in range(passes):
+        start = time.perf_counter()
+        for address in range(len(memory)):
+            disassemble_inst(memory, address)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    print("Decoded %d addresses in %.3f sec (best of %d)" % (
+        len(memory), best, passes))
+    print("%.0f decodes/sec" % (len(memory) / best))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2:
+        sys.stderr.write("%s\n" % __doc__)
+        sys.exit(1)
+    passes = int(sys.argv[1]) if len(sys.argv) == 2 else 5
+    main(passes)
@@ -0,0 +1,58 @@
+'''
+Measure Printer.print_listing() on a synthetic image that has been traced
+and had symbols generated.  The listing is written to a temporary file,
+rendered by the given number of processes.  Images are generated the
+same way as bench_trace.py.
+
+Usage: python bench_listing.py [<shape> [<size> [<seed> [<processes>]]]]
+'''
+
+import sys
+import tempfile
+import time
+
+from bench_trace import VECTORS, make_rom
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.listing import Printer
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import MB89620R_SYMBOLS, SymbolTable
+from f2mc8dasm.trace import Tracer
+
+def main(shape, size, seed, processes, passes=5):
+    rom = make_rom(shape, size, seed)
+    start_address = 0x10000 - len(rom)
+    memory = Memory(rom)
+    memory.set_reserved_byte(0xfffc)
+    memory.set_mode_byte(0xfffd)
+    tracer = Tracer(memory, [], VECTORS, range(start_address, 0x10000))
+    tracer.trace(disassemble_inst)
+    symbol_table = SymbolTable(MB89620R_SYMBOLS)
+    symbol_table.generate(memory, start_address)
+    printer = Printer(memory, start_address, symbol_table)
+    lines = sum(1 for _ in printer.iter_lines())
+
+    best = None
+    with tempfile.TemporaryFile('w') as f:
+        for _ in range(passes):
+            f.seek(0)
+            start = time.perf_counter()
+            printer.print_listing(f, processes)
+            f.flush()
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+
+    print("%s image of %d bytes, seed %d, %d processes" % (
+        shape, size, seed, processes))
+    print("%d lines in %.3f sec (best of %d)" % (lines, best, passes))
+    print("%.0f lines/sec" % (lines / best))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 5:
+        sys.stderr.write("%s\n" % __doc__)
+        sys.exit(1)
+    shape = sys.argv[1] if len(sys.argv) > 1 else 'random'
+    size = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0x10000
+    seed = int(sys.argv[3], 0) if len(sys.argv) > 3 else 0x8f2
+    processes = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+    main(shape, size, seed, processes)
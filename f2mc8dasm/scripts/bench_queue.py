@@ -0,0 +1,44 @@
+'''
+Measure the scaling of TraceQueue.  Pushes N processor states with random
+program counters and flags (fixed seed), some of them duplicates, then pops
+them all.  Run time should grow roughly linearly with N.
+
+Usage: python bench_queue.py [<n> ...]
+'''
+
+import random
+import sys
+import time
+
+from f2mc8dasm.trace import TraceQueue, ProcessorState, Unknown
+
+def run(n):
+    rng = random.Random(0x8f2)
+    flags = (0, 1, Unknown)
+    states = [ ProcessorState(pc=rng.randrange(0x10000),
+                              c=rng.choice(flags),
+                              n=rng.choice(flags),
+                              z=rng.choice(flags)) for _ in range(n) ]
+
+    queue = TraceQueue()
+    start = time.perf_counter()
+    for ps in states:
+        queue.push(ps)
+    popped = 0
+    while len(queue):
+        queue.pop()
+        popped += 1
+    return time.perf_counter() - start, popped
+
+def main(sizes):
+    for n in sizes:
+        elapsed, popped = run(n)
+        print("%8d pushed %8d popped %8.3f sec %10.0f pushes/sec" % (
+            n, popped, elapsed, n / elapsed))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        sizes = [ int(arg) for arg in sys.argv[1:] ]
+    else:
+        sizes = [10**5, 2 * 10**5, 5 * 10**5, 10**6]
+    main(sizes)
@@ -0,0 +1,57 @@
+'''
+Compare analyzing a synthetic image from scratch (trace and generate
+symbols) with saving and loading a snapshot of the analysis.  Images are
+generated the same way as bench_trace.py.
+
+Usage: python bench_snapshot.py [<shape> [<size> [<seed>]]]
+'''
+
+import io
+import sys
+import time
+
+from bench_trace import VECTORS, make_rom
+from f2mc8dasm import snapshot
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import MB89620R_SYMBOLS, SymbolTable
+from f2mc8dasm.trace import Tracer
+
+def analyze(rom):
+    start_address = 0x10000 - len(rom)
+    memory = Memory(rom)
+    memory.set_reserved_byte(0xfffc)
+    memory.set_mode_byte(0xfffd)
+    tracer = Tracer(memory, [], VECTORS, range(start_address, 0x10000))
+    tracer.trace(disassemble_inst)
+    symbol_table = SymbolTable(MB89620R_SYMBOLS)
+    symbol_table.generate(memory, start_address)
+    return memory, symbol_table, tracer
+
+def main(shape, size, seed):
+    rom = make_rom(shape, size, seed)
+    print("%s image of %d bytes, seed %d" % (shape, size, seed))
+
+    start = time.perf_counter()
+    memory, symbol_table, tracer = analyze(rom)
+    print("analyze %8.3f sec" % (time.perf_counter() - start))
+
+    f = io.BytesIO()
+    start = time.perf_counter()
+    snapshot.save(f, memory, symbol_table, tracer)
+    print("save    %8.3f sec %8d bytes" % (time.perf_counter() - start,
+                                           len(f.getvalue())))
+
+    f.seek(0)
+    start = time.perf_counter()
+    snapshot.load(f)
+    print("load    %8.3f sec" % (time.perf_counter() - start))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        sys.stderr.write("%s\n" % __doc__)
+        sys.exit(1)
+    shape = sys.argv[1] if len(sys.argv) > 1 else 'random'
+    size = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0x10000
+    seed = int(sys.argv[3], 0) if len(sys.argv) > 3 else 0x8f2
+    main(shape, size, seed)
@@ -0,0 +1,243 @@
+'''
+Measure each phase of disassembly on a fixed set of synthetic images and
+optionally compare the results with a baseline.  Images are generated the
+same way as bench_trace.py, with fixed seeds, in several shapes and sizes.
+
+For each image, the phases are timed separately:
+
+  decode    disassemble_inst() at every address of the image
+  trace     Tracer.trace() from the vectors
+  symbols   SymbolTable.generate()
+  listing   Printer.print_listing() to a temporary file
+
+In each pass, a phase is run again until it has run for at least the
+minimum time (default 0.2 seconds) and its time is the median of those
+runs.  The time reported is the median of the passes.  Throughput is
+reported as bytes/sec of image for each phase, plus instructions/sec and
+states popped/sec for trace, and lines/sec for listing.  Peak memory of
+each phase is measured with tracemalloc in one more pass, so that tracing
+memory does not slow the timed passes.
+
+With -o, the results are written to a JSON file.  With -b, they are
+compared with the results in a JSON file written before, and the exit
+status is 1 if any phase took more time or memory than the baseline by
+more than the threshold (default 0.10, for 10%).
+
+Usage: python bench_suite.py [-q] [-n <passes>] [-m <min time>]
+                             [-o <results.json>] [-b <baseline.json>]
+                             [-t <threshold>]
+'''
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_trace import VECTORS, make_rom
+from f2mc8dasm import __version__
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.listing import Printer
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.stats import Stats
+from f2mc8dasm.symbols import MB89620R_SYMBOLS, SymbolTable
+from f2mc8dasm.trace import Tracer
+
+# (shape, size, seed) of each image
+CASES = (
+    ('random', 0x4000, 0x8f2),
+    ('random', 0xF000, 0x8f2),
+    ('branchy', 0x4000, 0x8f2),
+    ('branchy', 0xF000, 0x8f2),
+    )
+
+QUICK_CASES = (CASES[0], CASES[2])
+
+PHASES = ('decode', 'trace', 'symbols', 'listing')
+
+def case_name(shape, size, seed):
+    return '%s-%dk-%x' % (shape, size // 1024, seed)
+
+def make_tracer(rom):
+    start_address = 0x10000 - len(rom)
+    memory = Memory(rom)
+    memory.set_reserved_byte(0xfffc)
+    memory.set_mode_byte(0xfffd)
+    return Tracer(memory, [], VECTORS, range(start_address, 0x10000))
+
+def time_phase(setup, run, min_time):
+    '''Call run(setup()) until the runs add up to at least min_time seconds
+    and return the median wall time of a run, not counting setup()'''
+    walls = []
+    while sum(walls) < min_time or not walls:
+        arg = setup()
+        start = time.perf_counter()
+        run(arg)
+        walls.append(time.perf_counter() - start)
+    return statistics.median(walls)
+
+def time_phases(rom, min_time):
+    '''Return {phase: wall} for one pass over the phases'''
+    start_address = 0x10000 - len(rom)
+
+    def decode(memory):
+        for address in range(start_address, 0x10000):
+            disassemble_inst(memory, address)
+
+    def trace(tracer):
+        tracer.trace(disassemble_inst)
+
+    def generate(memory):
+        SymbolTable(MB89620R_SYMBOLS).generate(memory, start_address)
+
+    tracer = make_tracer(rom)
+    trace(tracer)
+    memory = tracer.memory
+    symbol_table = SymbolTable(MB89620R_SYMBOLS)
+    symbol_table.generate(memory, start_address)
+    printer = Printer(memory, start_address, symbol_table)
+
+    with tempfile.TemporaryFile('w') as f:
+        def rewind():
+            f.seek(0)
+            f.truncate()
+            return f
+
+        return {
+            'decode': time_phase(lambda: Memory(rom), decode, min_time),
+            'trace': time_phase(lambda: make_tracer(rom), trace, min_time),
+            'symbols': time_phase(lambda: memory, generate, min_time),
+            'listing': time_phase(rewind, printer.print_listing, min_time),
+            }
+
+def run_phases(rom, stats):
+    '''Run each phase on the image once, recording it in the Stats, and
+    return the counts of work done: instructions, states, and lines'''
+    start_address = 0x10000 - len(rom)
+    memory = Memory(rom)
+    with stats.phase('decode'):
+        for address in range(start_address, 0x10000):
+            disassemble_inst(memory, address)
+
+    tracer = make_tracer(rom)
+    memory = tracer.memory
+    stats.watch_tracer(tracer)
+    with stats.phase('trace'):
+        tracer.trace(disassemble_inst)
+    stats.count_tracer(tracer)
+
+    with stats.phase('symbols'):
+        symbol_table = SymbolTable(MB89620R_SYMBOLS)
+        symbol_table.generate(memory, start_address)
+
+    printer = Printer(memory, start_address, symbol_table)
+    with tempfile.TemporaryFile('w') as f:
+        with stats.phase('listing'):
+            printer.print_listing(f)
+    lines = sum(1 for _ in printer.iter_lines())
+
+    return {'instructions': len(memory.instructions),
+            'states': stats.counters['states_popped'],
+            'lines': lines}
+
+def run_case(rom, passes, min_time):
+    '''Return {phase: result} for an image'''
+    walls = dict((name, []) for name in PHASES)
+    for _ in range(passes):
+        for name, wall in time_phases(rom, min_time).items():
+            walls[name].append(wall)
+    stats = Stats()
+    counts = run_phases(rom, stats)
+    peaks = dict((phase['name'], phase['peak_memory'])
+                 for phase in stats.phases)
+
+    results = {}
+    for name in PHASES:
+        wall = statistics.median(walls[name])
+        result = {'wall': wall, 'peak_memory': peaks[name],
+                  'bytes_per_sec': len(rom) / wall}
+        if name == 'trace':
+            result['instructions_per_sec'] = counts['instructions'] / wall
+            result['states_per_sec'] = counts['states'] / wall
+        elif name == 'listing':
+            result['lines_per_sec'] = counts['lines'] / wall
+        results[name] = result
+    return results
+
+def run_suite(cases, passes, min_time, stream):
+    results = {
+        'version': __version__,
+        'python': platform.python_version(),
+        'passes': passes,
+        'min_time': min_time,
+        'cases': {},
+        }
+    stream.write("%-18s %-8s %9s %10s %12s  %s\n" % (
+        'image', 'phase', 'sec', 'peak KiB', 'bytes/sec', 'other'))
+    for shape, size, seed in cases:
+        name = case_name(shape, size, seed)
+        case = run_case(make_rom(shape, size, seed), passes, min_time)
+        results['cases'][name] = case
+        for phase in PHASES:
+            result = case[phase]
+            other = ' '.join(
+                '%.0f %s' % (result[key], key[:-len('_per_sec')] + '/sec')
+                for key in sorted(result)
+                if key.endswith('_per_sec') and key != 'bytes_per_sec')
+            stream.write("%-18s %-8s %9.4f %10d %12.0f  %s\n" % (
+                name, phase, result['wall'], result['peak_memory'] // 1024,
+                result['bytes_per_sec'], other))
+    return results
+
+def compare(results, baseline, threshold, stream):
+    '''Write the change of each phase from the baseline and return the
+    number of regressions larger than the threshold'''
+    regressions = 0
+    for name in sorted(results['cases']):
+        if name not in baseline['cases']:
+            stream.write("%-18s not in baseline\n" % name)
+            continue
+        for phase in PHASES:
+            new = results['cases'][name][phase]
+            old = baseline['cases'][name][phase]
+            changes = [ (new[key] - old[key]) / float(old[key] or 1)
+                        for key in ('wall', 'peak_memory') ]
+            flag = ''
+            if max(changes) > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            stream.write("%-18s %-8s time %+7.1f%%  memory %+7.1f%%%s\n" % (
+                name, phase, changes[0] * 100, changes[1] * 100, flag))
+    return regressions
+
+def main(argv=None):
+    usage = __doc__.strip().split('Usage: ')[1]
+    parser = argparse.ArgumentParser(usage=usage)
+    parser.add_argument('-q', '--quick', action='store_true')
+    parser.add_argument('-n', '--passes', type=int, default=5)
+    parser.add_argument('-m', '--min-time', type=float, default=0.2)
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument('-b', '--baseline', default=None)
+    parser.add_argument('-t', '--threshold', type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    cases = QUICK_CASES if args.quick else CASES
+    results = run_suite(cases, args.passes, args.min_time, sys.stdout)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        sys.stdout.write('\n')
+        regressions = compare(results, baseline, args.threshold, sys.stdout)
+        if regressions:
+            sys.stdout.write("%d regressions over %.0f%%\n" % (
+                regressions, args.threshold * 100))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
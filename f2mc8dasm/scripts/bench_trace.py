@@ -0,0 +1,77 @@
+'''
+Measure Tracer.trace() on a synthetic image and report the number of
+processor states traced and the run time, with and without merging of
+processor states.  Images are generated with a fixed seed:
+
+  random    random bytes with every vector pointing into the image
+  branchy   runs of "bz/bc/bn +1; nop" with random code in between, so
+            the flags reaching each address take many combinations
+
+Usage: python bench_trace.py [<shape> [<size> [<seed>]]]
+'''
+
+import random
+import sys
+import time
+
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.trace import Tracer
+
+VECTORS = list(range(0xffc0, 0xfffc, 2)) + [0xfffe]
+
+BRANCHES = (0xfd, 0xf9, 0xfb) # bz, bc, bn
+
+def make_rom(shape, size, seed):
+    rng = random.Random(seed)
+    rom = bytearray(rng.randrange(0x100) for _ in range(size))
+    if shape == 'branchy':
+        offset = 0
+        while offset < size - 0x100:
+            for opcode in BRANCHES:
+                rom[offset:offset+3] = bytearray((opcode, 0x01, 0x00))
+                offset += 3
+            offset += rng.randrange(4, 24)
+    elif shape != 'random':
+        raise ValueError("Unknown shape %r" % shape)
+    start_address = 0x10000 - size
+    for vector in VECTORS:
+        target = rng.randrange(start_address, 0xffc0)
+        offset = vector - start_address
+        rom[offset:offset+2] = bytearray((target >> 8, target & 0xFF))
+    return rom
+
+def run(rom, merge_states):
+    start_address = 0x10000 - len(rom)
+    memory = Memory(rom)
+    memory.set_reserved_byte(0xfffc)
+    memory.set_mode_byte(0xfffd)
+    traceable_range = range(start_address, 0x10000)
+
+    start = time.perf_counter()
+    tracer = Tracer(memory, [], VECTORS, traceable_range,
+                    merge_states=merge_states)
+    tracer.trace(disassemble_inst)
+    elapsed = time.perf_counter() - start
+
+    states = len(tracer.queue.traced)
+    instructions = len(list(memory.iter_instructions()))
+    return elapsed, states, instructions
+
+def main(shape, size, seed):
+    rom = make_rom(shape, size, seed)
+    print("%s image of %d bytes, seed %d" % (shape, size, seed))
+    for merge_states in (False, True):
+        elapsed, states, instructions = run(rom, merge_states)
+        print("merge_states=%-5s %7d states %6d instructions "
+              "%7.3f sec %9.0f states/sec" % (
+              merge_states, states, instructions, elapsed, states / elapsed))
+
+if __name__ == '__main__':
+    if len(sys.argv) > 4:
+        sys.stderr.write("%s\n" % __doc__)
+        sys.exit(1)
+    shape = sys.argv[1] if len(sys.argv) > 1 else 'random'
+    size = int(sys.argv[2], 0) if len(sys.argv) > 2 else 0xF000
+    seed = int(sys.argv[3], 0) if len(sys.argv) > 3 else 0x8f2
+    main(shape, size, seed)
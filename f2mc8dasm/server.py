@@ -0,0 +1,178 @@
+'''
+A long-running process that answers disassembly requests, so that each
+request does not pay for starting Python and importing the package.
+
+Requests and responses are JSON objects, one per line.  A request has the
+rom as base64 ("rom") or the name of a file the server can read
+("filename"), and optionally an "id" that is copied to the response,
+"options" for Options (entry_points, vectors, reserved_bytes, mode_bytes,
+merge_states), and the "result" wanted:
+
+    "listing"    the listing as "listing" (default)
+    "analysis"   "start_address", "symbols" as [address, name, comment],
+                 "regions" as [start, end, type], and "instructions" as
+                 [address, disassembly]
+
+A response has "ok": true and the result, or "ok": false and "error".
+Requests are read from a stream (serve_stream) or from the connections
+to a Unix domain socket (serve_unix).  The socket is created so that only
+its owner can connect, because a request can read any file the server
+can.  See client.py for a client.
+'''
+
+import base64
+import json
+import os
+import socket
+import socketserver
+import stat
+
+from f2mc8dasm.analysis import Options, analyze
+from f2mc8dasm.memory import LocationTypes
+
+REQUEST_OPTIONS = ('entry_points', 'vectors', 'reserved_bytes',
+                   'mode_bytes', 'merge_states')
+
+LOCATION_TYPE_NAMES = dict(
+    (value, name) for name, value in vars(LocationTypes).items()
+    if not name.startswith('_'))
+
+
+def handle_request(request, cache=None):
+    '''Answer a request decoded from JSON and return the response.  An
+    error in the request is returned in the response, not raised.'''
+    response = {'id': request.get('id')}
+    try:
+        rom = _request_rom(request)
+        options = _request_options(request)
+        result = request.get('result', 'listing')
+        if result == 'listing':
+            if cache is None:
+                response['listing'] = analyze(rom, options).listing()
+            else:
+                response['listing'] = cache.listing(rom, options)
+        elif result == 'analysis':
+            if cache is None:
+                analysis = analyze(rom, options)
+            else:
+                analysis = cache.analyze(rom, options)
+            response.update(_describe(analysis))
+        else:
+            raise ValueError("Unknown result %r" % (result,))
+        response['ok'] = True
+    except Exception as exc:
+        response['ok'] = False
+        response['error'] = "%s: %s" % (exc.__class__.__name__, exc)
+    return response
+
+def handle_line(line, cache=None):
+    '''Answer a request that is a line of JSON, as text or UTF-8 bytes,
+    and return the response as a line of JSON'''
+    try:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError("Request is not an object")
+    except ValueError as exc:
+        response = {'id': None, 'ok': False,
+                    'error': "%s: %s" % (exc.__class__.__name__, exc)}
+    else:
+        response = handle_request(request, cache)
+    return json.dumps(response) + '\n'
+
+def serve_stream(infile, outfile, cache=None):
+    '''Answer each line read from a text stream until the end of it'''
+    for line in infile:
+        if line.strip():
+            outfile.write(handle_line(line, cache))
+            outfile.flush()
+
+def serve_unix(path, cache=None):
+    '''Answer requests from the connections to a Unix domain socket until
+    interrupted'''
+    server = make_unix_server(path, cache)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+def make_unix_server(path, cache=None):
+    '''Return a server bound to a Unix domain socket that answers each
+    connection in a thread.  Call serve_forever() to start it.  A socket
+    left at the path by a server that did not shut down is replaced, but
+    anything else there is an error.'''
+    _remove_stale_socket(path)
+    server = _UnixServer(path, _RequestHandler)
+    server.cache = cache
+    return server
+
+
+def _remove_stale_socket(path):
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise FileExistsError("%s exists and is not a socket" % path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        os.remove(path)
+        return
+    finally:
+        sock.close()
+    raise FileExistsError("A server is already listening on %s" % path)
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        old_umask = os.umask(0o077) # only the owner can connect
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(old_umask)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            if line.strip():
+                response = handle_line(line, self.server.cache)
+                self.wfile.write(response.encode('utf-8'))
+
+
+def _request_rom(request):
+    if 'rom' in request:
+        return base64.b64decode(request['rom'].encode('ascii'))
+    if 'filename' in request:
+        with open(request['filename'], 'rb') as f:
+            return f.read()
+    raise ValueError("Request has no rom or filename")
+
+def _request_options(request):
+    options = request.get('options', {})
+    for name in options:
+        if name not in REQUEST_OPTIONS:
+            raise ValueError("Unknown option %r" % (name,))
+    return Options(**options)
+
+def _describe(analysis):
+    printer = analysis.printer()
+    symbols = analysis.symbol_table.symbols
+    return {
+        'start_address': analysis.start_address,
+        'symbols': [ [address, name, comment] for address, (name, comment)
+                     in sorted(symbols.items()) ],
+        'regions': [ [start, end, LOCATION_TYPE_NAMES[loc_type]]
+                     for start, end, loc_type in analysis.memory.iter_regions(
+                        analysis.start_address) ],
+        'instructions': [ [address, printer.format_instruction(inst)]
+                          for address, inst
+                          in analysis.memory.iter_instructions() ],
+        }
@@ -0,0 +1,181 @@
+import struct
+import zlib
+
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import SymbolTable
+from f2mc8dasm.trace import Tracer, MergingTraceQueue
+
+# A snapshot file is an 8-byte magic, a version (u16), and the sections
+# present (u16), followed by a zlib-compressed body.  All integers are big
+# endian.  The body holds, in order:
+#
+#   memory       start address (u32), the rom bytes from there to the end,
+#                location types and annotations (one byte per address),
+#                and the addresses of instruction starts (u32 count, u16s).
+#                Instructions are decoded again when the snapshot is loaded.
+#   symbols      string table (u32 count, then u16 length + utf-8 each) and
+#                symbols (u32 count, then u16 address, u32 name index, u32
+#                comment index each)
+#   tracer       optional: traceable range start and stop (u32 each), merge
+#                states (u8), traced and pending packed states (u32 count,
+#                u32s each), and addresses marked as data (u32 count, u16s)
+
+MAGIC = b'F2MC8SNP'
+VERSION = 1
+
+SECTION_SYMBOLS = 1 << 0
+SECTION_TRACER = 1 << 1
+
+_HEADER = struct.Struct('>8sHH')
+
+
+class Snapshot(object):
+    '''The analysis objects restored from a snapshot.  symbol_table and
+    tracer are None if they were not saved.'''
+
+    def __init__(self, memory, symbol_table=None, tracer=None):
+        self.memory = memory
+        self.symbol_table = symbol_table
+        self.tracer = tracer
+
+
+def save(f, memory, symbol_table=None, tracer=None):
+    '''Write a snapshot of the analysis to a binary file object.  Save the
+    tracer to be able to resume it after loading with add_entry_point().'''
+    sections = 0
+    body = bytearray()
+    _write_memory(body, memory)
+    if symbol_table is not None:
+        sections |= SECTION_SYMBOLS
+        _write_symbols(body, symbol_table)
+    if tracer is not None:
+        sections |= SECTION_TRACER
+        _write_tracer(body, tracer)
+    f.write(_HEADER.pack(MAGIC, VERSION, sections))
+    f.write(zlib.compress(bytes(body)))
+
+def load(f, disassemble_func=disassemble_inst):
+    '''Read a snapshot from a binary file object and return a Snapshot'''
+    header = f.read(_HEADER.size)
+    if len(header) != _HEADER.size:
+        raise ValueError("Not a snapshot file")
+    magic, version, sections = _HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError("Not a snapshot file")
+    if version != VERSION:
+        raise ValueError("Unsupported snapshot version %d" % version)
+    try:
+        body = zlib.decompress(f.read())
+    except zlib.error:
+        raise ValueError("Snapshot file is corrupt")
+
+    reader = _Reader(body)
+    memory = _read_memory(reader, disassemble_func)
+    snapshot = Snapshot(memory)
+    if sections & SECTION_SYMBOLS:
+        snapshot.symbol_table = _read_symbols(reader)
+    if sections & SECTION_TRACER:
+        snapshot.tracer = _read_tracer(reader, memory)
+    return snapshot
+
+
+def _write_memory(body, memory):
+    start_address = memory.start_address
+    addresses = [ address for address, inst in memory.iter_instructions() ]
+    body += struct.pack('>I', start_address)
+    body += memory.contents[start_address:]
+    body += memory.types
+    body += memory.annotations
+    _write_array(body, 'H', addresses)
+
+def _read_memory(reader, disassemble_func):
+    start_address = reader.unpack('>I')[0]
+    memory = Memory(reader.read(0x10000 - start_address))
+    size = len(memory)
+    memory.types[:] = reader.read(size)
+    memory.annotations[:] = reader.read(size)
+    decode = memory.decode_cache.decode
+    for address in _read_array(reader, 'H'):
+        if not memory.is_instruction_start(address):
+            raise ValueError("Snapshot file is corrupt")
+        memory.instructions[address] = decode(memory, address,
+                                              disassemble_func)
+    memory.reindex()
+    return memory
+
+def _write_symbols(body, symbol_table):
+    strings = []
+    indexes = {} # string: index in strings
+    entries = []
+    for address in sorted(symbol_table.symbols):
+        name, comment = symbol_table.symbols[address]
+        for string in (name, comment):
+            if string not in indexes:
+                indexes[string] = len(strings)
+                strings.append(string)
+        entries.append((address, indexes[name], indexes[comment]))
+
+    body += struct.pack('>I', len(strings))
+    for string in strings:
+        encoded = string.encode('utf-8')
+        body += struct.pack('>H', len(encoded))
+        body += encoded
+    body += struct.pack('>I', len(entries))
+    for entry in entries:
+        body += struct.pack('>HII', *entry)
+
+def _read_symbols(reader):
+    strings = []
+    for _ in range(reader.unpack('>I')[0]):
+        length = reader.unpack('>H')[0]
+        strings.append(reader.read(length).decode('utf-8'))
+    symbols = {}
+    for _ in range(reader.unpack('>I')[0]):
+        address, name, comment = reader.unpack('>HII')
+        symbols[address] = (strings[name], strings[comment])
+    return SymbolTable(symbols)
+
+def _write_tracer(body, tracer):
+    merge_states = isinstance(tracer.queue, MergingTraceQueue)
+    body += struct.pack('>IIB', tracer.traceable_range.start,
+                        tracer.traceable_range.stop, int(merge_states))
+    _write_array(body, 'I', sorted(tracer.queue.traced))
+    _write_array(body, 'I', tracer.queue.pending_states())
+    _write_array(body, 'H', tracer.data_marked)
+
+def _read_tracer(reader, memory):
+    start, stop, merge_states = reader.unpack('>IIB')
+    tracer = Tracer(memory, [], [], range(start, stop),
+                    merge_states=bool(merge_states))
+    for state in _read_array(reader, 'I'):
+        tracer.queue.add_traced_state(state)
+    for state in _read_array(reader, 'I'):
+        tracer.queue.push_state(state)
+    tracer.data_marked = list(_read_array(reader, 'H'))
+    return tracer
+
+def _write_array(body, typecode, values):
+    body += struct.pack('>I', len(values))
+    body += struct.pack('>%d%s' % (len(values), typecode), *values)
+
+def _read_array(reader, typecode):
+    count = reader.unpack('>I')[0]
+    return reader.unpack('>%d%s' % (count, typecode))
+
+
+class _Reader(object):
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def read(self, length):
+        end = self.offset + length
+        if end > len(self.data):
+            raise ValueError("Snapshot file is truncated")
+        chunk = self.data[self.offset:end]
+        self.offset = end
+        return chunk
+
+    def unpack(self, fmt):
+        return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
@@ -0,0 +1,117 @@
+'''
+Record where the time and memory of a run go, phase by phase:
+
+    stats = Stats()
+    with stats.phase('trace'):
+        tracer.trace(disassemble_inst)
+    stats.write_report(sys.stderr)
+
+The counters of a tracer (see count_tracer()) are:
+
+  states_pushed         states queued or taken right away to be traced
+  states_popped         states traced
+  states_deduplicated   states dropped because they were already seen
+  instructions_traced   instructions decoded and traced
+  instructions_marked   new instructions marked in memory
+  branches_annotated    conditional branches found taken or not taken
+  data_bytes_marked     bytes marked as data at the end of the trace
+
+Straight-line code that was traced before is traced again as a block,
+from the state at its head straight to the state after it (see
+Tracer._trace_block()).  The states and instructions inside such a block
+are not counted, so the counters cover block heads only and depend on
+where the blocks fall as well as on the code.
+'''
+
+import contextlib
+import cProfile
+import json
+import os
+import time
+import tracemalloc
+
+from f2mc8dasm.observers import CountingObserver
+
+
+class Stats(object):
+    '''Wall time, CPU time, and peak memory of each phase of a run, plus
+    counters.  Peak memory is what tracemalloc saw allocated during the
+    phase; tracing memory slows the run, so it can be turned off.  If
+    profile_dir is given, each phase is also run under cProfile and the
+    profile is dumped to <profile_dir>/<phase>.prof.'''
+
+    def __init__(self, trace_memory=True, profile_dir=None):
+        self.trace_memory = trace_memory
+        self.profile_dir = profile_dir
+        self.phases = [] # dicts of name, wall, cpu, peak_memory
+        self.counters = {} # name: int
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''Record the phase run in the body of a with statement'''
+        started_tracing = False
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracing = True
+        profile = None
+        if self.profile_dir is not None:
+            profile = cProfile.Profile()
+            profile.enable()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            if profile is not None:
+                profile.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profile.dump_stats(os.path.join(self.profile_dir,
+                                                name + '.prof'))
+            peak_memory = None
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                if started_tracing:
+                    tracemalloc.stop()
+            self.phases.append({'name': name, 'wall': wall, 'cpu': cpu,
+                                'peak_memory': peak_memory})
+
+    def watch_tracer(self, tracer):
+        '''Start counting the events of a tracer that is about to trace.
+        Call count_tracer() when it is done.'''
+        self._counting = CountingObserver()
+        tracer.add_observer(self._counting)
+
+    def count_tracer(self, tracer):
+        '''Add the counters of a tracer that is done tracing'''
+        self.counters.update(self._counting.as_dict())
+        queue = tracer.queue
+        self.counters['states_pushed'] = queue.next_serial + queue.taken
+        self.counters['data_bytes_marked'] = len(tracer.data_marked)
+
+    def as_dict(self):
+        return {'phases': self.phases, 'counters': self.counters}
+
+    def write_json(self, stream):
+        json.dump(self.as_dict(), stream, indent=2, sort_keys=True)
+        stream.write('\n')
+
+    def write_report(self, stream):
+        '''Write the phases and counters as a table to a text stream'''
+        stream.write("%-12s %9s %9s %12s\n" % (
+            'phase', 'wall s', 'cpu s', 'peak KiB'))
+        for phase in self.phases:
+            if phase['peak_memory'] is None:
+                peak = '-'
+            else:
+                peak = '%d' % (phase['peak_memory'] // 1024)
+            stream.write("%-12s %9.3f %9.3f %12s\n" % (
+                phase['name'], phase['wall'], phase['cpu'], peak))
+        stream.write("%-12s %9.3f %9.3f\n" % (
+            'total', sum(phase['wall'] for phase in self.phases),
+            sum(phase['cpu'] for phase in self.phases)))
+        if self.counters:
+            stream.write('\n')
+            for name in sorted(self.counters):
+                stream.write("%-24s %9d\n" % (name, self.counters[name]))
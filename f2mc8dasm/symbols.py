@@ -7,67 +7,82 @@ class SymbolTable(object):
         self.symbols = initial_symbols.copy()
 
     def generate(self, memory, start_address):
-        self.generate_code_symbols(memory, start_address)
-        self.generate_data_symbols(memory, start_address)
+        self._generate(memory, start_address, True, True)
 
     def generate_code_symbols(self, memory, start_address):
-        for address in range(start_address, len(memory)):
-            if address in self.symbols:
-                pass # do not overwrite existing symbols
-            elif memory.is_call_target(address):
-                if memory.is_instruction_start(address):
-                    self.symbols[address] = ('sub_%04x' % address, '')
-            elif memory.is_jump_target(address):
-                if memory.is_instruction_start(address):
-                    self.symbols[address] = ('lab_%04x' % address, '')
+        self._generate(memory, start_address, True, False)
 
     def generate_data_symbols(self, memory, start_address):
-        # symbols are always generated for direct or extended address r/w
-        for address, inst in memory.iter_instructions():
-            if inst.addr_mode not in (AddressModes.Extended,
-                                      AddressModes.Direct,
-                                      AddressModes.DirectWithImmediateByte,
-                                      AddressModes.BitDirect):
-                continue
-            if inst.address in self.symbols:
-                continue
-            if memory.is_single_byte_or_start_of_multibyte(inst.address):
-                self.symbols[inst.address] = ('mem_%04x' % inst.address, '')
+        self._generate(memory, start_address, False, True)
 
-        # bbc 0xaa:0, 0xe005
-        # symbols are always generated for the tested address (0xaa)
+    def _generate(self, memory, start_address, code, data):
+        # one pass over the instructions applies every rule.  code symbols
+        # take precedence over data symbols for the same address, and
+        # existing symbols are never overwritten.
         for address, inst in memory.iter_instructions():
-            if inst.addr_mode != AddressModes.BitDirectWithRelative:
-                continue
-            if inst.bittest_address in self.symbols:
-                continue
-            if memory.is_single_byte_or_start_of_multibyte(inst.bittest_address):
-                self.symbols[inst.bittest_address] = ('mem_%04x' % inst.bittest_address, '')
+            if code and (address not in self.symbols):
+                name = _code_symbol_name(memory, address, start_address)
+                if name is not None:
+                    self.symbols[address] = (name, '')
 
-        # mov ep, #0x0123
-        # mov ix, #0x0123
-        # mov sp, #0x0123
-        # symbols are always generated for immediate words loaded into pointers
-        for address, inst in memory.iter_instructions():
-            if not inst.stores_immediate_word_in_pointer:
-                continue
-            if inst.immediate in self.symbols:
+            if not data:
                 continue
-            if memory.is_single_byte_or_start_of_multibyte(inst.immediate):
-                self.symbols[inst.immediate] = ('mem_%04x' % inst.immediate, '')
 
-        # mov a, #0xee9f
-        # symbols are only generated for immediate word loads into A if the
-        # address is in the rom range or else many false positives will result
-        for address, inst in memory.iter_instructions():
-            if not inst.stores_immediate_word_in_a:
-                continue
-            if inst.immediate in self.symbols:
-                continue
-            if inst.immediate < start_address:
-                continue
-            if memory.is_single_byte_or_start_of_multibyte(inst.immediate):
-                self.symbols[inst.immediate] = ('mem_%04x' % inst.immediate, '')
+            # symbols are always generated for direct or extended address r/w
+            if inst.addr_mode in _DATA_ADDRESS_MODES:
+                self._add_data_symbol(memory, inst.address, start_address,
+                                      code)
+
+            # bbc 0xaa:0, 0xe005
+            # symbols are always generated for the tested address (0xaa)
+            elif inst.addr_mode == AddressModes.BitDirectWithRelative:
+                self._add_data_symbol(memory, inst.bittest_address,
+                                      start_address, code)
+
+            # mov ep, #0x0123
+            # mov ix, #0x0123
+            # mov sp, #0x0123
+            # symbols are always generated for immediate words loaded into
+            # pointers
+            if inst.stores_immediate_word_in_pointer:
+                self._add_data_symbol(memory, inst.immediate, start_address,
+                                      code)
+
+            # mov a, #0xee9f
+            # symbols are only generated for immediate word loads into A if
+            # the address is in the rom range or else many false positives
+            # will result
+            if inst.stores_immediate_word_in_a:
+                if inst.immediate >= start_address:
+                    self._add_data_symbol(memory, inst.immediate,
+                                          start_address, code)
+
+    def _add_data_symbol(self, memory, address, start_address, code):
+        if address in self.symbols:
+            return
+        if not memory.is_single_byte_or_start_of_multibyte(address):
+            return
+        if code and (_code_symbol_name(memory, address,
+                                       start_address) is not None):
+            return # gets a code symbol when its instruction is reached
+        self.symbols[address] = ('mem_%04x' % address, '')
+
+
+_DATA_ADDRESS_MODES = (
+    AddressModes.Extended,
+    AddressModes.Direct,
+    AddressModes.DirectWithImmediateByte,
+    AddressModes.BitDirect,
+    )
+
+def _code_symbol_name(memory, address, start_address):
+    if (address < start_address) or not memory.is_instruction_start(address):
+        return None
+    if memory.is_call_target(address):
+        return 'sub_%04x' % address
+    if memory.is_jump_target(address):
+        return 'lab_%04x' % address
+    return None
 
 
 F2MC8L_COMMON_SYMBOLS = {
@@ -0,0 +1,17 @@
+'''Small rom images shared by the tests'''
+
+def small_rom(size=0x1000, reset=None):
+    '''Return a rom image aligned to the top of memory with a nop and a ret
+    at its start and again 0x10 bytes in, and the reset vector pointing to
+    reset, or to the start of the rom by default'''
+    start = 0x10000 - size
+    if reset is None:
+        reset = start
+    rom = bytearray(size)
+    rom[0x000] = 0x00   # nop           ;f000  00 in a 4K rom
+    rom[0x001] = 0x20   # ret           ;f001  20
+    rom[0x010] = 0x00   # nop           ;f010  00
+    rom[0x011] = 0x20   # ret           ;f011  20
+    rom[-2] = reset >> 8 # reset vector ;fffe
+    rom[-1] = reset & 0xff
+    return bytes(rom)
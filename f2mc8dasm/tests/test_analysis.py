@@ -0,0 +1,125 @@
+import io
+import os
+import tempfile
+import unittest
+from f2mc8dasm.analysis import Options, analyze, analyze_file
+from f2mc8dasm.observers import CountingObserver
+from f2mc8dasm.stats import Stats
+from f2mc8dasm.symbols import MB89620R_SYMBOLS
+from f2mc8dasm.tests.roms import small_rom
+
+
+class AnalyzeTests(unittest.TestCase):
+
+    # Options
+
+    def test_options_defaults(self):
+        options = Options()
+        self.assertEqual(options.entry_points, ())
+        self.assertEqual(len(options.vectors), 31)
+        self.assertFalse(0xfffc in options.vectors)
+        self.assertEqual(options.symbols, MB89620R_SYMBOLS)
+
+    def test_options_raises_for_unknown_option(self):
+        self.assertRaises(KeyError, Options, entry_point=0xf000)
+
+    # analyze
+
+    def test_analyze_traces_from_vectors(self):
+        analysis = analyze(small_rom())
+        self.assertEqual(analysis.start_address, 0xf000)
+        self.assertTrue(analysis.memory.is_instruction_start(0xf000))
+        self.assertTrue(analysis.memory.is_instruction_start(0xf001))
+        self.assertTrue(analysis.memory.is_data(0xf010))
+        self.assertTrue(analysis.memory.is_reserved_byte(0xfffc))
+        self.assertTrue(analysis.memory.is_mode_byte(0xfffd))
+        self.assertEqual(analysis.symbol_table.symbols[0xf000][0],
+                         'lab_f000')
+
+    def test_analyze_traces_entry_points(self):
+        analysis = analyze(small_rom(), Options(entry_points=[0xf010]))
+        self.assertTrue(analysis.memory.is_instruction_start(0xf010))
+
+    def test_analyze_sends_events_to_observer(self):
+        observer = CountingObserver()
+        analyze(small_rom(), Options(observer=observer))
+        self.assertEqual(observer.instructions_traced, 2)
+
+    def test_analyze_does_not_change_initial_symbols(self):
+        symbols = {0x0012: ('port', '')}
+        analysis = analyze(small_rom(), Options(symbols=symbols))
+        self.assertEqual(symbols, {0x0012: ('port', '')})
+        self.assertTrue(0xf000 in analysis.symbol_table.symbols)
+
+    def test_analyze_file_same_as_analyze(self):
+        rom = small_rom()
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(rom)
+        try:
+            analysis = analyze_file(f.name)
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(analysis.listing(), analyze(rom).listing())
+
+    def test_analyze_records_stats(self):
+        stats = Stats(trace_memory=False)
+        analyze(small_rom(), stats=stats)
+        self.assertEqual([ phase['name'] for phase in stats.phases ],
+                         ['load', 'trace', 'symbols'])
+        self.assertEqual(stats.counters['instructions_traced'], 2)
+        # f000 is queued, f001 is taken right away
+        self.assertEqual(stats.counters['states_pushed'], 2)
+        self.assertEqual(stats.counters['states_popped'], 2)
+        # all but the code, the mode and reserved bytes, and 31 vectors
+        self.assertEqual(stats.counters['data_bytes_marked'],
+                         0x1000 - 2 - 2 - (31 * 2))
+
+    # Analysis
+
+    def test_listing_is_printed_listing(self):
+        analysis = analyze(small_rom())
+        stream = io.StringIO()
+        analysis.print_listing(stream)
+        self.assertEqual(analysis.listing(), stream.getvalue())
+        self.assertEqual(analysis.listing(),
+                         '\n'.join(analysis.iter_lines()) + '\n')
+        self.assertTrue('    .org 0xf000\n' in analysis.listing())
+
+    def test_listing_can_be_rendered_again(self):
+        analysis = analyze(small_rom())
+        self.assertEqual(analysis.listing(), analysis.listing())
+
+    def test_resume_traces_new_entry_point_and_regenerates_symbols(self):
+        rom = bytearray(small_rom())
+        rom[0x010] = 0x31   # call 0xf020   ;f010  31 f0 20
+        rom[0x011] = 0xf0
+        rom[0x012] = 0x20
+        rom[0x013] = 0x20   # ret           ;f013  20
+        rom[0x020] = 0x20   # ret           ;f020  20
+        analysis = analyze(rom)
+        self.assertFalse(0xf020 in analysis.symbol_table.symbols)
+
+        analysis.resume(entry_points=[0xf010])
+        self.assertTrue(analysis.memory.is_instruction_start(0xf020))
+        self.assertEqual(analysis.symbol_table.symbols[0xf020],
+                         ('sub_f020', ''))
+        self.assertTrue('call sub_f020' in analysis.listing())
+        self.assertEqual(analysis.listing(),
+                         analyze(rom, Options(entry_points=[0xf010])
+                                 ).listing())
+
+    def test_resume_keeps_initial_symbols(self):
+        symbols = {0xf020: ('handler', 'from options')}
+        rom = bytearray(small_rom())
+        rom[0x020] = 0x20   # ret           ;f020  20
+        rom[0xfc0] = 0xf0   # callv 0 vector ;ffc0  f0 20
+        rom[0xfc1] = 0x20
+        analysis = analyze(rom, Options(symbols=symbols, vectors=[0xfffe]))
+        self.assertFalse(analysis.memory.is_instruction_start(0xf020))
+
+        analysis.resume(vectors=[0xffc0])
+        self.assertTrue(analysis.memory.is_instruction_start(0xf020))
+        self.assertEqual(analysis.symbol_table.symbols[0xf020],
+                         ('handler', 'from options'))
+        self.assertEqual(analysis.symbol_table.symbols[0xf000],
+                         ('lab_f000', ''))
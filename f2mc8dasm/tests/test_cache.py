@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import f2mc8dasm.cache
+from f2mc8dasm.analysis import Options, analyze
+from f2mc8dasm.cache import Cache
+from f2mc8dasm.observers import CountingObserver
+from f2mc8dasm.tests.roms import small_rom
+
+
+class CacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _files(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            found.extend(filenames)
+        return sorted(found)
+
+    # key
+
+    def test_key_depends_on_rom_and_options(self):
+        cache = Cache(self.directory)
+        key = cache.key(small_rom(), Options())
+        self.assertEqual(cache.key(small_rom(), Options()), key)
+        self.assertNotEqual(cache.key(small_rom(reset=0xf001), Options()), key)
+        self.assertNotEqual(
+            cache.key(small_rom(), Options(entry_points=[0xf010])), key)
+        self.assertNotEqual(cache.key(small_rom(), Options(symbols={})), key)
+
+    def test_key_depends_on_package_source(self):
+        cache = Cache(self.directory)
+        key = cache.key(small_rom(), Options())
+        saved = f2mc8dasm.cache._source_digest
+        try:
+            f2mc8dasm.cache._source_digest = '0' * 64
+            self.assertNotEqual(cache.key(small_rom(), Options()), key)
+        finally:
+            f2mc8dasm.cache._source_digest = saved
+
+    def test_source_digest_is_hex_sha256(self):
+        digest = f2mc8dasm.cache.source_digest()
+        self.assertEqual(len(digest), 64)
+        self.assertEqual(f2mc8dasm.cache.source_digest(), digest)
+
+    # listing
+
+    def test_listing_is_stored_and_reused(self):
+        cache = Cache(self.directory)
+        rom = small_rom()
+        listing = cache.listing(rom)
+        self.assertEqual(listing, analyze(rom).listing())
+        key = cache.key(rom, Options())
+        self.assertEqual(self._files(), [key + '.asm', key + '.snap'])
+
+        filename = os.path.join(self.directory, key[:2], key + '.asm')
+        with open(filename, 'w') as f:
+            f.write('cached')
+        self.assertEqual(cache.listing(rom), 'cached')
+
+    def test_listing_with_observer_is_not_cached(self):
+        cache = Cache(self.directory)
+        observer = CountingObserver()
+        cache.listing(small_rom(), Options(observer=observer))
+        self.assertEqual(observer.instructions_traced, 2)
+        self.assertEqual(self._files(), [])
+
+    # analyze
+
+    def test_analyze_restores_analysis(self):
+        cache = Cache(self.directory)
+        rom = small_rom()
+        first = cache.analyze(rom)
+        second = cache.analyze(rom)
+        self.assertFalse(first is second)
+        self.assertEqual(second.start_address, 0xf000)
+        self.assertEqual(second.symbol_table.symbols,
+                         first.symbol_table.symbols)
+        self.assertEqual(second.listing(), first.listing())
+
+    def test_analyze_replaces_corrupt_snapshot(self):
+        cache = Cache(self.directory)
+        rom = small_rom()
+        key = cache.key(rom, Options())
+        filename = os.path.join(self.directory, key[:2], key + '.snap')
+        os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(b'garbage')
+        analysis = cache.analyze(rom)
+        self.assertEqual(analysis.listing(), analyze(rom).listing())
+        self.assertTrue(os.path.getsize(filename) > len(b'garbage'))
+
+    # evict
+
+    def test_evict_deletes_least_recently_used(self):
+        cache = Cache(self.directory)
+        old, new = small_rom(), small_rom(reset=0xf001)
+        cache.listing(old)
+        cache.listing(new)
+        past = time.time() - 60
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            for name in filenames:
+                if name.startswith(cache.key(old, Options())):
+                    os.utime(os.path.join(dirpath, name), (past, past))
+
+        key = cache.key(new, Options())
+        cache.max_size = sum(
+            os.path.getsize(os.path.join(self.directory, key[:2], key + ext))
+            for ext in ('.asm', '.snap'))
+        self.assertEqual(cache.evict(), cache.max_size)
+        self.assertEqual(self._files(), [key + '.asm', key + '.snap'])
+
+    def test_size_is_kept_by_concurrent_writes(self):
+        cache = Cache(self.directory)
+        cache.listing(small_rom())
+        def write(reset):
+            cache.listing(small_rom(reset=reset))
+        threads = [ threading.Thread(target=write, args=(0xf001 + i,))
+                    for i in range(8) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(cache._size, cache.evict())
+
+    def test_evict_to_given_size(self):
+        cache = Cache(self.directory)
+        cache.listing(small_rom())
+        self.assertEqual(cache.evict(0), 0)
+        self.assertEqual(self._files(), [])
+
+    def test_write_walks_directory_only_when_full(self):
+        cache = Cache(self.directory)
+        walks = []
+        evict = cache.evict
+        def counting_evict(size=None):
+            walks.append(size)
+            return evict(size)
+        cache.evict = counting_evict
+        cache.listing(small_rom())
+        cache.listing(small_rom(reset=0xf001))
+        self.assertEqual(walks, [None]) # first write only
+
+        cache.max_size = cache._size
+        cache.listing(small_rom(reset=0xf010))
+        self.assertEqual(walks[0], None)
+        # each write over the limit evicts to below it
+        self.assertTrue(len(walks) > 1)
+        self.assertEqual(set(walks[1:]), set([int(cache.max_size * 0.9)]))
+        self.assertTrue(cache._size <= cache.max_size)
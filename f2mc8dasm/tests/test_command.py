@@ -0,0 +1,115 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from f2mc8dasm import command
+from f2mc8dasm.analysis import Options, analyze
+from f2mc8dasm.tests.roms import small_rom
+
+
+class BatchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _write_rom(self, name, size=0x2000):
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'wb') as f:
+            f.write(small_rom(size))
+        return filename
+
+    # _expand_filenames
+
+    def test_expand_filenames_directory_has_bin_files(self):
+        a = self._write_rom('a.bin')
+        b = self._write_rom('b.bin')
+        self._write_rom('notes.txt')
+        self.assertEqual(command._expand_filenames([self.tempdir]), [a, b])
+
+    def test_expand_filenames_pattern(self):
+        a = self._write_rom('a.bin')
+        self._write_rom('b.bin')
+        pattern = os.path.join(self.tempdir, '[a].bin')
+        self.assertEqual(command._expand_filenames([pattern, 'x.bin']),
+                         [a, 'x.bin'])
+
+    # _output_filename
+
+    def test_output_filename_next_to_input(self):
+        self.assertEqual(command._output_filename('/roms/a.bin', None),
+                         '/roms/a.asm')
+
+    def test_output_filename_in_output_dir(self):
+        self.assertEqual(command._output_filename('/roms/a.bin', '/out'),
+                         '/out/a.asm')
+
+    # run_batch
+
+    def _run_batch(self, processes, cache_dir=None):
+        good = self._write_rom('good.bin')
+        bad = self._write_rom('bad.bin', size=0x100) # 0xedba not in rom
+        jobs = [ (filename, command._output_filename(filename, None),
+                  cache_dir) for filename in (bad, good) ]
+        stream = io.StringIO()
+        failures = command.run_batch(jobs, processes, stream)
+        return failures, stream.getvalue()
+
+    def test_run_batch_writes_listings_and_reports_failures(self):
+        failures, report = self._run_batch(processes=1)
+        self.assertEqual(failures, 1)
+        self.assertTrue('FAIL' in report)
+        self.assertTrue('outside of traceable range' in report)
+        self.assertTrue('2 files, 1 failed' in report)
+
+        with open(os.path.join(self.tempdir, 'good.asm')) as f:
+            listing = f.read()
+        with open(os.path.join(self.tempdir, 'good.bin'), 'rb') as f:
+            rom = f.read()
+        expected = analyze(rom, Options(entry_points=[0xedba])).listing()
+        self.assertEqual(listing, expected)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir,
+                                                     'bad.asm')))
+
+    def test_run_batch_with_processes(self):
+        failures, report = self._run_batch(processes=2)
+        self.assertEqual(failures, 1)
+        self.assertTrue(os.path.exists(os.path.join(self.tempdir,
+                                                    'good.asm')))
+
+    def test_run_batch_with_cache(self):
+        cache_dir = os.path.join(self.tempdir, 'cache')
+        self._run_batch(processes=1, cache_dir=cache_dir)
+        with open(os.path.join(self.tempdir, 'good.asm')) as f:
+            listing = f.read()
+        os.remove(os.path.join(self.tempdir, 'good.asm'))
+
+        failures, report = self._run_batch(processes=1, cache_dir=cache_dir)
+        self.assertEqual(failures, 1)
+        with open(os.path.join(self.tempdir, 'good.asm')) as f:
+            self.assertEqual(f.read(), listing)
+        self.assertTrue(os.listdir(cache_dir))
+
+    def test_run_batch_fails_files_with_same_output(self):
+        os.mkdir(os.path.join(self.tempdir, 'a'))
+        os.mkdir(os.path.join(self.tempdir, 'b'))
+        a = self._write_rom(os.path.join('a', 'rom.bin'))
+        b = self._write_rom(os.path.join('b', 'rom.bin'))
+        c = self._write_rom(os.path.join('a', 'other.bin'))
+        output_dir = os.path.join(self.tempdir, 'out')
+        os.mkdir(output_dir)
+        jobs = [ (filename, command._output_filename(filename, output_dir),
+                  None) for filename in (a, b, c) ]
+        stream = io.StringIO()
+        failures = command.run_batch(jobs, 1, stream)
+        report = stream.getvalue()
+        self.assertEqual(failures, 2)
+        self.assertTrue('%s: %s is also the output' % (a, jobs[0][1])
+                        in report)
+        self.assertTrue('%s: %s is also the output' % (b, jobs[1][1])
+                        in report)
+        self.assertTrue('3 files, 2 failed' in report)
+        self.assertEqual(os.listdir(output_dir), ['other.asm'])
@@ -1,6 +1,12 @@
 import unittest
-from f2mc8dasm.disasm import disassemble_inst
-from f2mc8dasm.tables import AddressModes, Flags, FlowTypes
+from f2mc8dasm.disasm import Instruction, compile_template, disassemble_inst
+from f2mc8dasm.tables import (
+    AddressModes,
+    Flags,
+    FlowTypes,
+    InstructionLengths,
+    Opcodes,
+    )
 
 
 class InstructionTests(unittest.TestCase):
@@ -75,6 +81,44 @@ class InstructionTests(unittest.TestCase):
         inst = disassemble_inst([0xe8], pc=0)
         self.assertEqual(str(inst), "callv #0")
 
+    def test_str_leaves_placeholder_of_missing_operand(self):
+        inst = Instruction(disasm_template="mov a, #IMB", opcode=0x04)
+        self.assertEqual(str(inst), "mov a, #IMB")
+
+    def test_str_of_changed_template(self):
+        inst = disassemble_inst([0xe4, 0xaa, 0xbb], pc=0)
+        inst.disasm_template = "movw a, #100% IMW"
+        self.assertEqual(str(inst), "movw a, #100% 0xaabb")
+
+    # direct_address
+
+    def test_direct_address_is_address(self):
+        inst = disassemble_inst([0xa0, 0xaa], pc=0)
+        self.assertEqual(inst.direct_address, 0xaa)
+
+    def test_direct_address_is_bittest_address(self):
+        inst = disassemble_inst([0xb7, 0xaa, 0x08], pc=0)
+        self.assertEqual(inst.direct_address, 0xaa)
+
+
+class compile_templateTests(unittest.TestCase):
+    def test_converts_placeholders_in_order(self):
+        fmt, placeholders = compile_template("cmp @ix+IXD, #IMB",
+                                             {'IMB': '0x%02x'})
+        self.assertEqual(fmt, "cmp @ix+%s, #0x%02x")
+        self.assertEqual(placeholders, ('IXD', 'IMB'))
+
+    def test_escapes_percent(self):
+        fmt, placeholders = compile_template("100% DIR", {})
+        self.assertEqual(fmt, "100%% %s")
+        self.assertEqual(fmt % 'x', "100% x")
+        self.assertEqual(placeholders, ('DIR',))
+
+    def test_without_placeholders(self):
+        fmt, placeholders = compile_template("nop", {})
+        self.assertEqual(fmt, "nop")
+        self.assertEqual(placeholders, ())
+
 
 class disassemble_instTests(unittest.TestCase):
     def test_illegal(self):
@@ -403,3 +447,24 @@ class disassemble_instTests(unittest.TestCase):
         self.assertEqual(inst.bit, 1)
         self.assertEqual(inst.callv, None)
         self.assertEqual(inst.register, None)
+
+    def test_wraps_operands_around_top_of_memory(self):
+        memory = bytearray(0x10000)
+        memory[0xfffe] = 0x31
+        memory[0xffff] = 0xaa
+        memory[0x0000] = 0xbb
+        inst = disassemble_inst(memory, pc=0xfffe)
+        self.assertEqual(inst.operands, bytearray([0xaa, 0xbb]))
+        self.assertEqual(inst.address, 0xaabb)
+
+    def test_every_opcode_decodes_to_its_table_entry(self):
+        for opcode in Opcodes:
+            memory = bytearray(0x10000)
+            memory[0x1000] = opcode.number
+            inst = disassemble_inst(memory, pc=0x1000)
+            self.assertEqual(inst.opcode, opcode.number)
+            self.assertEqual(inst.disasm_template, opcode.disasm_template)
+            self.assertEqual(inst.addr_mode, opcode.addr_mode)
+            self.assertEqual(inst.flow_type, opcode.flow_type)
+            self.assertEqual(inst.affected_flags, opcode.affected_flags)
+            self.assertEqual(len(inst), InstructionLengths[opcode.addr_mode])
@@ -0,0 +1,236 @@
+import contextlib
+import io
+import unittest
+from f2mc8dasm.analysis import analyze
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.listing import Printer
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import SymbolTable
+
+
+class PrinterTests(unittest.TestCase):
+
+    def _printer(self):
+        rom = bytearray(0x10)
+        rom[0x00] = 0x00   # nop           ;fff0  00
+        rom[0x01] = 0x41   # 'A'           ;fff1  41
+        rom[0x02] = 0x42   # 'B'           ;fff2  42
+        memory = Memory(rom)
+        memory.set_instruction(0xfff0, disassemble_inst(memory, 0xfff0))
+        memory.set_data(0xfff1, 0x0b)
+        memory.set_reserved_byte(0xfffc)
+        memory.set_mode_byte(0xfffd)
+        memory.set_vector(0xfffe)
+        symbol_table = SymbolTable({0xfff2: ('text', ''),
+                                    0xfffe: ('reset_vect', 'reset')})
+        return Printer(memory, 0xfff0, symbol_table)
+
+    # iter_lines
+
+    def test_iter_lines_yields_listing_without_line_endings(self):
+        lines = list(self._printer().iter_lines())
+        self.assertEqual(lines[:5], [
+            '    .F2MC8L',
+            '    .area CODE1 (ABS)',
+            '    .org 0xfff0',
+            '',
+            '',
+            ])
+        self.assertEqual(lines[5:12], [
+            '    nop                     ;fff0  00      ',
+            '',
+            "    .byte 0x41              ;fff1  41          DATA 0x41 'A' ",
+            '',
+            'text:',
+            "    .byte 0x42              ;fff2  42          DATA 0x42 'B' ",
+            "    .byte 0x00              ;fff3  00          DATA 0x00 ",
+            ])
+        self.assertEqual(lines[-7:], [
+            '',
+            '    .byte 0x00              ;fffc  00          RESERVED',
+            '',
+            '    .byte 0x00              ;fffd  00          MODE',
+            '',
+            'reset_vect:',
+            '    .word 0x0000            ;fffe  00 00       VECTOR reset',
+            ])
+        for line in lines:
+            self.assertFalse('\n' in line)
+
+    # print_listing
+
+    def test_print_listing_writes_lines_to_stream(self):
+        printer = self._printer()
+        stream = io.StringIO()
+        printer.print_listing(stream)
+        lines = list(printer.iter_lines())
+        self.assertEqual(stream.getvalue(), '\n'.join(lines) + '\n')
+
+    # print_* compatibility methods
+
+    def test_print_methods_write_lines_to_stdout(self):
+        printer = self._printer()
+        inst = printer.memory.get_instruction(0xfff0)
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            printer.print_header()
+            printer.print_label(0xfff2)
+            printer.print_instruction_line(0xfff0, inst)
+            printer.print_data_line(0xfff1)
+            printer.print_vector_line(0xfffe)
+        self.assertEqual(stdout.getvalue().splitlines(), [
+            '    .F2MC8L',
+            '    .area CODE1 (ABS)',
+            '    .org 0xfff0',
+            '',
+            '',
+            'text:',
+            '    nop                     ;fff0  00      ',
+            "    .byte 0x41              ;fff1  41          DATA 0x41 'A' ",
+            '    .word 0x0000            ;fffe  00 00       VECTOR reset',
+            ])
+
+    # iter_body_lines
+
+    def test_iter_body_lines_renders_range_of_addresses(self):
+        printer = self._printer()
+        lines = list(printer.iter_lines())
+        printer.last_line_type = None
+        body = list(printer.iter_body_lines(0xfff0, 0x10000))
+        self.assertEqual(body, lines[-len(body):])
+        printer.last_line_type = None
+        self.assertEqual(list(printer.iter_body_lines(0xfff0, 0xfff1)),
+                         ['    nop                     ;fff0  00      '])
+
+    # split_body
+
+    def _analysis(self):
+        rom = bytearray(0x100)
+        rom[0x00:0x03] = bytearray((0x31, 0xff, 0x10)) # call 0xff10   ;ff00
+        rom[0x03:0x06] = bytearray((0x60, 0xff, 0x40)) # mov a, 0xff40 ;ff03
+        rom[0x06:0x08] = bytearray((0xfd, 0x02))       # beq 0xff0a    ;ff06
+        rom[0x08] = 0x00                               # nop           ;ff08
+        rom[0x09] = 0x00                               # nop           ;ff09
+        rom[0x0a:0x0d] = bytearray((0x21, 0xff, 0x00)) # jmp 0xff00    ;ff0a
+        rom[0x10] = 0x00                               # nop           ;ff10
+        rom[0x11] = 0x20                               # ret           ;ff11
+        rom[0x40:0x45] = b'HELLO'                      # data          ;ff40
+        rom[0xfe:0x100] = bytearray((0xff, 0x00))      # reset vector  ;fffe
+        return analyze(rom)
+
+    def _render_chunks(self, printer, chunks):
+        lines = printer.header_lines() + printer.symbol_lines()
+        for start, end, last_line_type in chunks:
+            printer.last_line_type = last_line_type
+            lines.extend(printer.iter_body_lines(start, end))
+        return lines
+
+    def test_split_body_chunks_render_same_lines(self):
+        printer = self._analysis().printer()
+        lines = list(printer.iter_lines())
+        for count in range(1, 80):
+            chunks = printer.split_body(count)
+            self.assertEqual(chunks[0][0], 0xff00)
+            self.assertEqual(chunks[-1][1], 0x10000)
+            self.assertEqual(self._render_chunks(printer, chunks), lines)
+
+    def test_split_body_splits_at_instructions_and_regions(self):
+        analysis = self._analysis()
+        memory = analysis.memory
+        printer = analysis.printer()
+        for start, end, last_line_type in printer.split_body(0x100):
+            self.assertFalse(memory.is_continuation_of_multibyte_type(start))
+            if start > 0xff00:
+                self.assertFalse(memory.is_data(start) and
+                                 memory.is_data(start - 1))
+
+    def test_split_body_does_not_split_instructions(self):
+        memory = Memory(bytearray([0x31, 0xff, 0xfd, 0x00]))
+        memory.set_instruction(0xfffc, disassemble_inst(memory, 0xfffc))
+        memory.set_instruction(0xffff, disassemble_inst(memory, 0xffff))
+        printer = Printer(memory, 0xfffc, SymbolTable({}))
+        self.assertEqual(printer.split_body(4), [(0xfffc, 0xffff, None),
+                                                 (0xffff, 0x10000, 2)])
+
+    def test_split_body_does_not_split_data_runs(self):
+        chunks = self._printer().split_body(16)
+        self.assertEqual(chunks[:3], [(0xfff0, 0xfff1, None),
+                                      (0xfff1, 0xfffc, 2),
+                                      (0xfffc, 0xfffd, 1)])
+
+    # print_listing with processes
+
+    def test_print_listing_with_processes_writes_same_lines(self):
+        analysis = self._analysis()
+        for processes in (2, 3):
+            self.assertEqual(analysis.listing(processes=processes),
+                             analysis.listing())
+
+    # format_instruction
+
+    def _format(self, rom, symbols):
+        memory = Memory(bytearray(rom + [0] * (0x10 - len(rom))))
+        printer = Printer(memory, 0xfff0, SymbolTable(symbols))
+        return printer.format_instruction(disassemble_inst(memory, 0xfff0))
+
+    def test_format_instruction_without_symbols(self):
+        self.assertEqual(self._format([0x86, 0xaa, 0xbb], {}),
+                         'mov @ix+0xaa, #0xbb')
+        self.assertEqual(self._format([0x31, 0x12, 0x34], {}),
+                         'call 0x1234')
+        self.assertEqual(self._format([0x45, 0x12], {}),
+                         'mov 0x12, a')
+
+    def test_format_instruction_substitutes_symbols(self):
+        symbols = {0x1234: ('sub_1234', ''), 0x12: ('mem_0012', '')}
+        self.assertEqual(self._format([0x31, 0x12, 0x34], symbols),
+                         'call sub_1234')
+        self.assertEqual(self._format([0x45, 0x12], symbols),
+                         'mov mem_0012, a')
+
+    def test_format_instruction_bittest_address(self):
+        symbols = {0xfffb: ('lab_fffb', '')}
+        self.assertEqual(self._format([0xb7, 0xaa, 0x08], symbols),
+                         'bbc 0x00aa:7, lab_fffb')
+        symbols[0xaa] = ('mem_00aa', '')
+        self.assertEqual(self._format([0xb7, 0xaa, 0x08], symbols),
+                         'bbc mem_00aa:7, lab_fffb')
+
+    def test_format_instruction_symbol_containing_placeholder(self):
+        symbols = {0xaa: ('DIR_BIT', '')}
+        self.assertEqual(self._format([0xa0, 0xaa], symbols),
+                         'clrb DIR_BIT:0')
+
+    def test_format_instruction_by_replacing_does_not_substitute_symbol(self):
+        symbols = {0xaa: ('DIR_BIT', '')}
+        memory = Memory(bytearray([0xa0, 0xaa] + [0] * 14))
+        printer = Printer(memory, 0xfff0, SymbolTable(symbols))
+        inst = disassemble_inst(memory, 0xfff0)
+        self.assertEqual(printer._format_instruction_by_replacing(inst),
+                         'clrb DIR_BIT:0')
+
+    def test_format_instruction_immediate_word_in_pointer(self):
+        symbols = {0x1234: ('mem_1234', '')}
+        self.assertEqual(self._format([0xe6, 0x12, 0x34], symbols),
+                         'movw ix, #mem_1234')
+
+    def test_format_instruction_immediate_word_in_a_below_start(self):
+        symbols = {0x1234: ('mem_1234', ''), 0xfff8: ('tbl_fff8', '')}
+        self.assertEqual(self._format([0xe4, 0x12, 0x34], symbols),
+                         'movw a, #0x1234')
+        self.assertEqual(self._format([0xe4, 0xff, 0xf8], symbols),
+                         'movw a, #tbl_fff8')
+
+    def test_format_instruction_does_not_change_instruction(self):
+        memory = Memory(bytearray([0xe6, 0x12, 0x34]))
+        inst = disassemble_inst(memory, 0xfffd)
+        printer = Printer(memory, 0xfffd,
+                          SymbolTable({0x1234: ('mem_1234', '')}))
+        self.assertEqual(printer.format_instruction(inst),
+                         'movw ix, #mem_1234')
+        self.assertEqual(inst.disasm_template, 'movw ix, #IMW')
+
+        printer = Printer(memory, 0xfffd,
+                          SymbolTable({0x1234: ('buf_1234', '')}))
+        self.assertEqual(printer.format_instruction(inst),
+                         'movw ix, #buf_1234')
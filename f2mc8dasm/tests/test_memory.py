@@ -0,0 +1,346 @@
+import os
+import pickle
+import tempfile
+import unittest
+from f2mc8dasm.memory import Memory, DecodeCache, LocationTypes
+from f2mc8dasm.disasm import disassemble_inst
+
+
+class MemoryTests(unittest.TestCase):
+
+    # __init__
+
+    def test_ctor_marks_all_locations_unknown(self):
+        memory = Memory(bytearray(0x8000))
+        self.assertTrue(memory.is_unknown(0, len(memory)))
+        self.assertEqual(memory.get_instruction(0x8000), None)
+
+    def test_ctor_sets_start_address(self):
+        self.assertEqual(Memory(bytearray(0x1000)).start_address, 0xf000)
+        self.assertEqual(Memory(bytearray(0x10000)).start_address, 0)
+
+    def test_ctor_raises_if_rom_larger_than_64k(self):
+        self.assertRaises(ValueError, Memory, bytearray(0x10001))
+
+    # from_file
+
+    def _write_rom(self, rom):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        self.addCleanup(os.remove, f.name)
+        with f:
+            f.write(rom)
+        return f.name
+
+    def test_from_file_reads_64k_image(self):
+        rom = bytearray(range(0x100)) * 0x100
+        memory = Memory.from_file(self._write_rom(rom))
+        self.assertEqual(len(memory), 0x10000)
+        self.assertEqual(memory[0x1234], 0x34)
+        self.assertEqual(memory.start_address, 0)
+        self.assertEqual(memory[0xfffe:0x10000], b'\xfe\xff')
+
+    def test_from_file_pads_smaller_image_at_bottom(self):
+        memory = Memory.from_file(self._write_rom(b'\x12\x34'))
+        self.assertEqual(len(memory), 0x10000)
+        self.assertEqual(memory[0x0000], 0)
+        self.assertEqual(memory[0xfffd], 0)
+        self.assertEqual(memory.read_word(0xfffe), 0x1234)
+        self.assertEqual(memory.start_address, 0xfffe)
+
+    def test_from_file_pads_empty_image(self):
+        memory = Memory.from_file(self._write_rom(b''))
+        self.assertEqual(len(memory), 0x10000)
+        self.assertEqual(memory[0xffff], 0)
+
+    def test_from_file_raises_if_image_larger_than_64k(self):
+        filename = self._write_rom(bytearray(0x10001))
+        self.assertRaises(ValueError, Memory.from_file, filename)
+
+    def test_from_file_write_byte_does_not_change_file(self):
+        filename = self._write_rom(bytearray(0x10000))
+        memory = Memory.from_file(filename)
+        memory.write_byte(0x1234, 0xaa)
+        self.assertEqual(memory[0x1234], 0xaa)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read()[0x1234], 0)
+
+    # __getitem__
+
+    def test_getitem_slice_is_copy_of_contents(self):
+        memory = Memory(bytearray(0x10000))
+        data = memory[0x1000:0x1002]
+        self.assertEqual(data, bytearray(b'\x00\x00'))
+        self.assertTrue(isinstance(data, bytearray))
+        memory.write_byte(0x1001, 0x42)
+        self.assertEqual(data, bytearray(b'\x00\x00'))
+
+    # pickle
+
+    def test_memory_from_file_can_be_pickled(self):
+        filename = self._write_rom(bytearray(range(0x100)) * 0x100)
+        memory = Memory.from_file(filename)
+        loaded = pickle.loads(pickle.dumps(memory))
+        self.assertEqual(loaded.contents, memory.contents)
+        self.assertEqual(loaded.start_address, 0)
+
+    # annotations
+
+    def test_annotations_are_independent_bits(self):
+        memory = Memory(bytearray(0x10000))
+        memory.annotate_jump_target(0x1234)
+        memory.annotate_branch_never_taken(0x1234)
+        self.assertTrue(memory.is_jump_target(0x1234))
+        self.assertTrue(memory.is_branch_never_taken(0x1234))
+        self.assertFalse(memory.is_call_target(0x1234))
+        self.assertFalse(memory.is_branch_taken(0x1234))
+        self.assertFalse(memory.is_branch_not_taken(0x1234))
+        self.assertFalse(memory.is_branch_always_taken(0x1234))
+        self.assertFalse(memory.is_jump_target(0x1235))
+
+    def test_unannotate_clears_only_its_bit(self):
+        memory = Memory(bytearray(0x10000))
+        memory.annotate_jump_target(0x1234)
+        memory.annotate_branch_always_taken(0x1234)
+        memory.annotate_branch_never_taken(0x1234)
+        memory.unannotate_branch_always_taken(0x1234)
+        self.assertFalse(memory.is_branch_always_taken(0x1234))
+        self.assertTrue(memory.is_branch_never_taken(0x1234))
+        memory.unannotate_branch_never_taken(0x1234)
+        self.assertFalse(memory.is_branch_never_taken(0x1234))
+        self.assertTrue(memory.is_jump_target(0x1234))
+
+    # iter_instructions
+
+    def _memory_with_nops(self, addresses):
+        memory = Memory(bytearray(0x10000))
+        for address in addresses:
+            memory.set_instruction(address, disassemble_inst(memory, address))
+        return memory
+
+    def test_iter_instructions_yields_in_address_order(self):
+        memory = self._memory_with_nops([0x3000, 0x1000, 0x2000])
+        self.assertEqual([ a for a, inst in memory.iter_instructions() ],
+                         [0x1000, 0x2000, 0x3000])
+
+    def test_iter_instructions_yields_only_from_address_to_end(self):
+        memory = self._memory_with_nops([0x1000, 0x2000, 0x3000, 0x4000])
+        addresses = [ a for a, inst in memory.iter_instructions(0x2000,
+                                                                0x4000) ]
+        self.assertEqual(addresses, [0x2000, 0x3000])
+        addresses = [ a for a, inst in memory.iter_instructions(0x2001) ]
+        self.assertEqual(addresses, [0x3000, 0x4000])
+
+    def test_iter_instructions_sees_instructions_set_after_iterating(self):
+        memory = self._memory_with_nops([0x2000])
+        list(memory.iter_instructions())
+        memory.set_instruction(0x1000, disassemble_inst(memory, 0x1000))
+        self.assertEqual([ a for a, inst in memory.iter_instructions() ],
+                         [0x1000, 0x2000])
+
+    def test_iter_instructions_skips_start_whose_type_changed(self):
+        memory = self._memory_with_nops([0x1000, 0x2000])
+        memory.set_data(0x1000)
+        self.assertEqual([ a for a, inst in memory.iter_instructions() ],
+                         [0x2000])
+
+    # next_instruction_start and previous_instruction_start
+
+    def test_next_instruction_start(self):
+        memory = self._memory_with_nops([0x1000, 0x2000])
+        self.assertEqual(memory.next_instruction_start(0x0000), 0x1000)
+        self.assertEqual(memory.next_instruction_start(0x1000), 0x2000)
+        self.assertEqual(memory.next_instruction_start(0x1fff), 0x2000)
+        self.assertEqual(memory.next_instruction_start(0x2000), None)
+
+    def test_previous_instruction_start(self):
+        memory = self._memory_with_nops([0x1000, 0x2000])
+        self.assertEqual(memory.previous_instruction_start(0xffff), 0x2000)
+        self.assertEqual(memory.previous_instruction_start(0x2000), 0x1000)
+        self.assertEqual(memory.previous_instruction_start(0x1001), 0x1000)
+        self.assertEqual(memory.previous_instruction_start(0x1000), None)
+
+    def test_next_and_previous_skip_start_whose_type_changed(self):
+        memory = self._memory_with_nops([0x1000, 0x2000, 0x3000])
+        memory.set_data(0x2000)
+        self.assertEqual(memory.next_instruction_start(0x1000), 0x3000)
+        self.assertEqual(memory.previous_instruction_start(0x3000), 0x1000)
+
+    # iter_vectors
+
+    def test_iter_vectors_yields_in_address_order_within_range(self):
+        rom = bytearray(0x10000)
+        rom[0xfffe:0x10000] = bytearray((0x12, 0x34))
+        memory = Memory(rom)
+        for address in (0xfffe, 0xffc0, 0xffd0, 0xffc0):
+            memory.set_vector(address)
+        self.assertEqual(list(memory.iter_vectors()),
+                         [(0xffc0, 0), (0xffd0, 0), (0xfffe, 0x1234)])
+        self.assertEqual(list(memory.iter_vectors(0xffc1, 0xfffe)),
+                         [(0xffd0, 0)])
+
+    # reindex
+
+    def test_reindex_finds_starts_assigned_directly(self):
+        memory = Memory(bytearray(0x10000))
+        memory.types[0x1000] = LocationTypes.InstructionStart
+        memory.instructions[0x1000] = disassemble_inst(memory, 0x1000)
+        memory.types[0xfffe] = LocationTypes.VectorStart
+        memory.reindex()
+        self.assertEqual([ a for a, inst in memory.iter_instructions() ],
+                         [0x1000])
+        self.assertEqual(list(memory.iter_vectors()), [(0xfffe, 0)])
+
+    # regions
+
+    def _memory_with_regions(self):
+        memory = Memory(bytearray(0x10000))
+        memory.set_data(0x1000, 0x10)   # 1000-100f
+        memory.set_data(0x1020, 0x08)   # 1020-1027
+        memory.set_vector(0x1028)       # 1028-1029
+        return memory
+
+    def test_iter_regions_yields_runs_of_each_type(self):
+        memory = self._memory_with_regions()
+        self.assertEqual(list(memory.iter_regions(0x0ff0, 0x1030)),
+            [(0x0ff0, 0x1000, LocationTypes.Unknown),
+             (0x1000, 0x1010, LocationTypes.Data),
+             (0x1010, 0x1020, LocationTypes.Unknown),
+             (0x1020, 0x1028, LocationTypes.Data),
+             (0x1028, 0x1029, LocationTypes.VectorStart),
+             (0x1029, 0x102a, LocationTypes.VectorContinuation),
+             (0x102a, 0x1030, LocationTypes.Unknown)])
+
+    def test_iter_regions_first_run_starts_at_address(self):
+        memory = self._memory_with_regions()
+        self.assertEqual(next(memory.iter_regions(0x1008)),
+                         (0x1008, 0x1010, LocationTypes.Data))
+
+    def test_iter_regions_of_one_type(self):
+        memory = self._memory_with_regions()
+        regions = memory.iter_regions(loc_type=LocationTypes.Data)
+        self.assertEqual(list(regions),
+            [(0x1000, 0x1010, LocationTypes.Data),
+             (0x1020, 0x1028, LocationTypes.Data)])
+
+    def test_region_at(self):
+        memory = self._memory_with_regions()
+        self.assertEqual(memory.region_at(0x1008),
+                         (0x1000, 0x1010, LocationTypes.Data))
+        self.assertEqual(memory.region_at(0x0000),
+                         (0x0000, 0x1000, LocationTypes.Unknown))
+        self.assertEqual(memory.region_at(0xffff),
+                         (0x102a, 0x10000, LocationTypes.Unknown))
+
+    # set_data
+
+    def test_set_data_marks_length_locations_wrapping_around(self):
+        memory = Memory(bytearray(0x10000))
+        memory.set_data(0xfffe, 4)
+        for address in (0xfffe, 0xffff, 0x0000, 0x0001):
+            self.assertTrue(memory.is_data(address))
+        self.assertTrue(memory.is_unknown(0x0002))
+        self.assertTrue(memory.is_unknown(0xfffd))
+
+    # is_unknown
+
+    def test_is_unknown_checks_every_location_in_length(self):
+        memory = Memory(bytearray(0x10000))
+        memory.set_data(0x1002)
+        self.assertTrue(memory.is_unknown(0x1000, 2))
+        self.assertFalse(memory.is_unknown(0x1000, 3))
+        memory.set_data(0x0000)
+        self.assertTrue(memory.is_unknown(0xfffe, 2))
+        self.assertFalse(memory.is_unknown(0xfffe, 3))
+
+    # set_unknown
+
+    def test_set_unknown_undoes_set_data(self):
+        memory = Memory(bytearray(0x10000))
+        memory.set_data(0x1234)
+        memory.set_unknown(0x1234)
+        self.assertTrue(memory.is_unknown(0x1234))
+
+    # set_instruction
+
+    def test_set_instruction_marks_start_and_continuation(self):
+        memory = Memory(bytearray([0x31, 0xaa, 0xbb]))
+        inst = disassemble_inst(memory, 0xfffd)
+        memory.set_instruction(0xfffd, inst)
+        self.assertTrue(memory.get_instruction(0xfffd) is inst)
+        self.assertTrue(memory.is_instruction_start(0xfffd))
+        self.assertTrue(memory.is_instruction_continuation(0xfffe))
+        self.assertTrue(memory.is_instruction_continuation(0xffff))
+        self.assertEqual(list(memory.iter_instructions()), [(0xfffd, inst)])
+
+    def test_set_instruction_raises_if_overlapping(self):
+        memory = Memory(bytearray(0x10000))
+        memory.set_data(0x1001)
+        inst = disassemble_inst([0x31, 0xaa, 0xbb], 0)
+        self.assertRaises(Exception, memory.set_instruction, 0x1000, inst)
+        self.assertTrue(memory.is_unknown(0x1000))
+
+    # write_byte
+
+    def test_write_byte_changes_contents(self):
+        memory = Memory(bytearray(0x10000))
+        memory.write_byte(0x1234, 0xaa)
+        self.assertEqual(memory.read_byte(0x1234), 0xaa)
+
+    def test_write_byte_invalidates_decoded_instruction(self):
+        memory = Memory(bytearray(0x10000))
+        memory.write_byte(0x1000, 0x31) # call 0x0000
+        inst = memory.decode_cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual(inst.address, 0x0000)
+        memory.write_byte(0x1002, 0x55) # call 0x0055
+        inst = memory.decode_cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual(inst.address, 0x0055)
+
+
+class DecodeCacheTests(unittest.TestCase):
+
+    # decode
+
+    def test_decode_counts_miss_then_hit(self):
+        memory = Memory(bytearray(0x10000))
+        cache = DecodeCache()
+        inst1 = cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        inst2 = cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertTrue(inst1 is inst2)
+
+    def test_decode_clears_if_disassemble_func_changes(self):
+        memory = Memory(bytearray(0x10000))
+        cache = DecodeCache()
+        inst1 = cache.decode(memory, 0x1000, disassemble_inst)
+        other_func = lambda memory, pc: disassemble_inst(memory, pc)
+        inst2 = cache.decode(memory, 0x1000, other_func)
+        self.assertFalse(inst1 is inst2)
+        self.assertEqual(cache.misses, 2)
+
+    # invalidate
+
+    def test_invalidate_drops_instructions_containing_address(self):
+        memory = Memory(bytearray(0x10000))
+        cache = DecodeCache()
+        for address in range(0x0ffd, 0x1002):
+            cache.decode(memory, address, disassemble_inst)
+        cache.invalidate(0x1000)
+        self.assertEqual(sorted(cache.instructions), [0x0ffd, 0x1001])
+
+    def test_invalidate_wraps_around_bottom_of_memory(self):
+        memory = Memory(bytearray(0x10000))
+        cache = DecodeCache()
+        cache.decode(memory, 0xffff, disassemble_inst)
+        cache.invalidate(0x0001)
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_callv_vector_drops_callv_instructions(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xe9 # callv #1
+        memory = Memory(rom)
+        inst = memory.decode_cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual(inst.address, 0x0000)
+        memory.write_byte(0xffc3, 0x42)
+        inst = memory.decode_cache.decode(memory, 0x1000, disassemble_inst)
+        self.assertEqual(inst.address, 0x0042)
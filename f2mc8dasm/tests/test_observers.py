@@ -0,0 +1,59 @@
+import io
+import json
+import unittest
+from f2mc8dasm.observers import (
+    CountingObserver,
+    JsonLinesObserver,
+    LoggingObserver,
+    ObserverGroup,
+    )
+from f2mc8dasm.trace import ProcessorState
+from f2mc8dasm.disasm import disassemble_inst
+
+
+class ObserverGroupTests(unittest.TestCase):
+    def test_sends_events_to_all_observers(self):
+        observers = [CountingObserver(), CountingObserver()]
+        group = ObserverGroup(observers)
+        group.state_popped(ProcessorState(pc=0x1000))
+        group.branch_annotated(0x1000, True)
+        for observer in observers:
+            self.assertEqual(observer.states_popped, 1)
+            self.assertEqual(observer.branches_annotated, 1)
+
+
+class CountingObserverTests(unittest.TestCase):
+    def test_as_dict(self):
+        observer = CountingObserver()
+        observer.state_deduplicated(ProcessorState(pc=0x1000))
+        observer.state_deduplicated(ProcessorState(pc=0x1000))
+        counts = observer.as_dict()
+        self.assertEqual(counts['states_deduplicated'], 2)
+        self.assertEqual(counts['states_popped'], 0)
+
+
+class JsonLinesObserverTests(unittest.TestCase):
+    def test_writes_one_json_object_per_line(self):
+        stream = io.StringIO()
+        observer = JsonLinesObserver(stream)
+        inst = disassemble_inst([0x04, 0xaa], 0)
+        observer.instruction_traced(inst, ProcessorState(pc=0x1000, c=1))
+        observer.instruction_marked(0x1000, inst)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(json.loads(lines[0]),
+            {'event': 'instruction_traced', 'pc': 0x1000,
+             'c': 1, 'n': None, 'z': None, 'disasm': 'mov a, #0xaa'})
+        self.assertEqual(json.loads(lines[1]),
+            {'event': 'instruction_marked', 'address': 0x1000,
+             'length': 2, 'disasm': 'mov a, #0xaa'})
+
+
+class LoggingObserverTests(unittest.TestCase):
+    def test_writes_trace_line(self):
+        stream = io.StringIO()
+        observer = LoggingObserver(stream)
+        inst = disassemble_inst([0x00], 0)
+        observer.instruction_traced(inst, ProcessorState(pc=0x1000, z=0))
+        self.assertEqual(stream.getvalue(),
+            "TRACE pc=1000 c=  n=  z=0     nop\n")
@@ -0,0 +1,198 @@
+import base64
+import io
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from f2mc8dasm import server
+from f2mc8dasm.analysis import Options, analyze
+from f2mc8dasm.client import Client
+from f2mc8dasm.tests.roms import small_rom
+
+
+def _encoded_rom():
+    return base64.b64encode(small_rom()).decode('ascii')
+
+
+class HandleRequestTests(unittest.TestCase):
+
+    def test_listing(self):
+        response = server.handle_request({'id': 7, 'rom': _encoded_rom()})
+        self.assertEqual(response, {'id': 7, 'ok': True,
+                                    'listing': analyze(small_rom()).listing()})
+
+    def test_listing_with_options(self):
+        request = {'rom': _encoded_rom(),
+                   'options': {'entry_points': [0xf010]}}
+        response = server.handle_request(request)
+        expected = analyze(small_rom(), Options(entry_points=[0xf010]))
+        self.assertEqual(response['listing'], expected.listing())
+
+    def test_listing_from_filename(self):
+        with tempfile.NamedTemporaryFile(delete=False) as f:
+            f.write(small_rom())
+        try:
+            response = server.handle_request({'filename': f.name})
+        finally:
+            os.unlink(f.name)
+        self.assertEqual(response['listing'], analyze(small_rom()).listing())
+
+    def test_analysis(self):
+        response = server.handle_request({'rom': _encoded_rom(),
+                                          'result': 'analysis'})
+        self.assertTrue(response['ok'])
+        self.assertEqual(response['start_address'], 0xf000)
+        self.assertTrue([0xf000, 'lab_f000', ''] in response['symbols'])
+        self.assertEqual(response['regions'][0], [0xf000, 0xf002,
+                                                  'InstructionStart'])
+        self.assertEqual(response['instructions'],
+                         [[0xf000, 'nop'], [0xf001, 'ret']])
+
+    def test_error_for_unknown_option(self):
+        response = server.handle_request({'id': 1, 'rom': _encoded_rom(),
+                                          'options': {'observer': True}})
+        self.assertEqual(response, {'id': 1, 'ok': False, 'error':
+                                    "ValueError: Unknown option 'observer'"})
+
+    def test_error_for_unknown_result(self):
+        response = server.handle_request({'rom': _encoded_rom(),
+                                          'result': 'pdf'})
+        self.assertEqual(response['error'], "ValueError: Unknown result 'pdf'")
+
+    def test_error_for_missing_rom(self):
+        response = server.handle_request({})
+        self.assertEqual(response['error'],
+                         "ValueError: Request has no rom or filename")
+
+
+class ServeStreamTests(unittest.TestCase):
+
+    def test_answers_each_line(self):
+        infile = io.StringIO(
+            json.dumps({'id': 1, 'rom': _encoded_rom()}) + '\n' +
+            '\n' +
+            '[1, 2]\n' +
+            'not json\n')
+        outfile = io.StringIO()
+        server.serve_stream(infile, outfile)
+        responses = [ json.loads(line)
+                      for line in outfile.getvalue().splitlines() ]
+        self.assertEqual(len(responses), 3)
+        self.assertEqual(responses[0]['listing'],
+                         analyze(small_rom()).listing())
+        self.assertEqual(responses[1]['error'],
+                         "ValueError: Request is not an object")
+        self.assertEqual(responses[2]['id'], None)
+        self.assertFalse(responses[2]['ok'])
+
+    def test_handle_line_answers_bytes(self):
+        line = json.dumps({'id': 1, 'rom': _encoded_rom()}).encode('utf-8')
+        response = json.loads(server.handle_line(line))
+        self.assertTrue(response['ok'])
+
+    def test_handle_line_answers_invalid_utf8_with_error(self):
+        response = json.loads(server.handle_line(b'{"id": 1}\xff\n'))
+        self.assertEqual(response['id'], None)
+        self.assertFalse(response['ok'])
+        self.assertTrue(response['error'].startswith('UnicodeDecodeError'))
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix domain sockets')
+class UnixServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'sock')
+        self.server = server.make_unix_server(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tempdir)
+
+    def test_client_listing(self):
+        client = Client(self.path)
+        try:
+            rom = small_rom()
+            self.assertEqual(client.listing(rom), analyze(rom).listing())
+            self.assertEqual(client.listing(rom, entry_points=[0xf010]),
+                             analyze(rom, Options(entry_points=[0xf010])
+                                     ).listing())
+        finally:
+            client.close()
+
+    def test_client_listing_raises_for_error(self):
+        client = Client(self.path)
+        try:
+            self.assertRaises(RuntimeError, client.listing, small_rom(),
+                              entry_points=[0x0000])
+        finally:
+            client.close()
+
+    def test_invalid_utf8_gets_error_and_keeps_connection(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        try:
+            request = json.dumps({'id': 2, 'rom': _encoded_rom()})
+            sock.sendall(b'\xff\xfe\n' + request.encode('utf-8') + b'\n')
+            with sock.makefile('rb') as f:
+                error = json.loads(f.readline().decode('utf-8'))
+                response = json.loads(f.readline().decode('utf-8'))
+        finally:
+            sock.close()
+        self.assertFalse(error['ok'])
+        self.assertTrue(error['error'].startswith('UnicodeDecodeError'))
+        self.assertEqual(response['id'], 2)
+        self.assertTrue(response['ok'])
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix domain sockets')
+class MakeUnixServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_socket_is_owner_only(self):
+        unix_server = server.make_unix_server(self.path)
+        try:
+            self.assertEqual(os.stat(self.path).st_mode & 0o077, 0)
+        finally:
+            unix_server.server_close()
+
+    def test_replaces_stale_socket(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.close()
+        unix_server = server.make_unix_server(self.path)
+        try:
+            client = Client(self.path)
+            client.close()
+        finally:
+            unix_server.server_close()
+
+    def test_raises_for_live_socket(self):
+        unix_server = server.make_unix_server(self.path)
+        try:
+            self.assertRaises(FileExistsError, server.make_unix_server,
+                              self.path)
+            self.assertTrue(os.path.exists(self.path))
+        finally:
+            unix_server.server_close()
+
+    def test_raises_for_file_that_is_not_socket(self):
+        with open(self.path, 'w') as f:
+            f.write('keep')
+        self.assertRaises(FileExistsError, server.make_unix_server,
+                          self.path)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'keep')
@@ -0,0 +1,128 @@
+import io
+import unittest
+from f2mc8dasm import snapshot
+from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.memory import Memory
+from f2mc8dasm.symbols import SymbolTable
+from f2mc8dasm.trace import Tracer, ProcessorState
+
+
+class SnapshotTests(unittest.TestCase):
+
+    def _traced_memory(self, merge_states=False):
+        rom = bytearray(0x1000)
+        rom[0x000] = 0x81   # clrc          ;f000  81
+        rom[0x001] = 0xf9   # bc 0xf005     ;f001  f9 02
+        rom[0x002] = 0x02
+        rom[0x003] = 0x20   # ret           ;f003  20
+        rom[0x005] = 0x20   # ret           ;f005  20
+        memory = Memory(rom)
+        tracer = Tracer(memory, [0xf000], [], range(0xf000, 0x10000),
+                        merge_states=merge_states)
+        tracer.trace(disassemble_inst)
+        return memory, tracer
+
+    def _round_trip(self, *args, **kwargs):
+        f = io.BytesIO()
+        snapshot.save(f, *args, **kwargs)
+        f.seek(0)
+        return snapshot.load(f)
+
+    # save and load
+
+    def test_round_trip_restores_memory(self):
+        memory, tracer = self._traced_memory()
+        loaded = self._round_trip(memory).memory
+        self.assertEqual(loaded.contents, memory.contents)
+        self.assertEqual(loaded.types, memory.types)
+        self.assertEqual(loaded.annotations, memory.annotations)
+        self.assertEqual(sorted(loaded.instructions),
+                         sorted(memory.instructions))
+        inst = loaded.get_instruction(0xf001)
+        self.assertEqual(inst.opcode, 0xf9)
+        self.assertEqual(inst.address, 0xf005)
+
+    def test_round_trip_keeps_leading_zeros_of_rom(self):
+        rom = bytearray(0x1000)
+        rom[0x800] = 0x20   # ret           ;f800  20
+        memory = Memory(rom)
+        loaded = self._round_trip(memory).memory
+        self.assertEqual(loaded.start_address, 0xf000)
+        self.assertEqual(loaded.contents, memory.contents)
+
+    def test_round_trip_restores_vector_index(self):
+        memory, tracer = self._traced_memory()
+        memory.set_vector(0xfffe)
+        loaded = self._round_trip(memory).memory
+        self.assertEqual(list(loaded.iter_vectors()),
+                         list(memory.iter_vectors()))
+
+    def test_round_trip_restores_symbols(self):
+        memory, tracer = self._traced_memory()
+        symbol_table = SymbolTable({0xffc0: ('callv_0_vect', 'callv #0'),
+                                    0x0012: ('mem_0012', '')})
+        loaded = self._round_trip(memory, symbol_table)
+        self.assertEqual(loaded.symbol_table.symbols, symbol_table.symbols)
+        self.assertEqual(loaded.tracer, None)
+
+    def test_round_trip_without_symbols_or_tracer(self):
+        memory, tracer = self._traced_memory()
+        loaded = self._round_trip(memory)
+        self.assertEqual(loaded.symbol_table, None)
+        self.assertEqual(loaded.tracer, None)
+
+    def test_round_trip_restores_tracer_that_can_be_resumed(self):
+        memory, tracer = self._traced_memory()
+        loaded = self._round_trip(memory, tracer=tracer)
+        self.assertEqual(loaded.tracer.traceable_range, range(0xf000, 0x10000))
+        self.assertEqual(loaded.tracer.queue.traced_processor_states,
+                         tracer.queue.traced_processor_states)
+        self.assertTrue(loaded.memory.is_data(0xf005))
+
+        loaded.tracer.add_entry_point(0xf005)
+        loaded.tracer.trace(disassemble_inst)
+        self.assertTrue(loaded.memory.is_instruction_start(0xf005))
+        self.assertTrue(loaded.memory.is_data(0xf006))
+
+    def test_round_trip_restores_merging_tracer(self):
+        memory, tracer = self._traced_memory(merge_states=True)
+        loaded = self._round_trip(memory, tracer=tracer)
+        self.assertEqual(loaded.tracer.queue.joined, tracer.queue.joined)
+
+    def test_round_trip_restores_pending_states(self):
+        memory = Memory(bytearray(0x1000))
+        tracer = Tracer(memory, [0xf010, 0xf000], [], range(0xf000, 0x10000))
+        loaded = self._round_trip(memory, tracer=tracer)
+        self.assertEqual(list(loaded.tracer.queue.untraced_processor_states),
+                         [ProcessorState(pc=0xf000),
+                          ProcessorState(pc=0xf010)])
+
+    # errors
+
+    def test_load_raises_for_bad_magic(self):
+        f = io.BytesIO(b'NOTASNAPSHOT')
+        try:
+            snapshot.load(f)
+            self.fail()
+        except ValueError as exc:
+            self.assertEqual(exc.args[0], "Not a snapshot file")
+
+    def test_load_raises_for_unsupported_version(self):
+        memory, tracer = self._traced_memory()
+        f = io.BytesIO()
+        snapshot.save(f, memory)
+        data = bytearray(f.getvalue())
+        data[9] = 99 # low byte of version
+        try:
+            snapshot.load(io.BytesIO(bytes(data)))
+            self.fail()
+        except ValueError as exc:
+            self.assertEqual(exc.args[0], "Unsupported snapshot version 99")
+
+    def test_load_raises_for_corrupt_body(self):
+        memory, tracer = self._traced_memory()
+        f = io.BytesIO()
+        snapshot.save(f, memory)
+        data = f.getvalue()[:-10]
+        self.assertRaises(ValueError, snapshot.load, io.BytesIO(data))
+
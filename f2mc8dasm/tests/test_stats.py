@@ -0,0 +1,82 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from f2mc8dasm.stats import Stats
+
+
+class StatsTests(unittest.TestCase):
+
+    # phase
+
+    def test_phase_records_time_and_memory(self):
+        stats = Stats()
+        with stats.phase('build'):
+            data = [ bytearray(1024) for _ in range(100) ]
+        self.assertEqual(len(stats.phases), 1)
+        phase = stats.phases[0]
+        self.assertEqual(phase['name'], 'build')
+        self.assertTrue(phase['wall'] >= 0)
+        self.assertTrue(phase['cpu'] >= 0)
+        self.assertTrue(phase['peak_memory'] >= 100 * 1024)
+
+    def test_phase_without_memory(self):
+        stats = Stats(trace_memory=False)
+        with stats.phase('build'):
+            pass
+        self.assertEqual(stats.phases[0]['peak_memory'], None)
+
+    def test_phase_recorded_when_body_raises(self):
+        stats = Stats()
+        try:
+            with stats.phase('fail'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(stats.phases[0]['name'], 'fail')
+
+    def test_phase_dumps_profile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            profile_dir = os.path.join(directory, 'profiles')
+            stats = Stats(profile_dir=profile_dir)
+            with stats.phase('trace'):
+                sorted(range(100))
+            self.assertEqual(os.listdir(profile_dir), ['trace.prof'])
+        finally:
+            shutil.rmtree(directory)
+
+    # write_report
+
+    def test_write_report(self):
+        stats = Stats()
+        stats.phases = [
+            {'name': 'trace', 'wall': 1.5, 'cpu': 1.25, 'peak_memory': 4096},
+            {'name': 'listing', 'wall': 0.5, 'cpu': 0.5, 'peak_memory': None},
+            ]
+        stats.counters = {'states_popped': 12}
+        stream = io.StringIO()
+        stats.write_report(stream)
+        self.assertEqual(stream.getvalue().splitlines(), [
+            'phase           wall s     cpu s     peak KiB',
+            'trace            1.500     1.250            4',
+            'listing          0.500     0.500            -',
+            'total            2.000     1.750',
+            '',
+            'states_popped                   12',
+            ])
+
+    # write_json
+
+    def test_write_json(self):
+        stats = Stats()
+        with stats.phase('trace'):
+            pass
+        stats.counters['states_popped'] = 12
+        stream = io.StringIO()
+        stats.write_json(stream)
+        loaded = json.loads(stream.getvalue())
+        self.assertEqual(loaded['counters'], {'states_popped': 12})
+        self.assertEqual(loaded['phases'][0]['name'], 'trace')
@@ -51,6 +51,60 @@ class SymbolTableTests(unittest.TestCase):
         st.generate(mem, 0)
         self.assertEqual(st.symbols, existing_symbols)
 
+    def test_generate_prefers_code_symbol_over_earlier_data_reference(self):
+        rom = bytearray(0x10000)
+        rom[0xF000:0xF003] = bytearray((0x60, 0xF0, 0x10)) # mov a, 0xf010
+        rom[0xF010] = 0x00                                  # nop
+        mem = memory.Memory(rom)
+        for address in (0xF000, 0xF010):
+            mem.set_instruction(address, disasm.disassemble_inst(mem, address))
+        mem.annotate_call_target(0xF010)
+        st = symbols.SymbolTable()
+        st.generate(mem, 0xF000)
+        self.assertEqual(st.symbols, {0xf010: ('sub_f010', '')})
+
+    def test_generate_makes_mem_symbol_for_code_below_start_address(self):
+        rom = bytearray(0x10000)
+        rom[0xF000:0xF003] = bytearray((0x60, 0xE0, 0x10)) # mov a, 0xe010
+        mem = memory.Memory(rom)
+        mem.set_instruction(0xF000, disasm.disassemble_inst(mem, 0xF000))
+        mem.set_instruction(0xE010, disasm.disassemble_inst(mem, 0xE010))
+        mem.annotate_call_target(0xE010)
+        st = symbols.SymbolTable()
+        st.generate(mem, 0xF000)
+        self.assertEqual(st.symbols, {0xe010: ('mem_e010', '')})
+
+    def _code_and_data_memory(self):
+        rom = bytearray(0x10000)
+        rom[0xF000:0xF003] = bytearray((0x60, 0xF0, 0x10)) # mov a, 0xf010
+        rom[0xF003:0xF006] = bytearray((0x60, 0x00, 0x80)) # mov a, 0x0080
+        rom[0xF010] = 0x00                                  # nop
+        mem = memory.Memory(rom)
+        for address in (0xF000, 0xF003, 0xF010):
+            mem.set_instruction(address, disasm.disassemble_inst(mem, address))
+        mem.annotate_call_target(0xF010)
+        return mem
+
+    def test_generate_code_symbols_makes_only_code_symbols(self):
+        st = symbols.SymbolTable()
+        st.generate_code_symbols(self._code_and_data_memory(), 0xF000)
+        self.assertEqual(st.symbols, {0xf010: ('sub_f010', '')})
+
+    def test_generate_data_symbols_makes_only_data_symbols(self):
+        st = symbols.SymbolTable()
+        st.generate_data_symbols(self._code_and_data_memory(), 0xF000)
+        self.assertEqual(st.symbols, {0x0080: ('mem_0080', ''),
+                                      0xf010: ('mem_f010', '')})
+
+    def test_generate_code_then_data_symbols_same_as_generate(self):
+        mem = self._code_and_data_memory()
+        st = symbols.SymbolTable()
+        st.generate_code_symbols(mem, 0xF000)
+        st.generate_data_symbols(mem, 0xF000)
+        expected = symbols.SymbolTable()
+        expected.generate(mem, 0xF000)
+        self.assertEqual(st.symbols, expected.symbols)
+
 
 class SymbolDictionariesTests(unittest.TestCase):
     def test_addresses_are_in_range(self):
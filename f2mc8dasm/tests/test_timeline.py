@@ -0,0 +1,73 @@
+import io
+import json
+import unittest
+from f2mc8dasm.analysis import analyze
+from f2mc8dasm.tests.roms import small_rom
+from f2mc8dasm.timeline import Timeline
+
+
+class TimelineTests(unittest.TestCase):
+
+    def _events(self, timeline, ph):
+        return [ event for event in timeline.events if event['ph'] == ph ]
+
+    # phase
+
+    def test_phase_records_span_and_stats(self):
+        timeline = Timeline()
+        with timeline.phase('listing'):
+            pass
+        spans = self._events(timeline, 'X')
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]['name'], 'listing')
+        self.assertTrue(spans[0]['dur'] >= 0)
+        self.assertEqual(timeline.phases[0]['name'], 'listing')
+        self.assertEqual(timeline.phases[0]['peak_memory'], None)
+
+    def test_phase_records_span_when_body_raises(self):
+        timeline = Timeline()
+        try:
+            with timeline.phase('fail'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self._events(timeline, 'X')[0]['name'], 'fail')
+
+    # analyze
+
+    def test_analyze_records_phases_and_samples(self):
+        timeline = Timeline(interval=0)
+        analyze(small_rom(), stats=timeline)
+        self.assertEqual([ e['name'] for e in self._events(timeline, 'X') ],
+                         ['load', 'trace', 'symbols'])
+        self.assertEqual(timeline.counters['instructions_traced'], 2)
+
+        samples = [ e for e in self._events(timeline, 'C')
+                    if e['name'] == 'memory' ]
+        self.assertEqual(samples[0]['args'],
+                         {'instructions': 0,
+                          'unknown bytes': 0x1000 - 62 - 2}) # vectors, mode
+        self.assertEqual(samples[-1]['args'],
+                         {'instructions': 2, 'unknown bytes': 0})
+        pcs = [ e['args']['pc'] for e in self._events(timeline, 'C')
+                if e['name'] == 'pc' ]
+        self.assertEqual(pcs[-1], 0xf001)
+        queue = [ e['args']['pending'] for e in self._events(timeline, 'C')
+                  if e['name'] == 'trace queue' ]
+        self.assertEqual((queue[0], queue[-1]), (1, 0))
+
+    # write_trace
+
+    def test_write_trace(self):
+        timeline = Timeline()
+        with timeline.phase('trace'):
+            timeline.counter('trace queue', {'pending': 3})
+        stream = io.StringIO()
+        timeline.write_trace(stream)
+        loaded = json.loads(stream.getvalue())
+        events = loaded['traceEvents']
+        self.assertEqual([ event['ph'] for event in events ],
+                         ['M', 'M', 'C', 'X'])
+        self.assertEqual(events[2]['args'], {'pending': 3})
+        for event in events[2:]:
+            self.assertTrue(event['ts'] >= 0)
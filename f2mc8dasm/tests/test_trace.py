@@ -1,8 +1,19 @@
 import unittest
 from operator import attrgetter
-from f2mc8dasm.trace import Tracer, TraceQueue, SortedSet, ProcessorState
+from f2mc8dasm.trace import (
+    Tracer,
+    TraceQueue,
+    MergingTraceQueue,
+    SortedSet,
+    ProcessorState,
+    BasicBlock,
+    Unknown,
+    find_basic_blocks,
+    join_states,
+    )
 from f2mc8dasm.memory import Memory
 from f2mc8dasm.disasm import disassemble_inst
+from f2mc8dasm.observers import CountingObserver, TraceObserver
 
 class TraceQueueTests(unittest.TestCase):
     # __init__
@@ -76,6 +87,171 @@ class TraceQueueTests(unittest.TestCase):
         self.assertEqual(queue.pop().pc, 0x0002)
         self.assertEqual(queue.pop().pc, 0x0003)
 
+    # push_or_take
+
+    def test_push_or_take_takes_state_lower_than_untraced(self):
+        queue = TraceQueue()
+        queue.push(ProcessorState(pc=0x0005))
+        ps = ProcessorState(pc=0x0004)
+        self.assertEqual(queue.push_or_take(ps), ps)
+        self.assertTrue(ps in queue.traced_processor_states)
+        self.assertEqual(len(queue), 1)
+
+    def test_push_or_take_takes_state_if_untraced_empty(self):
+        queue = TraceQueue()
+        ps = ProcessorState(pc=0x0004)
+        self.assertEqual(queue.push_or_take(ps), ps)
+        self.assertEqual(len(queue), 0)
+
+    def test_push_or_take_counts_states_taken(self):
+        queue = TraceQueue()
+        queue.push_or_take(ProcessorState(pc=0x0004))
+        queue.push_or_take(ProcessorState(pc=0x0004))
+        queue.push(ProcessorState(pc=0x0005))
+        queue.push_or_take(ProcessorState(pc=0x0006))
+        self.assertEqual(queue.taken, 1)
+        self.assertEqual(queue.next_serial, 2)
+
+    def test_push_or_take_pushes_state_with_same_pc_as_untraced(self):
+        queue = TraceQueue()
+        queue.push(ProcessorState(pc=0x0005, c=0))
+        ps = ProcessorState(pc=0x0005, c=1)
+        self.assertEqual(queue.push_or_take(ps), None)
+        self.assertEqual(len(queue), 2)
+        self.assertEqual(queue.pop().c, 0)
+
+    def test_push_or_take_ignores_state_already_traced(self):
+        queue = TraceQueue()
+        queue.push(ProcessorState(pc=0x0005))
+        queue.pop()
+        self.assertEqual(queue.push_or_take(ProcessorState(pc=0x0005)), None)
+        self.assertEqual(len(queue), 0)
+
+    # min_pc
+
+    def test_min_pc(self):
+        queue = TraceQueue()
+        self.assertEqual(queue.min_pc(), None)
+        queue.push(ProcessorState(pc=0x0005))
+        queue.push(ProcessorState(pc=0x0003))
+        self.assertEqual(queue.min_pc(), 0x0003)
+
+
+class MergingTraceQueueTests(unittest.TestCase):
+    # push
+
+    def test_push_first_state_for_pc(self):
+        queue = MergingTraceQueue()
+        queue.push(ProcessorState(pc=0x0005, c=1))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(), ProcessorState(pc=0x0005, c=1))
+
+    def test_push_replaces_pending_state_with_join(self):
+        queue = MergingTraceQueue()
+        queue.push(ProcessorState(pc=0x0005, c=1, z=0))
+        queue.push(ProcessorState(pc=0x0005, c=0, z=0))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(), ProcessorState(pc=0x0005, z=0))
+
+    def test_push_ignores_state_covered_by_traced_join(self):
+        queue = MergingTraceQueue()
+        queue.push(ProcessorState(pc=0x0005))
+        queue.pop()
+        queue.push(ProcessorState(pc=0x0005, c=1, n=0, z=1))
+        self.assertEqual(len(queue), 0)
+
+    def test_push_requeues_less_precise_join_after_traced(self):
+        queue = MergingTraceQueue()
+        queue.push(ProcessorState(pc=0x0005, c=1))
+        queue.pop()
+        queue.push(ProcessorState(pc=0x0005, c=0))
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(), ProcessorState(pc=0x0005))
+
+
+class ProcessorStateTests(unittest.TestCase):
+    # join
+
+    def test_join_keeps_flags_that_agree(self):
+        ps1 = ProcessorState(pc=0x0005, c=1, n=0, z=Unknown)
+        ps2 = ProcessorState(pc=0x0005, c=1, n=1, z=Unknown)
+        self.assertEqual(ps1.join(ps2),
+            ProcessorState(pc=0x0005, c=1, n=Unknown, z=Unknown))
+
+    def test_join_unknown_with_known_is_unknown(self):
+        ps1 = ProcessorState(pc=0x0005, c=0)
+        ps2 = ProcessorState(pc=0x0005)
+        self.assertEqual(ps1.join(ps2), ProcessorState(pc=0x0005))
+        self.assertEqual(ps2.join(ps1), ProcessorState(pc=0x0005))
+
+    def test_join_states_matches_join_for_every_pair_of_flags(self):
+        values = (0, 1, Unknown)
+        for c1 in values:
+            for n1 in values:
+                for c2 in values:
+                    for z2 in values:
+                        ps1 = ProcessorState(pc=0x1234, c=c1, n=n1, z=1)
+                        ps2 = ProcessorState(pc=0x1234, c=c2, n=0, z=z2)
+                        self.assertEqual(
+                            join_states(ps1.pack(), ps2.pack()),
+                            ps1.join(ps2).pack())
+
+    # pack and unpack
+
+    def test_pack_and_unpack_round_trip(self):
+        for ps in (ProcessorState(pc=0xffff, c=1, n=0, z=1),
+                   ProcessorState(pc=0x0000),
+                   ProcessorState(pc=0x1234, c=0, n=Unknown, z=0)):
+            self.assertEqual(ProcessorState.unpack(ps.pack()), ps)
+
+    def test_pack_distinguishes_unknown_from_known_flags(self):
+        packed = set()
+        for value in (0, 1, Unknown):
+            packed.add(ProcessorState(pc=0x0005, n=value).pack())
+        self.assertEqual(len(packed), 3)
+
+    def test_pack_raises_for_unknown_pc(self):
+        self.assertRaises(ValueError, ProcessorState().pack)
+
+
+class BasicBlockTests(unittest.TestCase):
+
+    def test_state_after_applies_flag_changes_up_to_index(self):
+        block = BasicBlock(0x1000)
+        block.append(0x1000, disassemble_inst([0x81], 0))       # clrc
+        block.append(0x1001, disassemble_inst([0x04, 0x80], 0)) # mov a,#0x80
+        block.append(0x1003, disassemble_inst([0x02], 0))       # rolc a
+        self.assertEqual(block.next_addresses, [0x1001, 0x1003, 0x1004])
+        state = ProcessorState(pc=0x1000, c=1, n=0, z=1).pack()
+        self.assertEqual(block.state_after(0, state),
+            ProcessorState(pc=0x1001, c=0, n=0, z=1).pack())
+        self.assertEqual(block.state_after(1, state),
+            ProcessorState(pc=0x1003, c=0, n=1, z=0).pack())
+        self.assertEqual(block.state_after(2, state),
+            ProcessorState(pc=0x1004).pack())
+
+    def test_find_basic_blocks_splits_at_flow_changes_and_targets(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x00   # nop             ;1000  00
+        rom[0x1001] = 0xfd   # bz 0x1004       ;1001  fd 01
+        rom[0x1002] = 0x01
+        rom[0x1003] = 0x00   # nop             ;1003  00
+        rom[0x1004] = 0x00   # nop             ;1004  00
+        rom[0x1005] = 0x20   # ret             ;1005  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1006)
+            )
+        tracer.trace(disassemble_inst)
+        blocks = find_basic_blocks(memory)
+        self.assertEqual(sorted(blocks), [0x1000, 0x1003, 0x1004])
+        self.assertEqual(blocks[0x1000].addresses, [0x1000, 0x1001])
+        self.assertEqual(blocks[0x1003].addresses, [0x1003])
+        self.assertEqual(blocks[0x1004].addresses, [0x1004, 0x1005])
+
 
 class SortedSetTests(unittest.TestCase):
     # __init__
@@ -176,6 +352,38 @@ class SortedSetTests(unittest.TestCase):
         s = SortedSet()
         self.assertRaises(KeyError, s.pop)
 
+    def test_pop_equal_keys_in_order_added(self):
+        items = [ProcessorState(pc=2, c=0), ProcessorState(pc=1, c=1),
+            ProcessorState(pc=2, c=1), ProcessorState(pc=1, c=0)]
+        s = SortedSet(items, key=attrgetter('pc'))
+        self.assertEqual(list(s), [items[1], items[3], items[0], items[2]])
+        self.assertEqual(s.pop(), items[1])
+        self.assertEqual(s.pop(), items[3])
+        self.assertEqual(s.pop(), items[0])
+        self.assertEqual(s.pop(), items[2])
+
+    def test_pop_skips_removed_items(self):
+        s = SortedSet([1, 2, 3])
+        s.remove(1)
+        self.assertEqual(s.pop(), 2)
+        self.assertEqual(len(s), 1)
+
+    def test_pop_item_removed_and_added_again(self):
+        s = SortedSet([1, 2])
+        s.remove(1)
+        s.add(1)
+        self.assertEqual(list(s), [1, 2])
+        self.assertEqual(s.pop(), 1)
+        self.assertEqual(s.pop(), 2)
+        self.assertRaises(KeyError, s.pop)
+
+    def test_remove_many_then_pop(self):
+        s = SortedSet(range(1000))
+        for i in range(999):
+            s.remove(i)
+        self.assertEqual(len(s), 1)
+        self.assertEqual(s.pop(), 999)
+
 
 class TracerTests(unittest.TestCase):
 
@@ -237,6 +445,212 @@ class TracerTests(unittest.TestCase):
         tracer.enqueue_vector(0xa000)
         self.assertEqual(len(tracer.queue), 0)
 
+    # decoding
+
+    def test_trace_decodes_each_address_once(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0x00   # nop             ;1002  00
+        rom[0x1003] = 0x00   # nop             ;1003  00
+        rom[0x1004] = 0x20   # ret             ;1004  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1005)
+            )
+        tracer.trace(disassemble_inst)
+        # 0x1004 is reached with both z=0 and z=1
+        self.assertEqual(memory.decode_cache.misses, 4)
+        self.assertEqual(memory.decode_cache.hits, 1)
+        self.assertTrue(memory.get_instruction(0x1004) is
+                        memory.decode_cache.instructions[0x1004])
+
+    # observers
+
+    def test_add_observer_receives_events(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0x00   # nop             ;1002  00
+        rom[0x1003] = 0x00   # nop             ;1003  00
+        rom[0x1004] = 0x20   # ret             ;1004  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1005)
+            )
+        counter = CountingObserver()
+        tracer.add_observer(counter)
+        tracer.trace(disassemble_inst)
+        self.assertEqual(counter.states_popped, 5)
+        self.assertEqual(counter.instructions_traced, 5)
+        self.assertEqual(counter.instructions_marked, 4)
+        self.assertEqual(counter.branches_annotated, 2)
+        self.assertEqual(counter.states_deduplicated, 0)
+
+    def test_state_popped_sent_for_states_taken_without_queueing(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x00   # nop             ;1000  00
+        rom[0x1001] = 0x00   # nop             ;1001  00
+        rom[0x1002] = 0x20   # ret             ;1002  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1003)
+            )
+        counter = CountingObserver()
+        tracer.add_observer(counter)
+        tracer.trace(disassemble_inst)
+        self.assertEqual(counter.states_popped, 3)
+        self.assertEqual(counter.states_popped, len(tracer.queue.traced))
+
+    def test_add_observer_twice_sends_events_to_both(self):
+        memory = Memory(bytearray(0x10000))
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1005)
+            )
+        counters = [CountingObserver(), CountingObserver()]
+        for counter in counters:
+            tracer.add_observer(counter)
+        tracer.enqueue_address(0x1000)
+        tracer.enqueue_address(0x1000)
+        for counter in counters:
+            self.assertEqual(counter.states_deduplicated, 1)
+
+    def test_base_observer_ignores_all_events(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1000       ;1000  fd fe
+        rom[0x1001] = 0xfe
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1002)
+            )
+        tracer.add_observer(TraceObserver())
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_instruction_start(0x1000))
+
+    # blocks
+
+    def test_get_block_returns_straight_line_code(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x91   # setc            ;1000  91
+        rom[0x1001] = 0x00   # nop             ;1001  00
+        rom[0x1002] = 0x20   # ret             ;1002  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1003)
+            )
+        tracer.trace(disassemble_inst)
+        block = tracer.get_block(0x1000)
+        self.assertEqual(block.addresses, [0x1000, 0x1001])
+        self.assertEqual(block.end, 0x1002)
+        self.assertEqual(tracer.get_block(0x1002), None) # ret
+
+    def test_trace_retraces_block_with_new_state(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0x04   # mov a, #0x00    ;1002  04 00
+        rom[0x1003] = 0x00
+        rom[0x1004] = 0x00   # nop             ;1004  00
+        rom[0x1005] = 0x00   # nop             ;1005  00
+        rom[0x1006] = 0xfd   # bz 0x1009       ;1006  fd 01
+        rom[0x1007] = 0x01
+        rom[0x1008] = 0x20   # ret             ;1008  20
+        rom[0x1009] = 0x20   # ret             ;1009  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x100a)
+            )
+        tracer.trace(disassemble_inst)
+        # 0x1004 is first traced with z=1 from the branch, then again as a
+        # block with z=1 after "mov a, #0x00", so the bz at 0x1006 is
+        # always taken
+        self.assertTrue(memory.is_instruction_start(0x1006))
+        self.assertTrue(memory.is_branch_always_taken(0x1006))
+        self.assertTrue(memory.is_data(0x1008)) # never traced
+
+    # annotate_branches
+
+    def test_annotate_branches_checks_all_instructions_by_default(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0xfd   # bz 0x1006       ;1002  fd 02
+        rom[0x1003] = 0x02
+        memory = Memory(rom)
+        memory.set_instruction(0x1000, disassemble_inst(memory, 0x1000))
+        memory.set_instruction(0x1002, disassemble_inst(memory, 0x1002))
+        memory.annotate_branch_taken(0x1000)
+        memory.annotate_branch_not_taken(0x1002)
+        tracer = Tracer(memory, [], [], range(0x1000, 0x1004))
+        tracer.annotate_branches()
+        self.assertTrue(memory.is_branch_always_taken(0x1000))
+        self.assertFalse(memory.is_branch_never_taken(0x1000))
+        self.assertTrue(memory.is_branch_never_taken(0x1002))
+        self.assertFalse(memory.is_branch_always_taken(0x1002))
+
+    def test_annotate_branches_checks_only_given_addresses(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0xfd   # bz 0x1006       ;1002  fd 02
+        rom[0x1003] = 0x02
+        memory = Memory(rom)
+        memory.set_instruction(0x1000, disassemble_inst(memory, 0x1000))
+        memory.set_instruction(0x1002, disassemble_inst(memory, 0x1002))
+        memory.annotate_branch_taken(0x1000)
+        memory.annotate_branch_taken(0x1002)
+        tracer = Tracer(memory, [], [], range(0x1000, 0x1004))
+        tracer.annotate_branches([0x1002])
+        self.assertFalse(memory.is_branch_always_taken(0x1000))
+        self.assertTrue(memory.is_branch_always_taken(0x1002))
+
+    # merging states
+
+    def test_trace_merges_states_at_same_pc(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0xfd   # bz 0x1004       ;1000  fd 02
+        rom[0x1001] = 0x02
+        rom[0x1002] = 0x00   # nop             ;1002  00
+        rom[0x1003] = 0x00   # nop             ;1003  00
+        rom[0x1004] = 0x20   # ret             ;1004  20
+        traced = []
+        for merge_states in (False, True):
+            memory = Memory(rom)
+            tracer = Tracer(
+                memory=memory,
+                entry_points=[0x1000],
+                vectors=[],
+                traceable_range=range(0x1000, 0x1005),
+                merge_states=merge_states,
+                )
+            tracer.trace(disassemble_inst)
+            self.assertTrue(memory.is_instruction_start(0x1004))
+            traced.append(tracer.queue.traced_processor_states)
+        self.assertEqual(len(traced[0]), 5) # 0x1004 with z=0 and z=1
+        self.assertEqual(len(traced[1]), 4) # 0x1004 with z unknown
+        self.assertTrue(ProcessorState(pc=0x1004) in traced[1])
+
     # branch always taken
 
     def test_branch_always_taken_bnz_bz(self):
@@ -734,3 +1148,90 @@ class TracerTests(unittest.TestCase):
         self.assertTrue(memory.is_instruction_start(0xf9e5))
         self.assertTrue(memory.is_unknown(0xf9e7)) # tracing stopped
         self.assertTrue(memory.is_branch_never_taken(0xf9e5))
+
+    # resuming
+
+    def test_add_entry_point_after_trace_reclaims_data_as_code(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x20   # ret           ;1000  20
+        rom[0x1001] = 0x00   # nop           ;1001  00
+        rom[0x1002] = 0x20   # ret           ;1002  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1002+1)
+            )
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_data(0x1001))
+        self.assertTrue(memory.is_data(0x1002))
+
+        counter = CountingObserver()
+        tracer.add_observer(counter)
+        tracer.add_entry_point(0x1001)
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_instruction_start(0x1000))
+        self.assertTrue(memory.is_instruction_start(0x1001))
+        self.assertTrue(memory.is_instruction_start(0x1002))
+        self.assertEqual(counter.instructions_traced, 2)
+
+    def test_add_vector_after_trace_traces_its_target(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x20   # ret           ;1000  20
+        rom[0x1001] = 0x20   # ret           ;1001  20
+        rom[0x1004] = 0x10   # vector        ;1004  10 01
+        rom[0x1005] = 0x01
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1005+1)
+            )
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_data(0x1004))
+
+        tracer.add_vector(0x1004)
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_vector_start(0x1004))
+        self.assertTrue(memory.is_instruction_start(0x1001))
+        self.assertTrue(memory.is_jump_target(0x1001))
+        self.assertTrue(memory.is_data(0x1002))
+        self.assertTrue(memory.is_data(0x1003))
+
+    def test_add_entry_point_after_trace_updates_branch_annotations(self):
+        rom = bytearray(0x10000)
+        rom[0x1000] = 0x81   # clrc          ;1000  81
+        rom[0x1001] = 0xf9   # bc 0x1005     ;1001  f9 02
+        rom[0x1002] = 0x02
+        rom[0x1003] = 0x20   # ret           ;1003  20
+        rom[0x1005] = 0x20   # ret           ;1005  20
+        memory = Memory(rom)
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[0x1000],
+            vectors=[],
+            traceable_range=range(0x1000, 0x1005+1)
+            )
+        tracer.trace(disassemble_inst)
+        self.assertTrue(memory.is_branch_never_taken(0x1001))
+        self.assertTrue(memory.is_data(0x1005))
+
+        tracer.add_entry_point(0x1001) # carry is unknown here
+        tracer.trace(disassemble_inst)
+        self.assertFalse(memory.is_branch_never_taken(0x1001))
+        self.assertFalse(memory.is_branch_always_taken(0x1001))
+        self.assertTrue(memory.is_instruction_start(0x1005))
+        self.assertTrue(memory.is_data(0x1004))
+
+    def test_add_entry_point_raises_if_outside_of_traceable_range(self):
+        memory = Memory(bytearray(0x10000))
+        tracer = Tracer(
+            memory=memory,
+            entry_points=[],
+            vectors=[],
+            traceable_range=range(0x8000, 0x9000)
+            )
+        self.assertRaises(ValueError, tracer.add_entry_point, 0xa000)
+        self.assertRaises(ValueError, tracer.add_vector, 0xa000)
@@ -0,0 +1,128 @@
+'''
+Record a run as Chrome trace events, which can be opened offline in a
+trace viewer such as Perfetto (ui.perfetto.dev, which runs in the browser
+and does not upload the file) or chrome://tracing:
+
+    timeline = Timeline()
+    analysis = analyze_file(filename, options, timeline)
+    with timeline.phase('listing'):
+        analysis.print_listing()
+    with open('trace.json', 'w') as f:
+        timeline.write_trace(f)
+
+Each phase is a span.  While the tracer runs, counters are sampled every
+interval seconds: the length of the trace queue, the states popped per
+second, the program counter of the state being traced, the instructions
+marked in memory, and the unknown bytes remaining in the traceable range.
+'''
+
+import contextlib
+import json
+import os
+import time
+
+from f2mc8dasm.memory import LocationTypes
+from f2mc8dasm.observers import TraceObserver
+from f2mc8dasm.stats import Stats
+
+DEFAULT_INTERVAL = 0.001
+
+
+class Timeline(Stats):
+    '''A Stats that also records its phases and samples of the tracer as
+    trace events.  Memory is not traced by default because it slows the
+    run the timeline is showing.'''
+
+    def __init__(self, trace_memory=False, profile_dir=None,
+                 interval=DEFAULT_INTERVAL):
+        Stats.__init__(self, trace_memory, profile_dir)
+        self.interval = interval
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.events = [
+            self._metadata('process_name', {'name': 'f2mc8dasm'}),
+            self._metadata('thread_name', {'name': 'main'}),
+            ]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.timestamp()
+        try:
+            with Stats.phase(self, name):
+                yield
+        finally:
+            self.events.append({'name': name, 'cat': 'phase', 'ph': 'X',
+                                'ts': start, 'dur': self.timestamp() - start,
+                                'pid': self.pid, 'tid': 1})
+
+    def watch_tracer(self, tracer):
+        Stats.watch_tracer(self, tracer)
+        self._sampler = _SamplingObserver(self, tracer)
+        tracer.add_observer(self._sampler)
+
+    def count_tracer(self, tracer):
+        Stats.count_tracer(self, tracer)
+        self._sampler.sample() # the end of the trace
+
+    def counter(self, name, values):
+        '''Record a sample of one or more counters drawn as one track'''
+        self.events.append({'name': name, 'cat': 'tracer', 'ph': 'C',
+                            'ts': self.timestamp(), 'args': values,
+                            'pid': self.pid, 'tid': 1})
+
+    def timestamp(self):
+        '''Return microseconds since the timeline was created'''
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def write_trace(self, stream):
+        '''Write the events as JSON in the Chrome trace event format'''
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'},
+                  stream)
+        stream.write('\n')
+
+    def _metadata(self, name, args):
+        return {'name': name, 'ph': 'M', 'pid': self.pid, 'tid': 1,
+                'args': args}
+
+
+class _SamplingObserver(TraceObserver):
+    '''Samples the tracer's queue and memory into a Timeline when a state
+    is popped and at least the interval has passed since the last sample'''
+
+    def __init__(self, timeline, tracer):
+        self.timeline = timeline
+        self.tracer = tracer
+        self.states_popped = 0
+        self.pc = None
+        self.last_time = time.perf_counter()
+        self.last_states_popped = 0
+        self.sample()
+
+    def state_popped(self, ps):
+        self.states_popped += 1
+        self.pc = ps.pc
+        if time.perf_counter() - self.last_time >= self.timeline.interval:
+            self.sample()
+
+    def sample(self):
+        now = time.perf_counter()
+        elapsed = now - self.last_time
+        rate = 0
+        if elapsed > 0:
+            rate = (self.states_popped - self.last_states_popped) / elapsed
+        self.last_time = now
+        self.last_states_popped = self.states_popped
+
+        memory = self.tracer.memory
+        traceable_range = self.tracer.traceable_range
+        unknown = memory.types.count(LocationTypes.Unknown,
+                                     traceable_range.start,
+                                     traceable_range.stop)
+        timeline = self.timeline
+        timeline.counter('trace queue', {'pending': len(self.tracer.queue)})
+        timeline.counter('states popped/s', {'rate': round(rate)})
+        if self.pc is not None:
+            timeline.counter('pc', {'pc': self.pc})
+        timeline.counter('memory',
+                         {'instructions': len(memory.instructions),
+                          'unknown bytes': unknown})
@@ -1,265 +1,319 @@
-import os
+import bisect
+import heapq
 from operator import attrgetter
+from f2mc8dasm.memory import LocationTypes
+from f2mc8dasm.observers import ObserverGroup
 from f2mc8dasm.tables import FlowTypes, Flags
 
 class Tracer(object):
-    def __init__(self, memory, entry_points, vectors, traceable_range):
+    def __init__(self, memory, entry_points, vectors, traceable_range,
+                 merge_states=False):
         self.memory = memory
         self.traceable_range = traceable_range
-        self.queue = TraceQueue()
+        self.blocks = {} # entry address: BasicBlock
+        self.observer = None # TraceObserver or None for no events
+        self.data_marked = [] # addresses marked as data by the last trace
+        self.branches = set() # branch addresses annotated since last trace
+        if merge_states:
+            self.queue = MergingTraceQueue()
+        else:
+            self.queue = TraceQueue()
 
         for address in entry_points:
-            if address not in traceable_range:
-                msg = "Address 0x%04X outside of traceable range"
-                raise ValueError(msg % address)
-            self.enqueue_address(address)
+            self.add_entry_point(address)
 
         for address in vectors:
-            if address not in traceable_range:
-                msg = "Vector address 0x%04X outside of traceable range"
-                raise ValueError(msg % address)
-            self.enqueue_vector(address)
+            self.add_vector(address)
+
+    def add_entry_point(self, address):
+        '''Queue an address to be traced.  May be called after trace() to
+        resume it: only the states that become reachable are traced.'''
+        if address not in self.traceable_range:
+            msg = "Address 0x%04X outside of traceable range"
+            raise ValueError(msg % address)
+        self.unmark_data()
+        self.enqueue_address(address)
+
+    def add_vector(self, address):
+        '''Queue the target of a vector to be traced.  May be called after
+        trace() to resume it, like add_entry_point().'''
+        if address not in self.traceable_range:
+            msg = "Vector address 0x%04X outside of traceable range"
+            raise ValueError(msg % address)
+        self.unmark_data()
+        self.enqueue_vector(address)
 
     def trace(self, disassemble_func):
-        mem_len = len(self.memory)
+        decode = self.memory.decode_cache.decode
 
         while len(self.queue):
-            ps = self.queue.pop() # current processor state
-            inst = disassemble_func(self.memory, ps.pc)
-
-            if "LOG" in os.environ: # XXX hack
-                self._log(inst, ps)
-
-            inst_len = len(inst)
-            if (ps.pc + inst_len) >= mem_len:
-                continue  # ignore instruction that would wrap around memory
-
-            if self.memory.is_instruction_start(ps.pc):
-                # tracing previously seen instruction with new processor state
-                pass
-            elif not self.memory.is_unknown(ps.pc, inst_len):
-                # ignore new instruction that would overlap a previous marking
-                continue
-            else:
-                # mark new instruction
-                self.memory.set_instruction(ps.pc, inst)
-
-            new_ps = ps.copy()  # new state after this instruction
-            new_ps.pc = (ps.pc + inst_len) & 0xFFFF
-
-            # trace this instruction
-            handler = self._instruction_handlers.get(inst.opcode)
-            if handler is None:
-                handler = self._generic_handlers[inst.flow_type]
-            handler(self, inst, ps, new_ps)
+            state = self.queue.pop_state() # current packed processor state
+
+            # trace until a state is reached that can't be traced right
+            # away because it must wait its turn in the queue
+            while state is not None:
+                if self.observer is not None:
+                    self.observer.state_popped(ProcessorState.unpack(state))
+                pc = state >> PC_SHIFT
+                if self.memory.is_instruction_start(pc):
+                    block = self.get_block(pc)
+                    if block is not None:
+                        state = self._trace_block(block, state)
+                        continue
+
+                inst = decode(self.memory, pc, disassemble_func)
+                state = self._trace_instruction(inst, state)
 
         self.mark_unknown_memory_as_data()
-        self.annotate_branches()
-
-    def _log(self, inst, ps):
-        print("TRACE " + str(ps).ljust(24) + str(inst))
+        # only branches traced since the last trace can have changed
+        self.annotate_branches(self.branches)
+        self.branches = set()
+
+    def _trace_instruction(self, inst, state):
+        pc = state >> PC_SHIFT
+        if self.observer is not None:
+            self.observer.instruction_traced(inst, ProcessorState.unpack(state))
+
+        inst_len = len(inst)
+        if (pc + inst_len) >= len(self.memory):
+            return None  # ignore instruction that would wrap around memory
+
+        if self.memory.is_instruction_start(pc):
+            # tracing previously seen instruction with new processor state
+            pass
+        elif not self.memory.is_unknown(pc, inst_len):
+            # ignore new instruction that would overlap a previous marking
+            return None
+        else:
+            # mark new instruction
+            self.memory.set_instruction(pc, inst)
+            if self.observer is not None:
+                self.observer.instruction_marked(pc, inst)
+
+        # new state after this instruction
+        new_state = set_state_pc(state, (pc + inst_len) & 0xFFFF)
+
+        # straight-line code only changes flags and has only one next state,
+        # which can be traced immediately if it would be the next one popped
+        if inst.flow_type == FlowTypes.Continue:
+            return self._enqueue_or_take_state(update_flags(inst, new_state))
+
+        # trace this instruction
+        handler = self._instruction_handlers.get(inst.opcode)
+        if handler is None:
+            handler = self._generic_handlers[inst.flow_type]
+        handler(self, inst, state, new_state)
+        return None
+
+    def _trace_block(self, block, state):
+        # the states inside the block would each be popped next only while
+        # their pc is lower than any pc waiting in the queue
+        last = len(block.transfers) - 1
+        min_pc = self.queue.min_pc()
+        if min_pc is not None:
+            last = min(last, bisect.bisect_left(block.next_addresses, min_pc))
+        return self._enqueue_or_take_state(block.state_after(last, state))
+
+    def get_block(self, address):
+        '''Return the BasicBlock of previously traced straight-line code
+        that starts at the address, or None if the instruction there changes
+        the flow of control.  Blocks are built on demand and cached.'''
+        block = self.blocks.get(address)
+        if block is None or (block.open and
+                             self.memory.is_instruction_start(block.end)):
+            block = self._build_block(address)
+            self.blocks[address] = block
+        if block.transfers:
+            return block
+        return None
+
+    def _build_block(self, address):
+        mem_len = len(self.memory)
+        block = BasicBlock(address)
+        while True:
+            inst = self.memory.get_instruction(address)
+            if (address + len(inst)) >= mem_len:
+                break # wraps around memory; never traced
+            if inst.flow_type != FlowTypes.Continue:
+                break # changes flow; traced by its handler
+            block.append(address, inst)
+            address = block.end
+            if address not in self.traceable_range:
+                break
+            if not self.memory.is_instruction_start(address):
+                block.open = True # may be extended when traced further
+                break
+        return block
+
+    def add_observer(self, observer):
+        '''Send trace events to a TraceObserver'''
+        if self.observer is None:
+            self.observer = observer
+        elif isinstance(self.observer, ObserverGroup):
+            self.observer.add(observer)
+        else:
+            self.observer = ObserverGroup([self.observer, observer])
+        self.queue.observer = self.observer
 
     # Handlers for specific instructions
 
-    def _trace_inst_0x04_mov(self, inst, ps, new_ps):
-        # flowtype = continue
-        a = inst.immediate
-        new_ps.n = int((a & 0x80) == 0x80)
-        new_ps.z = int(a == 0)
-        # TODO A register
-        self.enqueue_processor_state(new_ps)
-
-    def _trace_inst_0xe4_movw(self, inst, ps, new_ps):
-        # flowtype = continue
-        a = inst.immediate
-        new_ps.n = int((a & 0x8000) == 0x8000)
-        new_ps.z = int(a == 0)
-        # TODO A register
-        self.enqueue_processor_state(new_ps)
-
-    def _trace_inst_0x91_setc(self, inst, ps, new_ps):
-        # flowtype = continue
-        new_ps.c = 1
-        self.enqueue_processor_state(new_ps)
-
-    def _trace_inst_0x81_clrc(self, inst, ps, new_ps):
-        # flowtype = continue
-        new_ps.c = 0
-        self.enqueue_processor_state(new_ps)
-
-    def _trace_inst_0xf8_bnc(self, inst, ps, new_ps):
+    def _trace_inst_0xf8_bnc(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.c is Unknown:
+        pc = state >> PC_SHIFT
+        c = (state >> C_SHIFT) & 3
+        if c == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.c = 1
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, C_SHIFT, 1))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps = new_ps.copy()
-            new_ps.c = 0
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, C_SHIFT, 0)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.c == 0:
+        elif c == 0:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.c == 1:
+        else:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
 
-    def _trace_inst_0xfa_bp(self, inst, ps, new_ps):
+    def _trace_inst_0xfa_bp(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.n is Unknown:
+        pc = state >> PC_SHIFT
+        n = (state >> N_SHIFT) & 3
+        if n == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.n = 1
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, N_SHIFT, 1))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps = new_ps.copy()
-            new_ps.n = 0
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, N_SHIFT, 0)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.n == 1:
-            # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
-
-        elif ps.n == 0:
+        elif n == 0:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-    def _trace_inst_0xfb_bn(self, inst, ps, new_ps):
+        else:
+            # don't take the branch
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
+
+    def _trace_inst_0xfb_bn(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.n is Unknown:
+        pc = state >> PC_SHIFT
+        n = (state >> N_SHIFT) & 3
+        if n == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.n = 0
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, N_SHIFT, 0))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps = new_ps.copy()
-            new_ps.n = 1
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, N_SHIFT, 1)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.n == 0:
-            # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
-
-        elif ps.n == 1:
+        elif n == 1:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-    def _trace_inst_0xf9_bc(self, inst, ps, new_ps):
+        else:
+            # don't take the branch
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
+
+    def _trace_inst_0xf9_bc(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.c is Unknown:
+        pc = state >> PC_SHIFT
+        c = (state >> C_SHIFT) & 3
+        if c == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.c = 0
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, C_SHIFT, 0))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps = new_ps.copy()
-            new_ps.c = 1
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, C_SHIFT, 1)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.c == 0:
-            # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
-
-        elif ps.c == 1:
+        elif c == 1:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-    def _trace_inst_0xfd_beq(self, inst, ps, new_ps):
+        else:
+            # don't take the branch
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
+
+    def _trace_inst_0xfd_beq(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.z is Unknown:
+        pc = state >> PC_SHIFT
+        z = (state >> Z_SHIFT) & 3
+        if z == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.z = 0
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, Z_SHIFT, 0))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps = new_ps.copy()
-            new_ps.z = 1
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, Z_SHIFT, 1)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.z == 0:
-            # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
-
-        elif ps.z == 1:
+        elif z == 1:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-    def _trace_inst_0xfc_bne(self, inst, ps, new_ps):
+        else:
+            # don't take the branch
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
+
+    def _trace_inst_0xfc_bne(self, inst, state, new_state):
         # flowtype = conditional jump
-        if ps.z is Unknown:
+        pc = state >> PC_SHIFT
+        z = (state >> Z_SHIFT) & 3
+        if z == UNKNOWN_FLAG:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            new_ps.z = 1
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(set_state_flag(new_state, Z_SHIFT, 1))
 
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps2 = new_ps.copy()
-            new_ps2.z = 0
-            new_ps2.pc = inst.address
-            self.enqueue_processor_state(new_ps2)
+            self._annotate_branch_taken(pc)
+            new_state = set_state_flag(new_state, Z_SHIFT, 0)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.z == 0:
+        elif z == 0:
             # take the branch
-            self.memory.annotate_branch_taken(ps.pc)
-            new_ps.pc = inst.address
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_taken(pc)
+            self._enqueue_state(set_state_pc(new_state, inst.address))
             self.memory.annotate_jump_target(inst.address)
 
-        elif ps.z == 1:
+        else:
             # don't take the branch
-            self.memory.annotate_branch_not_taken(ps.pc)
-            self.enqueue_processor_state(new_ps)
+            self._annotate_branch_not_taken(pc)
+            self._enqueue_state(new_state)
 
     _instruction_handlers = {
-        0x04: _trace_inst_0x04_mov,
-        0xe4: _trace_inst_0xe4_movw,
-        0x91: _trace_inst_0x91_setc,
-        0x81: _trace_inst_0x81_clrc,
         0xf8: _trace_inst_0xf8_bnc,
         0xf9: _trace_inst_0xf9_bc,
         0xfa: _trace_inst_0xfa_bp,
@@ -270,56 +324,39 @@ class Tracer(object):
 
     # Fallback handlers for when an instruction handler is not available
 
-    def _trace_generic_continue(self, inst, ps, new_ps):
-        self._update_flags(inst, new_ps)
-        self.enqueue_processor_state(new_ps)
-
-    def _trace_generic_conditional_jump(self, inst, ps, new_ps):
-        self._update_flags(inst, new_ps)
+    def _trace_generic_conditional_jump(self, inst, state, new_state):
+        new_state = update_flags(inst, new_state)
 
         # don't take the branch
-        self.enqueue_processor_state(new_ps)
+        self._enqueue_state(new_state)
 
         # take the branch
-        new_ps = new_ps.copy()
-        new_ps.pc = inst.address
-        self.enqueue_processor_state(new_ps)
+        self._enqueue_state(set_state_pc(new_state, inst.address))
         self.memory.annotate_jump_target(inst.address)
 
-    def _trace_generic_unconditional_jump(self, inst, ps, new_ps):
-        self._update_flags(inst, new_ps)
+    def _trace_generic_unconditional_jump(self, inst, state, new_state):
+        new_state = update_flags(inst, new_state)
         self.memory.annotate_jump_target(inst.address)
-        new_ps.pc = inst.address
-        self.enqueue_processor_state(new_ps)
+        self._enqueue_state(set_state_pc(new_state, inst.address))
 
-    def _trace_generic_subroutine_call(self, inst, ps, new_ps):
+    def _trace_generic_subroutine_call(self, inst, state, new_state):
         # enqueue the next instruction after call returns
         # XXX the processor flags are dropped here because we don't
         # know how the subroutine would have affected them.
-        new_ps2 = ProcessorState(pc=new_ps.pc)
-        self.enqueue_processor_state(new_ps2)
+        self._enqueue_state(pack_state(new_state >> PC_SHIFT))
 
         # enqueue the subroutine called
-        new_ps.pc = inst.address
         self.memory.annotate_call_target(inst.address)
-        self.enqueue_processor_state(new_ps)
+        self._enqueue_state(set_state_pc(new_state, inst.address))
 
-    def _trace_generic_indirect_unconditional_jump(self, inst, ps, new_ps):
+    def _trace_generic_indirect_unconditional_jump(self, inst, state,
+                                                   new_state):
         pass
 
-    def _trace_generic_subroutine_return(self, inst, ps, new_ps):
+    def _trace_generic_subroutine_return(self, inst, state, new_state):
         pass
 
-    def _update_flags(self, inst, ps):
-        if Flags.C in inst.affected_flags:
-            ps.c = Unknown
-        if Flags.N in inst.affected_flags:
-            ps.n = Unknown
-        if Flags.Z in inst.affected_flags:
-            ps.z = Unknown
-
     _generic_handlers = {
-        FlowTypes.Continue:          _trace_generic_continue,
         FlowTypes.UnconditionalJump: _trace_generic_unconditional_jump,
         FlowTypes.ConditionalJump:   _trace_generic_conditional_jump,
         FlowTypes.SubroutineCall:    _trace_generic_subroutine_call,
@@ -327,19 +364,46 @@ class Tracer(object):
         FlowTypes.SubroutineReturn:  _trace_generic_subroutine_return,
     }
 
+    def _annotate_branch_taken(self, address):
+        self.memory.annotate_branch_taken(address)
+        self.branches.add(address)
+        if self.observer is not None:
+            self.observer.branch_annotated(address, True)
+
+    def _annotate_branch_not_taken(self, address):
+        self.memory.annotate_branch_not_taken(address)
+        self.branches.add(address)
+        if self.observer is not None:
+            self.observer.branch_annotated(address, False)
+
     def enqueue_processor_state(self, ps):
-        if ps.pc in self.traceable_range:
-            if self.memory.is_unknown(ps.pc):
-                self.queue.push(ps)
-            elif self.memory.is_instruction_start(ps.pc):
+        self._enqueue_state(ps.pack())
+
+    def _enqueue_state(self, state):
+        if self._is_traceable(state >> PC_SHIFT):
+            self.queue.push_state(state)
+
+    def _enqueue_or_take_state(self, state):
+        # enqueue the state, unless it would be the next state popped from
+        # the queue.  in that case, return it so it can be traced right away
+        # without passing through the queue.
+        if self._is_traceable(state >> PC_SHIFT):
+            return self.queue.push_or_take_state(state)
+        return None
+
+    def _is_traceable(self, pc):
+        if pc in self.traceable_range:
+            if self.memory.is_unknown(pc):
+                return True
+            elif self.memory.is_instruction_start(pc):
                 # we need to queue it again to so it's traced with the current
                 # processor state
-                self.queue.push(ps)
+                return True
+        return False
 
     def enqueue_address(self, address):
         if address in self.traceable_range:
-            ps = ProcessorState(pc=address)
-            self.enqueue_processor_state(ps)
+            self._enqueue_state(pack_state(address))
 
     def enqueue_vector(self, address):
         if address in self.traceable_range:
@@ -352,91 +416,454 @@ class Tracer(object):
                 self.enqueue_address(target)
 
     def mark_unknown_memory_as_data(self):
-        for address in self.traceable_range:
-            if self.memory.is_unknown(address):
-                self.memory.set_data(address)
-
-    def annotate_branches(self):
-        for address, inst in self.memory.iter_instructions():
-            if self.memory.is_branch_taken(address):
-                if not self.memory.is_branch_not_taken(address):
-                    self.memory.annotate_branch_always_taken(address)
+        start, end = self.traceable_range.start, self.traceable_range.stop
+        regions = self.memory.iter_regions(start, end, LocationTypes.Unknown)
+        for start, end, loc_type in list(regions):
+            self.memory.set_data(start, end - start)
+            self.data_marked.extend(range(start, end))
+
+    def unmark_data(self):
+        '''Return the locations marked as data by mark_unknown_memory_as_data()
+        to unknown so that a resumed trace can mark them as code.'''
+        for address in self.data_marked:
+            if self.memory.is_data(address):
+                self.memory.set_unknown(address)
+        self.data_marked = []
+
+    def annotate_branches(self, addresses=None):
+        '''Annotate branches found to be only taken as always taken, and
+        branches found to be only not taken as never taken.  All instructions
+        are checked unless the addresses to check are given.'''
+        if addresses is None:
+            addresses = [ address for address, inst
+                          in self.memory.iter_instructions() ]
+        for address in sorted(addresses):
+            taken = self.memory.is_branch_taken(address)
+            not_taken = self.memory.is_branch_not_taken(address)
+
+            if taken and not not_taken:
+                self.memory.annotate_branch_always_taken(address)
+            else:
+                self.memory.unannotate_branch_always_taken(address)
 
-            if self.memory.is_branch_not_taken(address):
-                if not self.memory.is_branch_taken(address):
-                    self.memory.annotate_branch_never_taken(address)
+            if not_taken and not taken:
+                self.memory.annotate_branch_never_taken(address)
+            else:
+                self.memory.unannotate_branch_never_taken(address)
 
 
 class TraceQueue(object):
     '''A queue for holding processor states that need to be traced.  States may
     be pushed in any order but are always popped sorted by the program counter.
     A state that was pushed will be ignored if it is pushed again, even if it
-    was popped off.'''
+    was popped off.
+
+    States are held as packed ints (see pack_state()).  push(), pop(), and
+    push_or_take() take and return ProcessorState objects instead.'''
 
     def __init__(self):
-        self.untraced_processor_states = SortedSet(key=attrgetter('pc'))
-        self.traced_processor_states = set()
+        self.heap = []          # heap entries, see _make_entry()
+        self.untraced = {}      # packed state: serial of its live heap entry
+        self.traced = set()     # packed states
+        self.next_serial = 0    # breaks ties between equal pcs
+        self.taken = 0          # states taken by push_or_take() unqueued
+        self.observer = None # TraceObserver for state_deduplicated events
 
     def __len__(self):
-        return len(self.untraced_processor_states)
+        return len(self.untraced)
+
+    @property
+    def untraced_processor_states(self):
+        '''A SortedSet of the ProcessorStates waiting to be traced,
+        unpacked from the queue on each access'''
+        states = [ ProcessorState.unpack(state)
+                   for state in self.pending_states() ]
+        return SortedSet(states, key=attrgetter('pc'))
+
+    @property
+    def traced_processor_states(self):
+        '''A set of the ProcessorStates already traced, unpacked on each
+        access'''
+        return set([ ProcessorState.unpack(state) for state in self.traced ])
 
     def push(self, processor_state):
-        if processor_state not in self.traced_processor_states:
-            if processor_state not in self.untraced_processor_states:
-                self.untraced_processor_states.add(processor_state)
+        self.push_state(processor_state.pack())
 
     def pop(self):
-        if self.untraced_processor_states:
-            processor_state = self.untraced_processor_states.pop()
-            self.traced_processor_states.add(processor_state)
-            return processor_state
+        return ProcessorState.unpack(self.pop_state())
+
+    def push_or_take(self, processor_state):
+        '''Same as push() followed by pop() when the pushed state is the one
+        pop() would return.  Returns the state if it was taken, or None if it
+        was queued or ignored.'''
+        state = self.push_or_take_state(processor_state.pack())
+        if state is None:
+            return None
+        return ProcessorState.unpack(state)
+
+    def push_state(self, state):
+        if (state in self.traced) or (state in self.untraced):
+            if self.observer is not None:
+                self.observer.state_deduplicated(ProcessorState.unpack(state))
+        else:
+            self._add(state)
+
+    def pop_state(self):
+        heap = self.heap
+        while heap:
+            entry = heapq.heappop(heap)
+            if self._is_live(entry):
+                state = _entry_state(entry)
+                del self.untraced[state]
+                self.traced.add(state)
+                return state
         raise KeyError("pop from empty trace queue")
 
+    def push_or_take_state(self, state):
+        if (state in self.traced) or (state in self.untraced):
+            if self.observer is not None:
+                self.observer.state_deduplicated(ProcessorState.unpack(state))
+            return None
+        min_pc = self.min_pc()
+        if (min_pc is not None) and (min_pc <= (state >> PC_SHIFT)):
+            # a state with an equal pc that was pushed earlier pops first
+            self._add(state)
+            return None
+        self.traced.add(state)
+        self.taken += 1
+        return state
+
+    def pending_states(self):
+        '''Return the packed states waiting to be traced in the order they
+        would be popped'''
+        entries = [ entry for entry in self.heap if self._is_live(entry) ]
+        entries.sort()
+        return [ _entry_state(entry) for entry in entries ]
+
+    def add_traced_state(self, state):
+        '''Record a packed state as already traced without tracing it, as
+        when restoring a saved trace'''
+        self.traced.add(state)
+
+    def min_pc(self):
+        '''Return the lowest pc waiting to be traced, or None if empty'''
+        heap = self.heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            return heap[0] >> _ENTRY_PC_SHIFT
+        return None
+
+    def _add(self, state):
+        serial = self.next_serial
+        self.next_serial += 1
+        self.untraced[state] = serial
+        heapq.heappush(self.heap, _make_entry(state, serial))
+
+    def _remove(self, state):
+        # the heap entry is left in place and skipped when it surfaces
+        del self.untraced[state]
+        if len(self.heap) > (2 * len(self.untraced)) + 64:
+            self.heap = [ entry for entry in self.heap
+                          if self._is_live(entry) ]
+            heapq.heapify(self.heap)
+
+    def _is_live(self, entry):
+        serial = (entry >> PC_SHIFT) & _ENTRY_SERIAL_MASK
+        return self.untraced.get(_entry_state(entry)) == serial
+
+
+# A heap entry is a single int that sorts by pc and then by the order the
+# states were pushed: pc in bits 46 and up, serial in bits 6-45, flags in 0-5
+_ENTRY_PC_SHIFT = 46
+_ENTRY_SERIAL_MASK = (1 << 40) - 1
+
+def _make_entry(state, serial):
+    return (((state >> PC_SHIFT) << _ENTRY_PC_SHIFT) |
+            (serial << PC_SHIFT) | (state & FLAGS_MASK))
+
+def _entry_state(entry):
+    return ((entry >> _ENTRY_PC_SHIFT) << PC_SHIFT) | (entry & FLAGS_MASK)
+
+
+class MergingTraceQueue(TraceQueue):
+    '''A TraceQueue that keeps at most one state per program counter.  A state
+    pushed for a pc that has already been seen is joined with the states
+    before it: any flag that differs between them becomes Unknown.  The
+    joined state is queued only if it is less precise than every state
+    traced at that pc so far, so each pc is traced at most four times.
+    The states inside a block traced by Tracer._trace_block() are never
+    pushed, so they are not joined; only the state after the block is.'''
+
+    def __init__(self):
+        TraceQueue.__init__(self)
+        self.joined = {} # pc: packed join of all states pushed
+
+    def push_state(self, state):
+        new = self._join(state)
+        if new is not None:
+            TraceQueue.push_state(self, new)
+
+    def push_or_take_state(self, state):
+        new = self._join(state)
+        if new is not None:
+            return TraceQueue.push_or_take_state(self, new)
+        return None
+
+    def add_traced_state(self, state):
+        TraceQueue.add_traced_state(self, state)
+        pc = state >> PC_SHIFT
+        old = self.joined.get(pc)
+        self.joined[pc] = state if old is None else join_states(old, state)
+
+    def _join(self, state):
+        # returns the state that needs to be traced, or None if none does
+        pc = state >> PC_SHIFT
+        old = self.joined.get(pc)
+        if old is None:
+            new = state
+        else:
+            new = join_states(old, state)
+            if new == old:
+                # already covered by a traced or pending state
+                if self.observer is not None:
+                    self.observer.state_deduplicated(
+                        ProcessorState.unpack(state))
+                return None
+            if old in self.untraced:
+                self._remove(old)
+        self.joined[pc] = new
+        return new
+
 
 class SortedSet(object):
-    '''A set-like object where pop() returns items in sorted order'''
+    '''A set-like object where pop() returns items in sorted order.  Items
+    with equal keys are popped in the order they were added.  Backed by a
+    binary heap and a dict so add, pop, remove, and membership tests do
+    not depend on a linear scan.'''
 
     def __init__(self, items=None, key=None):
-        self.items = []            # for ordered retrieval
+        self.heap = []             # (key, serial, item) for ordered retrieval
+        self.serials = {}          # item: serial of its live heap entry
+        self.next_serial = 0       # breaks ties between equal keys
         self.key = key             # key function for sorting
         if items is not None:
             for item in items:
                 self.add(item)
 
     def __len__(self):
-        return len(self.items)
+        return len(self.serials)
 
     def __contains__(self, item):
-        return item in self.items
+        return item in self.serials
 
     def __iter__(self):
-        return iter(self.items)
+        entries = [ entry for entry in self.heap if self._is_live(entry) ]
+        entries.sort()
+        return iter([ item for _, _, item in entries ])
 
     def __eq__(self, other):
-        return sorted(other) == self.items
+        return sorted(other) == list(self)
 
     def add(self, item):
-        if item not in self.items:
-            self.items.append(item)
-            self.items.sort(key=self.key)
+        if item not in self.serials:
+            serial = self.next_serial
+            self.next_serial += 1
+            key = item if self.key is None else self.key(item)
+            self.serials[item] = serial
+            heapq.heappush(self.heap, (key, serial, item))
 
     def remove(self, item):
-        try:
-            self.items.remove(item)
-        except ValueError:
-            raise KeyError(item)
+        # the heap entry is left in place and skipped when it surfaces
+        del self.serials[item]
+        if len(self.heap) > (2 * len(self.serials)) + 64:
+            self._compact()
+
+    def min_key(self):
+        '''Return the key of the item pop() would return, or None if empty'''
+        heap = self.heap
+        while heap and not self._is_live(heap[0]):
+            heapq.heappop(heap)
+        if heap:
+            return heap[0][0]
+        return None
 
     def pop(self):
-        try:
-            return self.items.pop(0)
-        except IndexError:
-            raise KeyError("pop from empty SortedSet")
+        heap = self.heap
+        while heap:
+            entry = heapq.heappop(heap)
+            if self._is_live(entry):
+                del self.serials[entry[2]]
+                return entry[2]
+        raise KeyError("pop from empty SortedSet")
+
+    def _is_live(self, entry):
+        _, serial, item = entry
+        return self.serials.get(item) == serial
+
+    def _compact(self):
+        self.heap = [ entry for entry in self.heap if self._is_live(entry) ]
+        heapq.heapify(self.heap)
 
 
 Unknown = object()
 
 
+class BasicBlock(object):
+    '''A run of straight-line instructions entered only at its start.  The
+    change each instruction makes to the flags does not depend on the flags
+    before it, so the effect of the block up to any instruction is computed
+    once, when the block is built, and applies to every processor state.'''
+
+    def __init__(self, start):
+        self.start = start          # address of first instruction
+        self.end = start            # address after last instruction
+        self.addresses = []         # address of each instruction
+        self.instructions = []      # Instruction at each address
+        self.next_addresses = []    # address after each instruction
+        self.transfers = []         # (keep, set) flag masks after each
+        self.open = False           # True if code after end was not traced
+
+    def __len__(self):
+        return len(self.instructions)
+
+    def append(self, address, inst):
+        if self.transfers:
+            keep, set_ = self.transfers[-1]
+        else:
+            keep, set_ = FLAGS_MASK, 0
+
+        # flag bits that differ between the results for all-zero and
+        # all-one flags are passed through, the rest are set by inst
+        zeros = update_flags(inst, 0)
+        ones = update_flags(inst, FLAGS_MASK)
+        inst_keep = (zeros ^ ones) & FLAGS_MASK
+        keep = keep & inst_keep
+        set_ = (set_ & inst_keep) | zeros
+
+        self.addresses.append(address)
+        self.instructions.append(inst)
+        self.end = (address + len(inst)) & 0xFFFF
+        self.next_addresses.append(self.end)
+        self.transfers.append((keep, set_))
+
+    def state_after(self, index, state):
+        '''Return the packed processor state after the instruction at the
+        index when the block is entered with the packed state.'''
+        keep, set_ = self.transfers[index]
+        return ((self.next_addresses[index] << PC_SHIFT) |
+                (state & keep) | set_)
+
+
+def find_basic_blocks(memory):
+    '''Split the instructions marked in memory into basic blocks.  A block
+    ends after an instruction that changes the flow of control or before an
+    instruction that is the target of a jump or call.  Returns a dict of
+    start address: BasicBlock.'''
+    blocks = {}
+    block = None
+    for address, inst in memory.iter_instructions():
+        if ((block is None) or (block.end != address) or
+                memory.is_jump_target(address) or
+                memory.is_call_target(address)):
+            block = BasicBlock(address)
+            blocks[address] = block
+        block.append(address, inst)
+        if inst.flow_type != FlowTypes.Continue:
+            block = None
+    return blocks
+
+
+# A packed processor state is an int with the pc in bits 6 and up and two
+# bits for each flag: c in bits 4-5, n in bits 2-3, and z in bits 0-1.
+# A flag is 0, 1, or UNKNOWN_FLAG.
+PC_SHIFT = 6
+C_SHIFT = 4
+N_SHIFT = 2
+Z_SHIFT = 0
+FLAGS_MASK = 0x3F
+UNKNOWN_FLAG = 2
+ALL_FLAGS_UNKNOWN = 0x2A
+
+def pack_state(pc, c=UNKNOWN_FLAG, n=UNKNOWN_FLAG, z=UNKNOWN_FLAG):
+    return (pc << PC_SHIFT) | (c << C_SHIFT) | (n << N_SHIFT) | (z << Z_SHIFT)
+
+def state_pc(state):
+    return state >> PC_SHIFT
+
+def state_flag(state, shift):
+    return (state >> shift) & 3
+
+def set_state_pc(state, pc):
+    return (pc << PC_SHIFT) | (state & FLAGS_MASK)
+
+def set_state_flag(state, shift, value):
+    return (state & ~(3 << shift)) | (value << shift)
+
+def join_states(state1, state2):
+    '''Join two packed states with the same pc.  Flags that are not the
+    same in both states become UNKNOWN_FLAG.'''
+    differ = state1 ^ state2
+    differ = (differ | (differ >> 1)) & 0x15 # low bit of each differing flag
+    return (state1 & ~(differ * 3)) | (differ << 1)
+
+
+def update_flags(inst, state):
+    '''Return the packed processor state with its flags updated for the
+    effect of executing an instruction.  Flags whose result is not known
+    become UNKNOWN_FLAG.'''
+    updater = _flag_updaters.get(inst.opcode)
+    if updater is None:
+        mask = _affected_flags_masks.get(inst.affected_flags)
+        if mask is None:
+            mask = _make_affected_flags_mask(inst.affected_flags)
+        return (state & ~mask) | (mask & ALL_FLAGS_UNKNOWN)
+    return updater(inst, state)
+
+def _make_affected_flags_mask(affected_flags):
+    mask = 0
+    for flag, shift in ((Flags.C, C_SHIFT), (Flags.N, N_SHIFT),
+                        (Flags.Z, Z_SHIFT)):
+        if flag in affected_flags:
+            mask |= 3 << shift
+    _affected_flags_masks[affected_flags] = mask
+    return mask
+
+_affected_flags_masks = {} # affected_flags tuple: mask of their bits
+
+def _update_flags_0x04_mov(inst, state):
+    a = inst.immediate
+    n = int((a & 0x80) == 0x80)
+    z = int(a == 0)
+    # TODO A register
+    return ((state & ~((3 << N_SHIFT) | (3 << Z_SHIFT))) |
+            (n << N_SHIFT) | (z << Z_SHIFT))
+
+def _update_flags_0xe4_movw(inst, state):
+    a = inst.immediate
+    n = int((a & 0x8000) == 0x8000)
+    z = int(a == 0)
+    # TODO A register
+    return ((state & ~((3 << N_SHIFT) | (3 << Z_SHIFT))) |
+            (n << N_SHIFT) | (z << Z_SHIFT))
+
+def _update_flags_0x91_setc(inst, state):
+    return set_state_flag(state, C_SHIFT, 1)
+
+def _update_flags_0x81_clrc(inst, state):
+    return set_state_flag(state, C_SHIFT, 0)
+
+_flag_updaters = {
+    0x04: _update_flags_0x04_mov,
+    0xe4: _update_flags_0xe4_movw,
+    0x91: _update_flags_0x91_setc,
+    0x81: _update_flags_0x81_clrc,
+}
+
+
 class ProcessorState(object):
+    '''A processor state with named fields and Unknown for unknown values.
+    The tracer works on packed ints; see pack() and unpack().'''
     __slots__ = ('pc', 'c', 'n', 'z')
 
     def __init__(self, pc=Unknown, n=Unknown, z=Unknown, c=Unknown):
@@ -464,3 +891,42 @@ class ProcessorState(object):
 
     def copy(self):
         return ProcessorState(pc=self.pc, c=self.c, n=self.n, z=self.z)
+
+    def join(self, other):
+        '''Return a state that covers both states.  Flags that are not the
+        same in both states become Unknown.'''
+        return ProcessorState(pc=self.pc,
+                              c=_join_flag(self.c, other.c),
+                              n=_join_flag(self.n, other.n),
+                              z=_join_flag(self.z, other.z))
+
+    def pack(self):
+        '''Return the state as a packed int.  The pc must be known.'''
+        if self.pc is Unknown:
+            raise ValueError("Cannot pack a state with an unknown pc")
+        return pack_state(self.pc, _pack_flag(self.c), _pack_flag(self.n),
+                          _pack_flag(self.z))
+
+    @classmethod
+    def unpack(cls, state):
+        '''Return a ProcessorState for a packed int'''
+        return cls(pc=state >> PC_SHIFT,
+                   c=_unpack_flag(state_flag(state, C_SHIFT)),
+                   n=_unpack_flag(state_flag(state, N_SHIFT)),
+                   z=_unpack_flag(state_flag(state, Z_SHIFT)))
+
+
+def _join_flag(a, b):
+    if a == b:
+        return a
+    return Unknown
+
+def _pack_flag(flag):
+    if flag is Unknown:
+        return UNKNOWN_FLAG
+    return flag
+
+def _unpack_flag(flag):
+    if flag == UNKNOWN_FLAG:
+        return Unknown
+    return flag
@@ -1,7 +1,6 @@
-__version__ = '1.0.0.dev0'
-
 import sys
 from setuptools import setup, find_packages
+from f2mc8dasm import __version__
 
 if sys.version_info[:2] < (3, 4):
     raise RuntimeError('f2mc8dasm requires Python 3.4 or later')
@@ -53,6 +52,7 @@ setup(
     entry_points={
         'console_scripts': [
             'f2mc8dasm = f2mc8dasm.command:main',
+            'f2mc8dasm-client = f2mc8dasm.client:main',
         ],
     },
 )